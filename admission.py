@@ -0,0 +1,262 @@
+import os
+import json
+import threading
+from collections import namedtuple
+from residency import GB
+from tiling import parse_resolution, format_resolution, base_size, tile_boxes, effective_steps
+
+# Motor que atiende cada modo del planificador
+ENGINES = {"generate": "flux", "edit": "flux", "analyze": "vlm"}
+
+# Pesos residentes por (motor, bits de cuantización); None = sin cuantizar (bf16)
+WEIGHT_BYTES = {
+    ("flux", 4): int(9.5 * GB), ("flux", 8): int(17 * GB), ("flux", None): int(33 * GB),
+    ("vlm", 4): int(5.5 * GB), ("vlm", 8): int(9.5 * GB), ("vlm", None): int(17 * GB),
+}
+# Velocidad relativa del denoising según la cuantización (4 bits como referencia)
+QUANT_SPEED = {4: 1.0, 8: 1.1, None: 1.3}
+
+# Estimaciones a priori (Mac Mini M4 Pro, FLUX.1-schnell y Qwen2-VL-7B a 4 bits) hasta que
+# haya ejecuciones registradas: segundos = fijo + por_unidad * trabajo y
+# memoria = pesos + por_mp * megapíxeles, con trabajo = pasos efectivos * megapíxeles
+PRIORS = {
+    "generate": {"seconds": (3.0, 2.6), "memory": (WEIGHT_BYTES[("flux", 4)], int(2.0 * GB))},
+    "edit": {"seconds": (4.0, 2.6), "memory": (WEIGHT_BYTES[("flux", 4)], int(2.5 * GB))},
+    "analyze": {"seconds": (12.0, 0.0), "memory": (WEIGHT_BYTES[("vlm", 4)], int(1.5 * GB))},
+}
+
+# Etapas de una traza que no forman parte del coste de ejecutar el trabajo
+OVERHEAD_STAGES = ("queue_wait", "translation", "model_load", "thumbnail")
+
+MIN_SAMPLES = 3
+MAX_SAMPLES = 500
+MIN_SIDE = 512
+
+Cost = namedtuple("Cost", ["memory_bytes", "seconds"])
+
+
+def _fit_line(xs, ys):
+    """Mínimos cuadrados de y = a + b*x; None si x no varía lo bastante para estimar la pendiente."""
+    n = len(xs)
+    mean_x, mean_y = sum(xs) / n, sum(ys) / n
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x <= 1e-9 * max(1.0, mean_x * mean_x):
+        return None
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    if slope <= 0:
+        return None
+    return mean_y - slope * mean_x, slope
+
+
+class CostModel:
+    """
+    Predice pico de memoria y duración de un trabajo a partir de (motor, resolución, pasos,
+    cuantización, modo). Parte de PRIORS y se recalibra con ejecuciones registradas: las
+    trazas de metrics.jsonl al arrancar y cada trabajo terminado mientras el servidor corre.
+    """
+
+    def __init__(self, quantization=4, tile_mode="auto", tile_size=1024, tile_overlap=128,
+                 tile_refine_strength=0.35):
+        self.quantization = quantization
+        self.tile_mode = tile_mode
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_refine_strength = tile_refine_strength
+        self._samples = {mode: {"seconds": [], "memory": []} for mode in PRIORS}
+        self._coefficients = {mode: dict(PRIORS[mode]) for mode in PRIORS}
+        self._lock = threading.Lock()
+
+    def passes(self, mode, resolution, steps, strength=0.8):
+        """
+        Pasadas de FLUX que hará el motor: lista de (pasos efectivos, megapíxeles).
+        Como _run_flux: por encima de tile_size² hay pasada base + teselas, y cada tesela
+        es una edición con tile_refine_strength. Los pasos salen de tiling.effective_steps.
+        """
+        if mode == "analyze":
+            return [(1, 0.0)]
+        width, height = parse_resolution(resolution)
+        effective = effective_steps(mode, steps, strength)
+        if width * height > self.tile_size * self.tile_size and self.tile_mode == "auto":
+            base_w, base_h = base_size(width, height, self.tile_size)
+            refine = effective_steps("edit", steps, self.tile_refine_strength)
+            return [(effective, base_w * base_h / 1e6)] + [
+                (refine, (box[2] - box[0]) * (box[3] - box[1]) / 1e6)
+                for box in tile_boxes(width, height, self.tile_size, self.tile_overlap)
+            ]
+        return [(effective, width * height / 1e6)]
+
+    def predict(self, mode, resolution="1024x1024", steps=4, strength=0.8, quantization=-1):
+        """Cost(bytes de pico, segundos) estimados; quantization=-1 usa la del servidor."""
+        if quantization == -1:
+            quantization = self.quantization
+        engine = ENGINES[mode]
+        passes = self.passes(mode, resolution, steps, strength)
+        with self._lock:
+            base_s, per_unit = self._coefficients[mode]["seconds"]
+            base_mem, per_mp = self._coefficients[mode]["memory"]
+        # Cada pasada paga su coste fijo (codificar, decodificar VAE); el pico es el de la mayor
+        seconds = sum(base_s + per_unit * pass_steps * mp for pass_steps, mp in passes)
+        seconds *= QUANT_SPEED.get(quantization, 1.0)
+        memory = base_mem + per_mp * max(mp for _, mp in passes)
+        reference = WEIGHT_BYTES[(engine, self.quantization)]
+        memory += WEIGHT_BYTES.get((engine, quantization), reference) - reference
+        return Cost(int(memory), seconds)
+
+    def observe(self, mode, resolution, steps, strength=0.8, seconds=None, peak_memory=None):
+        """Añade una ejecución real (con la cuantización del servidor) y recalibra el modo."""
+        if mode not in PRIORS:
+            return
+        passes = self.passes(mode, resolution, steps, strength)
+        work = sum(pass_steps * mp for pass_steps, mp in passes)
+        largest = max(mp for _, mp in passes)
+        with self._lock:
+            samples = self._samples[mode]
+            if seconds is not None and seconds > 0:
+                # Normalizado a una pasada para ajustar fijo + por_unidad con todas las resoluciones
+                samples["seconds"].append((work / len(passes), seconds / len(passes)))
+                del samples["seconds"][:-MAX_SAMPLES]
+            if peak_memory:
+                samples["memory"].append((largest, peak_memory))
+                del samples["memory"][:-MAX_SAMPLES]
+            self._refit(mode)
+
+    def load_log(self, path):
+        """Calibra con las trazas de un metrics.jsonl; devuelve cuántas se usaron."""
+        if not path or not os.path.exists(path):
+            return 0
+        used = 0
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                mode = record.get("kind")
+                # Aciertos de caché y peticiones fallidas no dicen nada del coste del motor
+                if mode not in PRIORS or record.get("status") != "ok" or record.get("cache") == "hit":
+                    continue
+                total = record.get("total_s")
+                if total is None:
+                    continue
+                # Espera en cola, traducción y cargas puntuales del modelo no son coste del trabajo
+                overhead = sum(span.get("seconds", 0) for span in record.get("spans", [])
+                               if span.get("stage") in OVERHEAD_STAGES)
+                try:
+                    self.observe(mode, record.get("resolution", "1024x1024"), int(record.get("steps", 4)),
+                                 float(record.get("strength", 0.8)), seconds=total - overhead,
+                                 peak_memory=record.get("peak_memory_bytes"))
+                except Exception:
+                    continue
+                used += 1
+        return used
+
+    def stats(self):
+        with self._lock:
+            return {
+                mode: {
+                    "samples": len(self._samples[mode]["seconds"]),
+                    "seconds": self._coefficients[mode]["seconds"],
+                    "memory": self._coefficients[mode]["memory"],
+                }
+                for mode in PRIORS
+            }
+
+    def _refit(self, mode):
+        samples = self._samples[mode]
+        for kind in ("seconds", "memory"):
+            points = samples[kind]
+            if len(points) < MIN_SAMPLES:
+                continue
+            prior_base, prior_slope = PRIORS[mode][kind]
+            fit = _fit_line([x for x, _ in points], [y for _, y in points])
+            if fit is None:
+                # Todas las muestras con el mismo tamaño: se escala el prior para que pase por su media
+                mean_x = sum(x for x, _ in points) / len(points)
+                mean_y = sum(y for _, y in points) / len(points)
+                scale = mean_y / max(prior_base + prior_slope * mean_x, 1e-9)
+                fit = (prior_base * scale, prior_slope * scale)
+            self._coefficients[mode][kind] = (max(0, fit[0]), fit[1])
+
+
+Decision = namedtuple("Decision", ["action", "reason", "resolution", "steps", "cost", "wait"])
+
+
+class AdmissionController:
+    """
+    Decide antes de encolar si un trabajo se admite, espera en cola, se rebaja (menos pasos
+    o menos resolución) o se rechaza, con un motivo legible para el usuario:
+    - memoria: el pico estimado, sumado a lo que reservan los trabajos en curso en otros
+      carriles (motores que corren a la vez), no puede superar el presupuesto de memoria,
+    - latencia: espera estimada + duración no puede superar max_latency segundos.
+    Rechazar pronto lo que no cabe mantiene acotada la cola (y la latencia de cola) en ráfagas.
+    """
+
+    def __init__(self, cost_model, memory_budget, max_latency=180.0, allow_downgrade=True,
+                 min_steps=1, min_side=MIN_SIDE):
+        self.cost_model = cost_model
+        self.memory_budget = memory_budget
+        self.max_latency = max_latency
+        self.allow_downgrade = allow_downgrade
+        self.min_steps = min_steps
+        self.min_side = min_side
+
+    def estimate(self, job):
+        return self.cost_model.predict(job.mode, job.resolution, job.steps, job.strength)
+
+    def decide(self, job, backlog_seconds=0.0, reserved_memory=0):
+        """
+        Decision para job dado el trabajo ya comprometido por delante (segundos estimados)
+        y la memoria estimada de lo que se ejecuta a la vez en otros carriles.
+        """
+        cost = self.estimate(job)
+        if self._fits(cost, backlog_seconds, reserved_memory):
+            if backlog_seconds > 0:
+                return Decision("queue", f"En cola: espera estimada {backlog_seconds:.0f} s.",
+                                job.resolution, job.steps, cost, backlog_seconds)
+            return Decision("admit", "", job.resolution, job.steps, cost, 0.0)
+
+        if self.allow_downgrade and job.mode != "analyze":
+            for resolution, steps in self._downgrades(job):
+                smaller = self.cost_model.predict(job.mode, resolution, steps, job.strength)
+                if self._fits(smaller, backlog_seconds, reserved_memory):
+                    changes = []
+                    if resolution != job.resolution:
+                        changes.append(f"resolución {job.resolution} → {resolution}")
+                    if steps != job.steps:
+                        changes.append(f"steps {job.steps} → {steps}")
+                    reason = self._problem(cost, backlog_seconds, reserved_memory) + " Se ajusta la petición: " + ", ".join(changes) + "."
+                    return Decision("downgrade", reason, resolution, steps, smaller, backlog_seconds)
+
+        return Decision("reject", self._problem(cost, backlog_seconds, reserved_memory) + " Petición rechazada.",
+                        job.resolution, job.steps, cost, backlog_seconds)
+
+    def _fits(self, cost, backlog_seconds, reserved_memory=0):
+        if self.memory_budget and cost.memory_bytes + reserved_memory > self.memory_budget:
+            return False
+        if self.max_latency and backlog_seconds + cost.seconds > self.max_latency:
+            return False
+        return True
+
+    def _problem(self, cost, backlog_seconds, reserved_memory=0):
+        if self.memory_budget and cost.memory_bytes + reserved_memory > self.memory_budget:
+            if reserved_memory:
+                return (f"Memoria insuficiente: se estiman {cost.memory_bytes / GB:.1f} GB y otros motores en curso "
+                        f"ocupan {reserved_memory / GB:.1f} GB de un presupuesto de {self.memory_budget / GB:.1f} GB.")
+            return (f"Memoria insuficiente: se estiman {cost.memory_bytes / GB:.1f} GB y el presupuesto "
+                    f"es de {self.memory_budget / GB:.1f} GB.")
+        return (f"Servidor ocupado: espera estimada {backlog_seconds:.0f} s + {cost.seconds:.0f} s de cómputo "
+                f"(límite {self.max_latency:.0f} s).")
+
+    def _downgrades(self, job):
+        """Alternativas de menor a mayor pérdida: menos pasos y, después, lados reducidos al 75 %."""
+        width, height = parse_resolution(job.resolution)
+        scale = 1.0
+        while True:
+            w, h = round(width * scale), round(height * scale)
+            if scale < 1.0 and min(w, h) < self.min_side:
+                return
+            resolution = format_resolution((w, h))
+            for steps in range(job.steps, self.min_steps - 1, -1):
+                if (resolution, steps) != (job.resolution, job.steps):
+                    yield resolution, steps
+            scale *= 0.75
@@ -1,62 +1,307 @@
 import gradio as gr
 import os
+import threading
 from PIL import Image
 from model_manager import QwenImageGenerator
+from scheduler import RequestScheduler, GeneratorBackend, ENGINE_LANES
+from admission import CostModel, AdmissionController
+from result_cache import ResultCache
+from tiling import format_resolution
+from image_writer import ImageWriter
+from history_index import HistoryIndex
+from metrics import REGISTRY, start_metrics_server
+from progress import ProgressStream
 from datetime import datetime
 
 # Inicializar generador
 generator = QwenImageGenerator()
 
+# Control de admisión: coste estimado (memoria y tiempo) de cada petición, calibrado
+# con las ejecuciones registradas en el log de métricas
+cost_model = CostModel(tile_mode=generator.tile_mode, tile_size=generator.tile_size,
+                       tile_overlap=generator.tile_overlap,
+                       tile_refine_strength=generator.tile_refine_strength)
+calibrated = cost_model.load_log(REGISTRY.log_path)
+if calibrated:
+    print(f"Modelo de costes calibrado con {calibrated} ejecuciones registradas.")
+admission = None
+if os.getenv("QWEN_ADMISSION", "on") != "off":
+    admission = AdmissionController(
+        cost_model,
+        memory_budget=generator.residency.memory_budget,
+        max_latency=float(os.getenv("QWEN_ADMISSION_MAX_LATENCY", "180")),
+        allow_downgrade=os.getenv("QWEN_ADMISSION_DOWNGRADE", "on") != "off",
+    )
+
+# Todas las peticiones pasan por el planificador: un único hilo usa el motor
+# y agrupa los trabajos compatibles en lotes.
+# Con QWEN_ENGINE_WORKERS=1 cada motor corre en su propio proceso supervisado y tiene su
+# propio carril: el análisis no espera a las generaciones y un fallo del motor no tumba la app.
+engine_workers = None
+if os.getenv("QWEN_ENGINE_WORKERS", "0").lower() in ("1", "true", "yes", "on"):
+    from engine_workers import WorkerBackend, split_memory_budget
+    job_timeout = float(os.getenv("QWEN_WORKER_JOB_TIMEOUT", "0")) or None
+    # Los dos procesos corren a la vez: cada uno recibe su parte del presupuesto, y la
+    # admisión suma la memoria de lo que está en curso en el otro carril
+    footprints = {name: slot.footprint for name, slot in generator.residency.slots.items()}
+    engine_workers = WorkerBackend(
+        memory_budgets=split_memory_budget(generator.residency.memory_budget, footprints),
+        health_interval=float(os.getenv("QWEN_WORKER_HEALTH_INTERVAL", "5")),
+        health_timeout=float(os.getenv("QWEN_WORKER_HEALTH_TIMEOUT", "30")),
+        job_timeout=job_timeout,
+    )
+    scheduler = RequestScheduler(engine_workers, admission=admission, lanes=ENGINE_LANES)
+else:
+    scheduler = RequestScheduler(GeneratorBackend(generator), admission=admission)
+
 # Directorio de salida
 OUTPUT_DIR = "outputs"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# Estado global para la galería
-session_history = []
+# Caché de resultados: reenvíos idénticos (misma semilla fija) se sirven desde disco
+result_cache = ResultCache(
+    os.path.join(OUTPUT_DIR, "cache"),
+    max_bytes=int(os.getenv("QWEN_CACHE_MAX_MB", "2048")) * 1024 * 1024
+)
+
+# Las imágenes se guardan en segundo plano; la galería muestra miniaturas
+image_writer = ImageWriter(
+    OUTPUT_DIR,
+    workers=int(os.getenv("QWEN_WRITER_THREADS", "2")),
+    fmt=os.getenv("QWEN_OUTPUT_FORMAT", "png"),
+    png_level=int(os.getenv("QWEN_PNG_LEVEL", "6")),
+    quality=int(os.getenv("QWEN_OUTPUT_QUALITY", "90")),
+    thumb_size=int(os.getenv("QWEN_THUMB_SIZE", "256")),
+)
+
+# Cada cuántos pasos se envía una preview de baja resolución (0 = solo progreso)
+PREVIEW_EVERY = int(os.getenv("QWEN_PREVIEW_EVERY", "1"))
+
+# Historial persistente e indexado; la galería lo recorre por páginas de tamaño fijo
+history = HistoryIndex(
+    os.path.join(OUTPUT_DIR, "history.sqlite3"),
+    page_size=int(os.getenv("QWEN_GALLERY_PAGE_SIZE", "12"))
+)
+
+def session_id(request):
+    return getattr(request, "session_hash", None) or "local"
+
+def persist_image(image, prefix, cache_key, request, trace, prompt, seed, **params):
+    """
+    Encola el guardado de la imagen y la registra en el historial.
+    La entrada del caché se registra cuando el archivo completo ya está en disco.
+    """
+    name = f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+    # Sin clave (p. ej. petición rebajada por admisión) el resultado no se cachea
+    on_done = (lambda path: result_cache.put(cache_key, path)) if cache_key else None
+    path, thumb_path, _ = image_writer.submit(image, name, on_done=on_done)
+    timings = {stage: round(seconds, 4) for stage, seconds in trace.spans}
+    timings["denoise_steps"] = len(trace.steps)
+    # Semilla real usada por el motor (también cuando se pidió aleatoria)
+    seed = image.info.get("seed", seed)
+    history.add(session_id(request), prefix, path, thumb_path, prompt=prompt, seed=seed,
+                params=params, timings=timings)
+
+def gallery_page(scope, search, cursor, request):
+    """Una página de miniaturas: (items, cursor siguiente)."""
+    session = session_id(request) if scope == "Esta sesión" else None
+    if search and search.strip():
+        entries, next_cursor = history.search(search.strip(), session=session, cursor=cursor)
+    else:
+        entries, next_cursor = history.page(session, cursor)
+    items = [(entry["thumb_path"] or entry["path"], entry["prompt"]) for entry in entries]
+    return items, next_cursor
+
+def render_gallery(scope, search, cursors, request):
+    """cursors: pila de cursores de las páginas visitadas (None = página más reciente)."""
+    items, next_cursor = gallery_page(scope, search, cursors[-1], request)
+    state = {"cursors": cursors, "next": next_cursor}
+    label = f"Página {len(cursors)}"
+    return (items, state, label, gr.update(interactive=len(cursors) > 1),
+            gr.update(interactive=next_cursor is not None))
+
+def refresh_gallery(scope, search, request: gr.Request):
+    return render_gallery(scope, search, [None], request)
+
+def older_page(scope, search, state, request: gr.Request):
+    if not state or state.get("next") is None:
+        return render_gallery(scope, search, (state or {}).get("cursors", [None]), request)
+    return render_gallery(scope, search, state["cursors"] + [state["next"]], request)
 
-def process_generation(prompt, steps, guidance, seed, resolution, use_translation):
+def newer_page(scope, search, state, request: gr.Request):
+    cursors = (state or {}).get("cursors", [None])
+    return render_gallery(scope, search, cursors[:-1] or [None], request)
+
+def load_cached_image(path):
+    """Carga completamente una imagen del caché para no retener el archivo abierto."""
+    with Image.open(path) as img:
+        img.load()
+        return img.copy()
+
+def release_job(job, trace):
+    """
+    Se llama al salir de un manejador. Si el trabajo sigue vivo es que el cliente
+    se desconectó o pulsó Cancelar: se cancela para no gastar GPU en él.
+    """
+    if job is not None and not job.future.done():
+        scheduler.cancel(job.job_id, "Cancelado por el cliente.")
+        trace.status = "cancelled"
+
+def admission_note(job):
+    """Aviso para el usuario si el control de admisión rebajó la petición, o None."""
+    if job.admission is not None and job.admission.action == "downgrade":
+        return job.admission.reason
+    return None
+
+def stream_job(job, stream):
+    """Emite (preview, estado) mientras el trabajo avanza en el planificador."""
+    for event in stream.iterate(job.future):
+        if event.done:
+            continue
+        preview = event.preview if event.preview is not None else gr.update()
+        yield preview, event.describe()
+
+def process_generation(prompt, steps, guidance, seed, resolution, use_translation, request: gr.Request):
+    # Función generadora: Gradio puede reanudarla en hilos distintos, así que la
+    # traza de métricas se activa solo por tramos que no cruzan un yield.
+    trace = REGISTRY.begin("generate", resolution=resolution, steps=steps)
+    job = None
     try:
-        final_prompt = generator.translate_prompt(prompt) if use_translation else prompt
-        image = generator.generate_image(final_prompt, steps, guidance, seed, resolution)
-        filename = f"gen_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-        filepath = os.path.join(OUTPUT_DIR, filename)
-        generator.save_image(image, filepath)
-        
-        session_history.insert(0, filepath) # Añadir al inicio
-        return image, None, session_history
+        with REGISTRY.use_trace(trace):
+            final_prompt = generator.translate_prompt(prompt) if use_translation else prompt
+            # "2048x2048 (2K)", "2K" y "2048x2048" son la misma petición
+            cache_key = ResultCache.make_key("generate", model=generator.flux_model_path, prompt=final_prompt,
+                                             steps=steps, guidance=guidance, seed=seed,
+                                             resolution=format_resolution(resolution))
+            cached = result_cache.get(cache_key)
+        if cached:
+            trace.attrs["cache"] = "hit"
+            yield load_cached_image(cached), None
+            return
+
+        stream = ProgressStream()
+        with REGISTRY.use_trace(trace):
+            job = scheduler.submit("generate", final_prompt, steps=steps, guidance_scale=guidance, seed=seed,
+                                   resolution=resolution, progress_callback=stream, preview_every=PREVIEW_EVERY)
+        for preview, status in stream_job(job, stream):
+            yield preview, status
+        image = job.future.result()
+
+        # Se registran los parámetros realmente usados (la admisión puede haberlos rebajado)
+        note = admission_note(job)
+        with REGISTRY.use_trace(trace):
+            persist_image(image, "gen", None if note else cache_key, request, trace, final_prompt, seed,
+                          steps=job.steps, guidance=guidance, resolution=job.resolution)
+        yield image, note
     except Exception as e:
-        return None, f"Error: {str(e)}", session_history
+        trace.status = "error"
+        yield None, f"Error: {str(e)}"
+    finally:
+        release_job(job, trace)
+        REGISTRY.end(trace)
 
-def process_editing(input_image, prompt, strength, steps, guidance, seed, resolution, use_translation):
+def process_editing(input_image, prompt, strength, steps, guidance, seed, resolution, use_translation, request: gr.Request):
     if input_image is None:
-        return None, "Error: Por favor, carga una imagen original para editar.", session_history
+        yield None, "Error: Por favor, carga una imagen original para editar."
+        return
+    trace = REGISTRY.begin("edit", resolution=resolution, steps=steps, strength=strength)
+    job = None
     try:
-        final_prompt = generator.translate_prompt(prompt) if use_translation else prompt
-        # Guardar imagen temporal para el motor
-        temp_input = os.path.join(OUTPUT_DIR, "temp_input.png")
-        input_image.save(temp_input)
-        
-        image = generator.generate_image(final_prompt, steps, guidance, seed, resolution, image_path=temp_input, strength=strength)
-        
-        filename = f"edit_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-        filepath = os.path.join(OUTPUT_DIR, filename)
-        generator.save_image(image, filepath)
-        
-        session_history.insert(0, filepath)
-        return image, None, session_history
+        with REGISTRY.use_trace(trace):
+            final_prompt = generator.translate_prompt(prompt) if use_translation else prompt
+            cache_key = ResultCache.make_key("edit", input_image=input_image, model=generator.flux_model_path,
+                                             prompt=final_prompt, strength=strength, steps=steps, guidance=guidance,
+                                             seed=seed, resolution=format_resolution(resolution))
+            cached = result_cache.get(cache_key)
+        if cached:
+            trace.attrs["cache"] = "hit"
+            yield load_cached_image(cached), None
+            return
+
+        stream = ProgressStream()
+        with REGISTRY.use_trace(trace):
+            # La imagen viaja en memoria hasta el motor, sin PNG intermedio
+            job = scheduler.submit("edit", final_prompt, steps=steps, guidance_scale=guidance, seed=seed,
+                                   resolution=resolution, image_path=input_image, strength=strength,
+                                   progress_callback=stream, preview_every=PREVIEW_EVERY)
+        for preview, status in stream_job(job, stream):
+            yield preview, status
+        image = job.future.result()
+
+        note = admission_note(job)
+        with REGISTRY.use_trace(trace):
+            persist_image(image, "edit", None if note else cache_key, request, trace, final_prompt, seed,
+                          steps=job.steps, guidance=guidance, resolution=job.resolution, strength=strength)
+        yield image, note
     except Exception as e:
-        return None, f"Error: {str(e)}", session_history
+        trace.status = "error"
+        yield None, f"Error: {str(e)}"
+    finally:
+        release_job(job, trace)
+        REGISTRY.end(trace)
 
 def process_analysis(input_image, query):
     if input_image is None:
-        return "Error: Cargue una imagen para analizar."
+        yield "Error: Cargue una imagen para analizar."
+        return
+    trace = REGISTRY.begin("analyze")
+    job = None
     try:
-        temp_input = os.path.join(OUTPUT_DIR, "temp_analyze.png")
-        input_image.save(temp_input)
-        response = generator.interrogate_image(temp_input, query)
-        return response
+        stream = ProgressStream()
+        with REGISTRY.use_trace(trace):
+            job = scheduler.submit("analyze", image_path=input_image, query=query, progress_callback=stream)
+        yield "Analizando..."
+        # Los tokens se muestran según llegan; sin tokens se emite un latido periódico:
+        # si el cliente se desconecta, Gradio cierra el generador y el finally cancela
+        text = ""
+        for piece in stream.iterate(job.future, poll=0.5, heartbeat=True):
+            if piece is None:
+                yield gr.update()
+                continue
+            text += piece
+            yield text
+        yield job.future.result()
     except Exception as e:
-        return f"Error: {str(e)}"
+        trace.status = "error"
+        yield f"Error: {str(e)}"
+    finally:
+        release_job(job, trace)
+        REGISTRY.end(trace)
+
+def collect_app_metrics():
+    """Gauges del estado de la app para el endpoint /metrics."""
+    cache = result_cache.stats()
+    translations = generator.translator.stats()
+    samples = [
+        ("qwen_scheduler_pending_jobs", {}, scheduler.pending_count()),
+        ("qwen_admission_rejected_total", {}, scheduler.stats["rejected"]),
+        ("qwen_admission_downgraded_total", {}, scheduler.stats["downgraded"]),
+        ("qwen_result_cache_hits_total", {}, cache["hits"]),
+        ("qwen_result_cache_misses_total", {}, cache["misses"]),
+        ("qwen_result_cache_bytes", {}, cache["bytes"]),
+        ("qwen_translation_memo_hits_total", {}, translations["hits"]),
+        ("qwen_translation_memo_misses_total", {}, translations["misses"]),
+        ("qwen_image_writer_pending", {}, image_writer.pending()),
+        ("qwen_image_writer_failed_total", {}, image_writer.stats["failed"]),
+    ]
+    # Con procesos trabajadores los motores (y sus cachés) viven en ellos, no en este generador
+    if engine_workers is not None:
+        caches, loaded = engine_workers.engine_stats()
+    else:
+        caches = generator.cache_stats()
+        loaded = {name: slot["loaded"] for name, slot in generator.residency.stats().items()}
+    for name, value in caches.items():
+        samples.append((f"qwen_{name}" if name.endswith("_bytes") else f"qwen_{name}_total", {}, value))
+    for name, is_loaded in loaded.items():
+        samples.append(("qwen_engine_loaded", {"engine": name}, int(is_loaded)))
+    if engine_workers is not None:
+        for name, worker in engine_workers.health().items():
+            samples.append(("qwen_engine_worker_up", {"engine": name}, int(worker["status"] == "up")))
+            samples.append(("qwen_engine_worker_restarts_total", {"engine": name}, worker["restarts"]))
+            samples.append(("qwen_engine_worker_queued", {"engine": name}, worker["queued"]))
+    return samples
+
+REGISTRY.register_collector(collect_app_metrics)
 
 # Construir la interfaz Gradio
 with gr.Blocks(title="Qwen Studio Editor", theme=gr.themes.Soft()) as demo:
@@ -74,8 +319,10 @@ with gr.Blocks(title="Qwen Studio Editor", theme=gr.themes.Soft()) as demo:
                         gen_steps = gr.Slider(1, 4, 4, step=1, label="Steps")
                         gen_guidance = gr.Slider(0.0, 10.0, 0.0, step=0.1, label="Guidance")
                         gen_seed = gr.Number(-1, label="Seed")
-                        gen_res = gr.Dropdown(["512x512", "768x768", "1024x1024"], value="1024x1024", label="Resolución")
-                    gen_btn = gr.Button("Generar Arte", variant="primary")
+                        gen_res = gr.Dropdown(["512x512", "768x768", "1024x1024", "2048x2048 (2K)"], value="1024x1024", label="Resolución")
+                    with gr.Row():
+                        gen_btn = gr.Button("Generar Arte", variant="primary")
+                        gen_cancel = gr.Button("Cancelar", variant="stop")
                 with gr.Column(scale=1):
                     gen_output = gr.Image(label="Resultado")
                     gen_error = gr.Markdown()
@@ -91,8 +338,10 @@ with gr.Blocks(title="Qwen Studio Editor", theme=gr.themes.Soft()) as demo:
                     edit_strength = gr.Slider(0.0, 1.0, 0.8, step=0.05, label="Fuerza de Cambio (Denoising)")
                     with gr.Accordion("Avanzado", open=False):
                         edit_steps = gr.Slider(1, 4, 4, step=1, label="Steps")
-                        edit_res = gr.Dropdown(["512x512", "768x768", "1024x1024"], value="1024x1024", label="Resolución")
-                    edit_btn = gr.Button("Aplicar Cambios", variant="primary")
+                        edit_res = gr.Dropdown(["512x512", "768x768", "1024x1024", "2048x2048 (2K)"], value="1024x1024", label="Resolución")
+                    with gr.Row():
+                        edit_btn = gr.Button("Aplicar Cambios", variant="primary")
+                        edit_cancel = gr.Button("Cancelar", variant="stop")
                 with gr.Column(scale=1):
                     edit_output = gr.Image(label="Imagen Editada")
                     edit_error = gr.Markdown()
@@ -103,32 +352,66 @@ with gr.Blocks(title="Qwen Studio Editor", theme=gr.themes.Soft()) as demo:
                 with gr.Column(scale=1):
                     vlm_input = gr.Image(label="Imagen para Analizar", type="pil")
                     vlm_query = gr.Textbox(label="¿Qué quieres saber?", value="Describe esta imagen en detalle.")
-                    vlm_btn = gr.Button("Analizar", variant="primary")
+                    with gr.Row():
+                        vlm_btn = gr.Button("Analizar", variant="primary")
+                        vlm_cancel = gr.Button("Cancelar", variant="stop")
                 with gr.Column(scale=1):
                     vlm_output = gr.Textbox(label="Respuesta de Qwen AI", lines=10)
 
-    # Galería de Sesión
-    gr.Markdown("### 🕒 Historial de la Sesión")
+    # Galería del historial (paginada)
+    gr.Markdown("### 🕒 Historial")
+    with gr.Row():
+        history_scope = gr.Radio(["Esta sesión", "Todo"], value="Esta sesión", label="Mostrar")
+        history_search = gr.Textbox(label="Buscar por prompt", placeholder="astronauta, atardecer...")
     gallery = gr.Gallery(label="Mis Creaciones", columns=4, height="auto")
+    with gr.Row():
+        newer_btn = gr.Button("◀ Más recientes", interactive=False)
+        page_label = gr.Markdown("Página 1")
+        older_btn = gr.Button("Anteriores ▶", interactive=False)
+    gallery_state = gr.State({"cursors": [None], "next": None})
+    gallery_outputs = [gallery, gallery_state, page_label, newer_btn, older_btn]
 
     # Lógica de los botones
-    gen_btn.click(
+    gen_event = gen_btn.click(
         process_generation, 
         inputs=[gen_prompt, gen_steps, gen_guidance, gen_seed, gen_res, use_translation], 
-        outputs=[gen_output, gen_error, gallery]
+        outputs=[gen_output, gen_error]
     )
+    gen_event.then(refresh_gallery, inputs=[history_scope, history_search], outputs=gallery_outputs)
     
-    edit_btn.click(
+    edit_event = edit_btn.click(
         process_editing,
         inputs=[edit_input, edit_prompt, edit_strength, edit_steps, gen_guidance, gen_seed, edit_res, edit_use_translation],
-        outputs=[edit_output, edit_error, gallery]
+        outputs=[edit_output, edit_error]
     )
+    edit_event.then(refresh_gallery, inputs=[history_scope, history_search], outputs=gallery_outputs)
     
-    vlm_btn.click(
+    vlm_event = vlm_btn.click(
         process_analysis,
         inputs=[vlm_input, vlm_query],
         outputs=[vlm_output]
     )
 
+    # Navegación del historial: cada página es una consulta indexada de tamaño fijo
+    history_scope.change(refresh_gallery, inputs=[history_scope, history_search], outputs=gallery_outputs)
+    history_search.submit(refresh_gallery, inputs=[history_scope, history_search], outputs=gallery_outputs)
+    older_btn.click(older_page, inputs=[history_scope, history_search, gallery_state], outputs=gallery_outputs)
+    newer_btn.click(newer_page, inputs=[history_scope, history_search, gallery_state], outputs=gallery_outputs)
+    demo.load(refresh_gallery, inputs=[history_scope, history_search], outputs=gallery_outputs)
+
+    # Cancelar cierra el manejador en curso; su finally cancela el trabajo en el motor
+    gen_cancel.click(None, cancels=[gen_event])
+    edit_cancel.click(None, cancels=[edit_event])
+    vlm_cancel.click(None, cancels=[vlm_event])
+
 if __name__ == "__main__":
+    # Permitir varias peticiones simultáneas para que el planificador pueda agruparlas
+    demo.queue(default_concurrency_limit=scheduler.max_queue)
+    start_metrics_server(int(os.getenv("QWEN_METRICS_PORT", "9464")))
+    # Precargar FLUX en segundo plano mientras arranca la interfaz
+    if engine_workers is not None:
+        # Cada proceso trabajador precarga su motor al arrancar
+        threading.Thread(target=engine_workers.start, name="qwen-workers-start", daemon=True).start()
+    else:
+        generator.prewarm([e for e in os.getenv("QWEN_PREWARM", "flux").split(",") if e])
     demo.launch(server_name="127.0.0.1", inbrowser=True)
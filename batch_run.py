@@ -0,0 +1,421 @@
+"""
+Generación por lotes sin interfaz sobre QwenImageGenerator.
+
+Lee peticiones de un JSONL o CSV (una por línea / fila) y escribe las imágenes y un
+manifest.jsonl de forma incremental. El manifest es también el checkpoint: al relanzar
+con el mismo --out se saltan las peticiones ya completadas.
+
+Campos por petición (todos opcionales salvo prompt/query según el modo):
+    id, mode (generate|edit|analyze), prompt, image, query, seed, steps, guidance,
+    resolution, strength
+
+Uso:
+    python batch_run.py prompts.jsonl --out outputs/batch
+    python batch_run.py fotos/ --out outputs/captions   # describe un directorio -> captions.jsonl
+    python batch_run.py prompts.csv --out outputs/batch --stub   # sin GPU, para pruebas
+"""
+import os
+import re
+import sys
+import csv
+import json
+import time
+import queue
+import hashlib
+import argparse
+import threading
+from image_writer import ImageWriter
+from translation_cache import TranslationMemo, DictTranslatorBackend
+from tiling import parse_resolution
+
+MODES = ("generate", "edit", "analyze")
+DEFAULTS = {
+    "mode": "generate",
+    "seed": -1,
+    "steps": 4,
+    "guidance": 0.0,
+    "resolution": "1024x1024",
+    "strength": 0.8,
+    "query": "Describe esta imagen en detalle.",
+}
+SAFE_ID_RE = re.compile(r"[^\w.-]+")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+
+_END = object()
+
+
+def read_records(path, fmt=None):
+    """Itera las peticiones del archivo sin cargarlo entero en memoria."""
+    fmt = fmt or ("csv" if path.lower().endswith(".csv") else "jsonl")
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            for index, row in enumerate(csv.DictReader(f), start=1):
+                # Las celdas vacías cuentan como ausentes
+                yield index, {k: v for k, v in row.items() if k and v not in (None, "")}
+        else:
+            for index, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    yield index, json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield index, {"_error": f"JSON inválido en la línea {index}: {e}"}
+
+
+def normalize_record(index, raw, defaults):
+    """Completa una petición con los valores por defecto y tipa sus campos."""
+    record = {**defaults, **raw}
+    record["id"] = SAFE_ID_RE.sub("_", str(raw.get("id", index)))
+    if "_error" in record:
+        return record
+    try:
+        record["seed"] = int(record["seed"])
+        record["steps"] = int(record["steps"])
+        record["guidance"] = float(record["guidance"])
+        record["strength"] = float(record["strength"])
+    except (TypeError, ValueError) as e:
+        record["_error"] = f"Parámetro numérico inválido: {e}"
+        return record
+    if record["mode"] not in MODES:
+        record["_error"] = f"Modo desconocido: {record['mode']}"
+    elif record["mode"] in ("edit", "analyze") and not record.get("image"):
+        record["_error"] = f"El modo {record['mode']} necesita el campo 'image'."
+    elif record["mode"] != "analyze" and not record.get("prompt"):
+        record["_error"] = "Falta el campo 'prompt'."
+    return record
+
+
+class Manifest:
+    """
+    Registro append-only de resultados (una línea JSON por petición terminada).
+    Cada línea se sincroniza con disco: tras un corte, lo escrito es exactamente lo completado.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Última línea truncada por el fallo: se rehace esa petición
+                        continue
+                    self.completed[entry["id"]] = entry["status"]
+        self._file = open(path, "a", encoding="utf-8")
+
+    def should_skip(self, record_id, retry_failed=False):
+        status = self.completed.get(record_id)
+        return status == "ok" or (status is not None and not retry_failed)
+
+    def append(self, entry):
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.completed[entry["id"]] = entry["status"]
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class StubGenerator:
+    """
+    Motor falso con la interfaz de QwenImageGenerator que usa este módulo.
+    Imágenes de color plano deterministas y traducción por diccionario: sin mflux ni red.
+    """
+
+    def __init__(self, step_time=0.0, table=None):
+        self.step_time = step_time
+        self.translator = TranslationMemo(":memory:", DictTranslatorBackend(table))
+        self.calls = []
+
+    def translate_prompts(self, texts):
+        return self.translator.translate_batch(list(texts))
+
+    def generate_image(self, prompt, steps=4, guidance_scale=0.0, seed=-1, resolution="1024x1024",
+                       image_path=None, strength=0.8, **kwargs):
+        from PIL import Image
+        import random
+
+        self.calls.append(("edit" if image_path is not None else "generate", prompt))
+        time.sleep(self.step_time * steps)
+        final_seed = seed if seed != -1 else random.randint(0, 1000000)
+        width, height = parse_resolution(resolution)
+        digest = hashlib.sha256(f"{prompt}|{final_seed}".encode("utf-8")).digest()
+        image = Image.new("RGB", (width, height), tuple(digest[:3]))
+        image.info["seed"] = final_seed
+        return image
+
+    def interrogate_image(self, image_path, query="Describe esta imagen en detalle.", cancel_token=None):
+        self.calls.append(("analyze", query))
+        time.sleep(self.step_time)
+        return f"Descripción simulada: {query}"
+
+    def caption_batch(self, images, query="Describe esta imagen en detalle.", max_tokens=500):
+        return [self.interrogate_image(image, query) for image in images]
+
+
+def list_images(directory, recursive=False):
+    """Imágenes del directorio en orden estable (rutas relativas al directorio)."""
+    if recursive:
+        found = [os.path.relpath(os.path.join(root, name), directory)
+                 for root, _, names in os.walk(directory) for name in names]
+    else:
+        found = [name for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name))]
+    return sorted(name for name in found if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def caption_directory(generator, directory, output_path, query=DEFAULTS["query"], batch_size=4,
+                      recursive=False, retry_failed=False):
+    """
+    Describe todas las imágenes de un directorio con el VLM cargado una sola vez,
+    en bloques de batch_size (prefill por lotes con generator.caption_batch).
+    Cada descripción se añade a output_path (JSONL) al terminar su bloque; al relanzar
+    se saltan las imágenes ya descritas.
+    """
+    manifest = Manifest(output_path)
+    stats = {"ok": 0, "error": 0, "skipped": 0}
+    start = time.perf_counter()
+    try:
+        names = []
+        for name in list_images(directory, recursive):
+            if manifest.should_skip(name, retry_failed):
+                stats["skipped"] += 1
+            else:
+                names.append(name)
+        for i in range(0, len(names), batch_size):
+            block = names[i:i + batch_size]
+            results = generator.caption_batch([os.path.join(directory, name) for name in block], query)
+            for name, result in zip(block, results):
+                entry = {"id": name, "path": os.path.join(directory, name), "query": query}
+                if isinstance(result, Exception):
+                    entry.update({"status": "error", "error": str(result)})
+                else:
+                    entry.update({"status": "ok", "text": result})
+                manifest.append(entry)
+                stats[entry["status"]] += 1
+                print(f"[{entry['status']}] {name}" + (f": {entry['error']}" if entry.get("error") else ""))
+    except KeyboardInterrupt:
+        print("\nInterrumpido: relanza el mismo comando para continuar.")
+    finally:
+        manifest.close()
+    return {**stats, "seconds": round(time.perf_counter() - start, 2)}
+
+
+class BatchRunner:
+    """
+    Ejecuta un lote en tres etapas solapadas:
+    un hilo lector traduce (en bloques) y carga imágenes de entrada por delante del motor,
+    el hilo principal solo alimenta al motor, y el ImageWriter guarda en segundo plano.
+    """
+
+    def __init__(self, generator, out_dir, translate=True, translate_batch=8, prefetch=16,
+                 retry_failed=False, fmt="png", png_level=6, quality=90, writers=2):
+        self.generator = generator
+        self.out_dir = out_dir
+        self.translate = translate
+        self.translate_batch = translate_batch
+        self.prefetch = prefetch
+        self.retry_failed = retry_failed
+        os.makedirs(out_dir, exist_ok=True)
+        self.manifest = Manifest(os.path.join(out_dir, "manifest.jsonl"))
+        self.writer = ImageWriter(os.path.join(out_dir, "images"), workers=writers, fmt=fmt,
+                                  png_level=png_level, quality=quality, thumb_size=0)
+        self.stats = {"ok": 0, "error": 0, "skipped": 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def run(self, records, defaults=None):
+        """records: iterable de (índice, dict). Devuelve el resumen de la ejecución."""
+        defaults = {**DEFAULTS, **(defaults or {})}
+        ready = queue.Queue(maxsize=self.prefetch)
+        reader = threading.Thread(target=self._prepare, args=(records, defaults, ready),
+                                  name="qwen-batch-reader", daemon=True)
+        start = time.perf_counter()
+        reader.start()
+        try:
+            while True:
+                record = ready.get()
+                if record is _END:
+                    break
+                self._execute(record)
+        except KeyboardInterrupt:
+            print("\nInterrumpido: se guarda lo pendiente; relanza el mismo comando para continuar.")
+        finally:
+            self._stop.set()
+            # Desbloquear al lector si estaba esperando hueco en la cola
+            while not ready.empty():
+                ready.get_nowait()
+            reader.join(timeout=5)
+            self.writer.close()
+            self.manifest.close()
+        return {**self.stats, "seconds": round(time.perf_counter() - start, 2)}
+
+    def _prepare(self, records, defaults, ready):
+        """Hilo lector: normaliza, salta lo completado, traduce en bloques y carga imágenes."""
+        block = []
+        try:
+            for index, raw in records:
+                if self._stop.is_set():
+                    return
+                record = normalize_record(index, raw, defaults)
+                if self.manifest.should_skip(record["id"], self.retry_failed):
+                    with self._lock:
+                        self.stats["skipped"] += 1
+                    continue
+                block.append(record)
+                if len(block) >= self.translate_batch:
+                    self._enqueue(self._prepare_block(block), ready)
+                    block = []
+            if block:
+                self._enqueue(self._prepare_block(block), ready)
+        except Exception as e:
+            print(f"Error al leer las peticiones: {e}")
+        finally:
+            if not self._stop.is_set():
+                ready.put(_END)
+
+    def _enqueue(self, block, ready):
+        for record in block:
+            while not self._stop.is_set():
+                try:
+                    ready.put(record, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+    def _prepare_block(self, block):
+        if self.translate:
+            indexes = [i for i, r in enumerate(block) if "_error" not in r and r["mode"] != "analyze"]
+            if indexes:
+                translated = self.generator.translate_prompts([block[i]["prompt"] for i in indexes])
+                for i, text in zip(indexes, translated):
+                    block[i]["final_prompt"] = text
+        for record in block:
+            record.setdefault("final_prompt", record.get("prompt"))
+            if "_error" in record or record["mode"] == "generate":
+                continue
+            try:
+                from PIL import Image
+                with Image.open(record["image"]) as img:
+                    record["input_image"] = img.convert("RGB")
+            except Exception as e:
+                record["_error"] = f"No se pudo abrir {record['image']}: {e}"
+        return block
+
+    def _execute(self, record):
+        entry = {"id": record["id"], "mode": record["mode"], "prompt": record.get("prompt")}
+        if "_error" in record:
+            self._finish({**entry, "status": "error", "error": record["_error"]})
+            return
+        start = time.perf_counter()
+        try:
+            if record["mode"] == "analyze":
+                text = self.generator.interrogate_image(record["input_image"], record["query"])
+                self._finish({**entry, "status": "ok", "image": record["image"], "query": record["query"],
+                              "text": text, "seconds": round(time.perf_counter() - start, 3)})
+                return
+            image = self.generator.generate_image(
+                record["final_prompt"],
+                steps=record["steps"],
+                guidance_scale=record["guidance"],
+                seed=record["seed"],
+                resolution=record["resolution"],
+                image_path=record.get("input_image"),
+                strength=record["strength"],
+            )
+        except Exception as e:
+            self._finish({**entry, "status": "error", "error": str(e)})
+            return
+
+        entry.update({
+            "status": "ok",
+            "final_prompt": record["final_prompt"],
+            "seed": image.info.get("seed", record["seed"]),
+            "steps": record["steps"],
+            "guidance": record["guidance"],
+            "resolution": record["resolution"],
+            "seconds": round(time.perf_counter() - start, 3),
+        })
+        if record["mode"] == "edit":
+            entry.update({"input": record["image"], "strength": record["strength"]})
+        # La línea del manifest se escribe cuando la imagen ya está en disco
+        written = []
+
+        def on_done(path):
+            written.append(path)
+            self._finish({**entry, "path": path})
+
+        try:
+            _, _, future = self.writer.submit(image, record["id"], on_done=on_done)
+        except Exception as e:
+            self._finish({**entry, "status": "error", "error": f"No se pudo guardar la imagen: {e}"})
+            return
+        # Si la escritura falla, on_done no llega a llamarse: la petición también debe quedar en el manifest
+        future.add_done_callback(lambda future: self._write_failed(entry, future, written))
+
+    def _write_failed(self, entry, future, written):
+        error = future.exception()
+        if error is not None and not written:
+            self._finish({**entry, "status": "error", "error": f"No se pudo guardar la imagen: {error}"})
+
+    def _finish(self, entry):
+        self.manifest.append(entry)
+        with self._lock:
+            self.stats[entry["status"]] += 1
+        print(f"[{entry['status']}] {entry['id']}" + (f": {entry['error']}" if entry.get("error") else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generación por lotes sin interfaz (JSONL o CSV)")
+    parser.add_argument("input", help="Archivo .jsonl o .csv con una petición por línea, "
+                                      "o un directorio de imágenes para describirlas con el VLM")
+    parser.add_argument("--out", default="outputs/batch", help="Directorio de salida (imágenes + manifest.jsonl)")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="Formato de entrada (por defecto, según la extensión)")
+    parser.add_argument("--mode", choices=MODES, default=DEFAULTS["mode"], help="Modo por defecto de las peticiones")
+    parser.add_argument("--steps", type=int, default=DEFAULTS["steps"])
+    parser.add_argument("--guidance", type=float, default=DEFAULTS["guidance"])
+    parser.add_argument("--resolution", default=DEFAULTS["resolution"])
+    parser.add_argument("--no-translate", action="store_true", help="No traducir los prompts al inglés")
+    parser.add_argument("--retry-failed", action="store_true", help="Reintentar las peticiones que fallaron")
+    parser.add_argument("--output-format", default="png", choices=["png", "webp", "jpeg"])
+    parser.add_argument("--quality", type=int, default=90, help="Calidad WebP/JPEG")
+    parser.add_argument("--png-level", type=int, default=6)
+    parser.add_argument("--query", default=DEFAULTS["query"], help="Pregunta al describir un directorio")
+    parser.add_argument("--caption-batch", type=int, default=4, help="Imágenes por lote al describir un directorio")
+    parser.add_argument("--recursive", action="store_true", help="Incluir subdirectorios al describir")
+    parser.add_argument("--stub", action="store_true", help="Usar el motor falso (sin GPU ni modelos)")
+    parser.add_argument("--stub-step-time", type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.stub:
+        generator = StubGenerator(step_time=args.stub_step_time)
+    else:
+        from model_manager import QwenImageGenerator
+        generator = QwenImageGenerator()
+
+    if os.path.isdir(args.input):
+        output_path = os.path.join(args.out, "captions.jsonl")
+        os.makedirs(args.out, exist_ok=True)
+        summary = caption_directory(generator, args.input, output_path, args.query, args.caption_batch,
+                                    args.recursive, args.retry_failed)
+        print(f"Descripciones terminadas: {summary['ok']} ok, {summary['error']} con error, "
+              f"{summary['skipped']} ya descritas ({summary['seconds']} s). Resultado: {output_path}")
+        return 0 if summary["error"] == 0 else 1
+
+    runner = BatchRunner(generator, args.out, translate=not args.no_translate, retry_failed=args.retry_failed,
+                         fmt=args.output_format, png_level=args.png_level, quality=args.quality)
+    defaults = {"mode": args.mode, "steps": args.steps, "guidance": args.guidance, "resolution": args.resolution}
+    summary = runner.run(read_records(args.input, args.format), defaults)
+    print(f"Lote terminado: {summary['ok']} ok, {summary['error']} con error, "
+          f"{summary['skipped']} ya completadas ({summary['seconds']} s). Manifest: {runner.manifest.path}")
+    return 0 if summary["error"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""
+Simulación de una ráfaga de peticiones mixtas contra el planificador, sin GPU.
+
+Usa StubBackend con costes sintéticos (los que predice el modelo de costes, escalados
+por --time-scale) y compara la latencia con y sin control de admisión: sin él la cola
+crece sin límite durante la ráfaga; con él los trabajos que no caben se rebajan o se
+rechazan al momento y la latencia de cola queda acotada por --max-latency.
+
+Uso:
+    python bench_admission.py
+    python bench_admission.py --requests 60 --burst 2.0 --max-latency 120 --memory-gb 24
+"""
+import time
+import random
+import argparse
+import threading
+from residency import GB
+from scheduler import RequestScheduler, StubBackend
+from admission import Cost, CostModel, AdmissionController
+
+# (modo, resolución, steps, peso en la mezcla)
+MIX = [
+    ("generate", "1024x1024", 4, 5),
+    ("generate", "768x768", 4, 2),
+    ("generate", "2048x2048", 4, 1),
+    ("edit", "1024x1024", 4, 2),
+    ("analyze", "1024x1024", 4, 2),
+]
+
+
+class ScaledCostModel(CostModel):
+    """Modelo de costes en tiempo real escalado: el stub duerme time_scale segundos por segundo simulado."""
+
+    def __init__(self, time_scale, **kwargs):
+        super().__init__(**kwargs)
+        self.time_scale = time_scale
+
+    def predict(self, *args, **kwargs):
+        cost = super().predict(*args, **kwargs)
+        return Cost(cost.memory_bytes, cost.seconds * self.time_scale)
+
+    def observe(self, mode, resolution, steps, strength=0.8, seconds=None, peak_memory=None):
+        if seconds is not None:
+            seconds /= self.time_scale
+        super().observe(mode, resolution, steps, strength, seconds, peak_memory)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(requests, burst, time_scale, admission, seed):
+    """Lanza la ráfaga y devuelve (latencias simuladas en s, contadores de decisiones)."""
+    rng = random.Random(seed)
+    backend = StubBackend(cost_model=CostModel(), time_scale=time_scale)
+    # max_queue amplio: con admisión el límite lo pone el coste estimado, no el número de trabajos.
+    # La ventana de agrupación también se escala (1 s simulado)
+    scheduler = RequestScheduler(backend, max_queue=requests, batch_window=time_scale, admission=admission)
+    latencies, counts, lock = [], {"ok": 0, "rejected": 0, "downgraded": 0}, threading.Lock()
+
+    def client(mode, resolution, steps):
+        start = time.perf_counter()
+        try:
+            job = scheduler.submit(mode, "prueba", steps=steps, resolution=resolution, query="¿Qué hay?",
+                                   image_path="stub.png" if mode != "generate" else None)
+            job.future.result()
+        except Exception:
+            with lock:
+                counts["rejected"] += 1
+            return
+        with lock:
+            latencies.append((time.perf_counter() - start) / time_scale)
+            counts["ok"] += 1
+            if job.admission is not None and job.admission.action == "downgrade":
+                counts["downgraded"] += 1
+
+    weighted = [entry[:3] for entry in MIX for _ in range(entry[3])]
+    threads = []
+    for _ in range(requests):
+        thread = threading.Thread(target=client, args=rng.choice(weighted))
+        thread.start()
+        threads.append(thread)
+        # Llegadas de Poisson concentradas en `burst` segundos simulados
+        time.sleep(rng.expovariate(requests / burst) * time_scale)
+    for thread in threads:
+        thread.join()
+    scheduler.shutdown()
+    return latencies, counts, backend.peak_memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latencia bajo ráfagas con y sin control de admisión")
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--burst", type=float, default=5.0, help="Duración de la ráfaga en segundos simulados")
+    parser.add_argument("--time-scale", type=float, default=0.01, help="Segundos reales por segundo simulado")
+    parser.add_argument("--max-latency", type=float, default=120.0)
+    parser.add_argument("--memory-gb", type=float, default=24.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for label, with_admission in (("sin admisión", False), ("con admisión", True)):
+        admission = None
+        if with_admission:
+            admission = AdmissionController(ScaledCostModel(args.time_scale), int(args.memory_gb * GB),
+                                            args.max_latency * args.time_scale)
+        latencies, counts, peak = run(args.requests, args.burst, args.time_scale, admission, args.seed)
+        print(f"{label}: {counts['ok']} servidas ({counts['downgraded']} rebajadas), {counts['rejected']} rechazadas, "
+              f"p50 {percentile(latencies, 0.5):.0f} s, p95 {percentile(latencies, 0.95):.0f} s, "
+              f"p99 {percentile(latencies, 0.99):.0f} s, pico {peak / GB:.1f} GB")
+
+
+if __name__ == "__main__":
+    main()
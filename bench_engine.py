@@ -0,0 +1,158 @@
+"""
+Prueba de las pasadas de FLUX de model_manager con un mflux falso, sin GPU ni modelos.
+
+1. Modo por teselas con un cargador de imágenes que solo admite rutas (versiones de mflux
+   anteriores a PIL en memoria): la pasada base y el refinado de cada tesela deben llegar
+   al cargador como archivos, nunca como PIL.Image.
+2. CostModel.passes de admission frente a las pasadas que hace de verdad _run_flux
+   (pasos recorridos y megapíxeles) en edición y en generación y edición por teselas.
+
+Uso:
+    python bench_engine.py
+"""
+import os
+import sys
+import tempfile
+
+# Módulos falsos: ruta relativa -> contenido. ImageUtil.load_image rechaza todo lo que no sea ruta
+STUB_MODULES = {
+    "mflux/__init__.py": "",
+    "mflux/utils/__init__.py": "",
+    "mflux/utils/image_util.py": (
+        "from pathlib import Path\n"
+        "LOADED = []\n"
+        "class ImageUtil:\n"
+        "    @staticmethod\n"
+        "    def load_image(image_path: 'str | Path'):\n"
+        "        from PIL import Image\n"
+        "        LOADED.append(type(image_path).__name__)\n"
+        "        if not isinstance(image_path, (str, Path)):\n"
+        "            raise TypeError(f'load_image espera una ruta, no {type(image_path).__name__}')\n"
+        "        with Image.open(image_path) as image:\n"
+        "            return image.convert('RGB')\n"
+    ),
+    "mflux/models/__init__.py": "",
+    "mflux/models/common/__init__.py": "",
+    "mflux/models/common/latent_creator/__init__.py": "",
+    "mflux/models/common/latent_creator/latent_creator.py": (
+        "from mflux.utils.image_util import ImageUtil\n"
+        "class LatentCreator:\n"
+        "    @staticmethod\n"
+        "    def encode_image(vae, image_path, height, width, tiling_config=None):\n"
+        "        return ImageUtil.load_image(image_path).resize((width, height))\n"
+    ),
+}
+
+
+class FakeFlux:
+    """
+    generate_image de mflux: codifica la imagen de entrada con LatentCreator, anota los pasos
+    que recorrería (en Image-to-Image desde init_time_step, como Config de mflux) y devuelve
+    una imagen lisa.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def generate_image(self, image_path=None, seed=0, prompt="", num_inference_steps=4, width=1024, height=1024,
+                       guidance=0.0, image_strength=None):
+        from PIL import Image
+        from mflux.models.common.latent_creator.latent_creator import LatentCreator
+
+        if image_path is not None:
+            LatentCreator.encode_image(vae=None, image_path=image_path, height=height, width=width)
+        steps = num_inference_steps
+        if image_path is not None and image_strength:
+            steps -= max(1, int(num_inference_steps * max(0.0, min(1.0, image_strength))))
+        self.calls.append({"steps": steps, "size": (width, height), "edit": image_path is not None})
+        return Image.new("RGB", (width, height), (seed * 37 % 256, 128, 64))
+
+
+def make_generator(root):
+    os.environ.setdefault("QWEN_WEIGHT_CACHE", "off")
+    os.environ.setdefault("QWEN_TRANSLATION_DB", os.path.join(root, "translations.sqlite3"))
+    os.environ["QWEN_TILE_MODE"] = "auto"
+    os.environ["QWEN_TILE_SIZE"] = "256"
+    os.environ["QWEN_TILE_OVERLAP"] = "32"
+    import model_manager
+
+    generator = model_manager.QwenImageGenerator()
+    # load_model real (caché de latentes, detección del cargador) con el modelo falso
+    generator._load_flux = lambda quantization: (FakeFlux(), None)
+    if not generator.load_model():
+        raise Exception(generator.error_message)
+    return generator
+
+
+def check_tiled_path_only(generator):
+    from mflux.utils.image_util import LOADED
+
+    try:
+        image = generator._run_flux("un faro al atardecer", 4, 0.0, 7, "512x384", None, 0.8)
+    except Exception as e:
+        return [f"modo por teselas: {type(e).__name__}: {e}"]
+    problems = []
+    refines = [call for call in generator.model.calls if call["edit"]]
+    print(f"  {len(generator.model.calls)} pasadas, {len(refines)} teselas refinadas, cargador: {sorted(set(LOADED))}")
+    if image.size != (512, 384):
+        problems.append(f"tamaño final {image.size}, se esperaba (512, 384)")
+    if not refines or len(LOADED) != len(refines):
+        problems.append(f"{len(refines)} teselas pero el cargador se llamó {len(LOADED)} veces")
+    if any(kind != "str" for kind in LOADED):
+        problems.append(f"el cargador recibió algo que no es una ruta: {LOADED}")
+    if generator.latent_cache.stats()["entries"]:
+        problems.append("las teselas de refinado entraron en el caché de latentes")
+    return problems
+
+
+def check_passes(generator, root):
+    from PIL import Image
+    from admission import CostModel
+
+    source = os.path.join(root, "entrada.png")
+    Image.new("RGB", (320, 320), (90, 120, 150)).save(source)
+    cost_model = CostModel(tile_mode=generator.tile_mode, tile_size=generator.tile_size,
+                           tile_overlap=generator.tile_overlap,
+                           tile_refine_strength=generator.tile_refine_strength)
+    cases = [
+        ("edit", "256x256", 4, 0.8, source),
+        ("edit", "256x256", 8, 0.3, source),
+        ("generate", "512x384", 4, 0.8, None),
+        ("edit", "512x512", 2, 0.6, source),
+    ]
+    problems = []
+    for mode, resolution, steps, strength, image in cases:
+        generator.model.calls.clear()
+        generator._run_flux("un faro al atardecer", steps, 0.0, 3, resolution, image, strength)
+        real = [(call["steps"], round(call["size"][0] * call["size"][1] / 1e6, 6)) for call in generator.model.calls]
+        predicted = [(pass_steps, round(mp, 6)) for pass_steps, mp in cost_model.passes(mode, resolution, steps, strength)]
+        label = f"{mode} {resolution} steps={steps} strength={strength}"
+        print(f"  {label}: pasos reales {[s for s, _ in real]}, previstos {[s for s, _ in predicted]}")
+        if real != predicted:
+            problems.append(f"{label}: passes() {predicted} != _run_flux {real}")
+    return problems
+
+
+def main():
+    with tempfile.TemporaryDirectory(prefix="qwen_bench_engine_") as root:
+        for rel_path, body in STUB_MODULES.items():
+            path = os.path.join(root, rel_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(body)
+        sys.path.insert(0, root)
+        generator = make_generator(root)
+
+        print("Teselas con cargador solo de rutas:")
+        problems = check_tiled_path_only(generator)
+        print("Pasadas previstas por admisión:")
+        problems += check_passes(generator, root)
+
+    for problem in problems:
+        print(f"FALLO: {problem}")
+    print("OK" if not problems else "FALLO")
+    return 0 if not problems else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""
+Benchmark reproducible del arranque en frío de model_manager.
+
+Ejecuta `import model_manager` + `QwenImageGenerator()` en un proceso nuevo con
+los paquetes de ML sustituidos por módulos falsos que tardan STUB_DELAY en
+importarse. Así el resultado no depende de tener mlx/mflux instalados y
+cualquier importación pesada que vuelva al arranque se detecta de inmediato.
+
+Uso:
+    python bench_startup.py                         # falla si se supera --max-seconds
+    python bench_startup.py --save-baseline base.json
+    python bench_startup.py --baseline base.json    # falla si empeora más de --tolerance
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Módulos falsos: ruta relativa -> contenido
+STUB_MODULES = {
+    "mlx/__init__.py": "",
+    "mlx/core.py": "class _Metal:\n    def clear_cache(self): pass\nmetal = _Metal()\n",
+    "mflux/__init__.py": "",
+    "mflux/models/__init__.py": "",
+    "mflux/models/flux/__init__.py": "",
+    "mflux/models/flux/variants/__init__.py": "",
+    "mflux/models/flux/variants/txt2img/__init__.py": "",
+    "mflux/models/flux/variants/txt2img/flux.py": "class Flux1:\n    pass\n",
+    "mflux/models/common/__init__.py": "",
+    "mflux/models/common/config/__init__.py": "",
+    "mflux/models/common/config/model_config.py": "class ModelConfig:\n    pass\n",
+    "mflux/models/common/config/config.py": "class Config:\n    pass\n",
+    "mlx_vlm/__init__.py": "def load(*a, **k): pass\ndef generate(*a, **k): pass\n",
+    "mlx_vlm/prompt_utils.py": "def apply_chat_template(*a, **k): pass\n",
+    "mlx_vlm/utils.py": "def load_config(*a, **k): pass\n",
+    "deep_translator/__init__.py": "class GoogleTranslator:\n    def __init__(self, *a, **k): pass\n",
+    "dotenv/__init__.py": "def load_dotenv(*a, **k): pass\n",
+    "numpy/__init__.py": "",
+}
+HEAVY_MODULES = ["mlx", "mflux", "mlx_vlm", "deep_translator", "dotenv", "numpy"]
+
+PROBE = """
+import sys, time, json
+t0 = time.perf_counter()
+import model_manager
+t1 = time.perf_counter()
+generator = model_manager.QwenImageGenerator()
+t2 = time.perf_counter()
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{"import_s": t1 - t0, "init_s": t2 - t1, "heavy_loaded": heavy}}))
+"""
+
+
+def write_stubs(root, delay):
+    for rel_path, body in STUB_MODULES.items():
+        path = os.path.join(root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            # Solo los paquetes de primer nivel simulan el coste de importación
+            if rel_path.count("/") == 1 and rel_path.endswith("__init__.py"):
+                f.write(f"import time\ntime.sleep({delay})\n")
+            f.write(body)
+
+
+def parse_importtime(stderr, top=10):
+    """Coste por módulo de primer nivel a partir de la salida de -X importtime."""
+    costs = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # Los módulos anidados vienen sangrados; solo interesan los de primer nivel
+        if name[1:].startswith(" "):
+            continue
+        costs.append({"module": name.strip(), "self_ms": int(self_us) / 1000,
+                      "cumulative_ms": int(cumulative_us) / 1000})
+    costs.sort(key=lambda c: c["cumulative_ms"], reverse=True)
+    return costs[:top]
+
+
+def run_once(stub_dir, work_dir):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([stub_dir, REPO_DIR])
+    env["QWEN_TRANSLATION_DB"] = os.path.join(work_dir, "translations.sqlite3")
+    env["QWEN_IDLE_UNLOAD_SECONDS"] = "0"
+    cmd = [sys.executable, "-X", "importtime", "-c", PROBE.format(heavy=HEAVY_MODULES)]
+    proc = subprocess.run(cmd, cwd=work_dir, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise Exception(f"El proceso de prueba falló:\n{proc.stderr}")
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["modules"] = parse_importtime(proc.stderr)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de arranque en frío de model_manager")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--stub-delay", type=float, default=0.2, help="Segundos que tarda cada paquete falso en importarse")
+    parser.add_argument("--max-seconds", type=float, default=0.5, help="Límite absoluto para import + __init__ (mediana)")
+    parser.add_argument("--baseline", help="JSON de referencia con el que comparar")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Empeoramiento relativo admitido frente a la referencia")
+    parser.add_argument("--save-baseline", help="Guardar el resultado como referencia")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as stub_dir, tempfile.TemporaryDirectory() as work_dir:
+        write_stubs(stub_dir, args.stub_delay)
+        runs = [run_once(stub_dir, work_dir) for _ in range(args.runs)]
+
+    totals = sorted(r["import_s"] + r["init_s"] for r in runs)
+    median = totals[len(totals) // 2]
+    heavy = sorted({m for r in runs for m in r["heavy_loaded"]})
+    summary = {
+        "median_s": median,
+        "min_s": totals[0],
+        "max_s": totals[-1],
+        "heavy_loaded": heavy,
+        "modules": runs[-1]["modules"],
+    }
+
+    print(f"Arranque (import + __init__): mediana {median * 1000:.1f} ms "
+          f"(min {totals[0] * 1000:.1f}, max {totals[-1] * 1000:.1f}) en {args.runs} ejecuciones")
+    print("Coste por módulo (acumulado):")
+    for cost in summary["modules"]:
+        print(f"  {cost['module']:<30} {cost['cumulative_ms']:8.1f} ms (propio {cost['self_ms']:.1f} ms)")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Referencia guardada en {args.save_baseline}")
+
+    failures = []
+    if heavy:
+        failures.append(f"dependencias pesadas importadas al arrancar: {', '.join(heavy)}")
+    if median > args.max_seconds:
+        failures.append(f"mediana {median:.3f}s supera el límite de {args.max_seconds:.3f}s")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        limit = baseline["median_s"] * (1 + args.tolerance)
+        if median > limit:
+            failures.append(f"mediana {median:.3f}s empeora la referencia {baseline['median_s']:.3f}s (+{args.tolerance:.0%})")
+
+    if failures:
+        for failure in failures:
+            print(f"REGRESIÓN: {failure}")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
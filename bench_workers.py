@@ -0,0 +1,132 @@
+"""
+Prueba de los motores en procesos trabajadores con DummyEngine, sin GPU ni modelos.
+
+1. Tráfico mixto: generaciones, ediciones (imagen de entrada por memoria compartida) y
+   análisis a la vez, con un carril por motor y con un único carril. Con carriles el
+   análisis no espera a las generaciones.
+2. Fallos: un trabajo que mata su proceso y otro que lo cuelga. Solo falla ese trabajo;
+   el otro motor sigue atendiendo y el proceso caído se reinicia para la cola siguiente.
+3. Al terminar no deben quedar bloques de memoria compartida huérfanos.
+
+Uso:
+    python bench_workers.py
+    python bench_workers.py --jobs 12 --step-time 0.05
+"""
+import os
+import sys
+import time
+import argparse
+from scheduler import RequestScheduler, ENGINE_LANES
+from engine_workers import WorkerBackend
+
+
+def shm_segments():
+    try:
+        return {name for name in os.listdir("/dev/shm") if name.startswith("psm_")}
+    except OSError:
+        return set()
+
+
+def make_backend(step_time, job_timeout=None):
+    return WorkerBackend("engine_workers:DummyEngine", options={"step_time": step_time},
+                         health_interval=0.2, health_timeout=2.0, job_timeout=job_timeout)
+
+
+def run_mixed(jobs, step_time, lanes):
+    import numpy as np
+
+    backend = make_backend(step_time)
+    backend.start()
+    scheduler = RequestScheduler(backend, max_batch_size=1, lanes=lanes)
+    image = np.full((96, 128, 3), 200, dtype=np.uint8)
+    start = time.perf_counter()
+    submitted = []
+    for i in range(jobs):
+        if i % 3 == 0:
+            job = scheduler.submit("analyze", image_path=image, query=f"pregunta {i}")
+        elif i % 3 == 1:
+            job = scheduler.submit("edit", f"edición {i}", steps=8, seed=i, resolution="128x128",
+                                   image_path=image, preview_every=2)
+        else:
+            job = scheduler.submit("generate", f"imagen {i}", steps=8, seed=i, resolution="128x128")
+        submitted.append((job, time.perf_counter()))
+
+    latencies = {"analyze": [], "flux": []}
+    for job, sent in submitted:
+        result = job.future.result(timeout=60)
+        if job.mode == "analyze":
+            assert result.startswith("Descripción simulada (128x96)"), result
+        else:
+            assert result.size == (128, 128) and result.info.get("seed") == job.seed, result
+        latencies["analyze" if job.mode == "analyze" else "flux"].append(job.finished_at - job.submitted_at)
+    wall = time.perf_counter() - start
+    scheduler.shutdown()
+    backend.shutdown()
+    return wall, latencies
+
+
+def run_faults(step_time):
+    backend = make_backend(step_time, job_timeout=3.0)
+    backend.start()
+    scheduler = RequestScheduler(backend, max_batch_size=1, lanes=ENGINE_LANES)
+    flux = backend.workers["flux"]
+    first_pid = flux.health()["pid"]
+    problems = []
+
+    crash = scheduler.submit("generate", "__crash__", resolution="64x64")
+    analyses = [scheduler.submit("analyze", query=f"pregunta {i}") for i in range(4)]
+    after_crash = scheduler.submit("generate", "tras el fallo", resolution="64x64", seed=1)
+    hang = scheduler.submit("generate", "__hang__", resolution="64x64")
+    after_hang = scheduler.submit("generate", "tras el cuelgue", resolution="64x64", seed=2)
+    error = scheduler.submit("analyze", query="__error__")
+
+    for label, job in (("crash", crash), ("hang", hang), ("error", error)):
+        try:
+            job.future.result(timeout=60)
+            problems.append(f"{label}: debería haber fallado")
+        except Exception as e:
+            print(f"  {label}: falla solo esa petición -> {e}")
+    for job in analyses + [after_crash, after_hang]:
+        try:
+            job.future.result(timeout=60)
+        except Exception as e:
+            problems.append(f"{job.mode} '{job.prompt or job.query}' falló: {e}")
+
+    health = backend.health()
+    if health["flux"]["restarts"] < 2 or health["flux"]["pid"] == first_pid:
+        problems.append(f"flux no se reinició: {health['flux']}")
+    if health["vlm"]["restarts"] != 0:
+        problems.append(f"vlm se reinició sin motivo: {health['vlm']}")
+    print(f"  flux: {health['flux']['restarts']} reinicios, último fallo: {health['flux']['last_failure']}")
+    scheduler.shutdown()
+    backend.shutdown()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Motores en procesos trabajadores con un motor falso")
+    parser.add_argument("--jobs", type=int, default=12)
+    parser.add_argument("--step-time", type=float, default=0.05)
+    args = parser.parse_args()
+
+    before = shm_segments()
+    for label, lanes in (("un carril", None), ("un carril por motor", ENGINE_LANES)):
+        wall, latencies = run_mixed(args.jobs, args.step_time, lanes)
+        analyze = sum(latencies["analyze"]) / max(1, len(latencies["analyze"]))
+        flux = sum(latencies["flux"]) / max(1, len(latencies["flux"]))
+        print(f"{label}: {args.jobs} trabajos en {wall:.2f} s, latencia media análisis {analyze:.2f} s, "
+              f"generación {flux:.2f} s")
+
+    print("Fallos aislados:")
+    problems = run_faults(args.step_time)
+    leaked = shm_segments() - before
+    if leaked:
+        problems.append(f"memoria compartida sin liberar: {sorted(leaked)}")
+    for problem in problems:
+        print(f"FALLO: {problem}")
+    print("OK" if not problems else "FALLO")
+    return 0 if not problems else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,32 @@
+import threading
+
+
+class CancelledError(Exception):
+    """La petición se canceló antes de terminar."""
+
+    def __init__(self, reason="Petición cancelada."):
+        super().__init__(reason)
+
+
+class CancellationToken:
+    """
+    Señal de cancelación cooperativa. Los motores la comprueban entre pasos
+    de denoising o entre tokens generados y abortan con CancelledError.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason="Petición cancelada."):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise CancelledError(self.reason)
@@ -1,36 +1,91 @@
-import os
-from huggingface_hub import snapshot_download
-
-def download_qwen_image_model(model_id="mlx-community/Qwen2-VL-7B-Instruct-4bit", local_dir="models/Qwen-Image-2.0-7B-Instruct-MLX"):
-    """
-    Descarga el modelo especificado desde Hugging Face.
-    Asegura que se descarguen los archivos necesarios para MLX.
-    """
-    print(f"Iniciando descarga del modelo {model_id}...")
-    
-    if not os.path.exists(local_dir):
-        os.makedirs(local_dir)
-        
+"""
+Descarga los modelos de la suite al registro local (models/ por defecto).
+
+Los archivos se descargan en paralelo, se reanudan si se corta la conexión y se
+verifican con el hash publicado por el hub. Una vez completos, la aplicación
+los carga del disco sin acceder a la red.
+
+Uso:
+    python download_model.py                       # VLM (Qwen2-VL)
+    python download_model.py flux vlm --workers 8  # ambos motores
+    python download_model.py --verify --deep       # recomprueba los sha256 locales
+    python download_model.py --serve espejo/       # espejo HTTP local (espejo/<org>/<modelo>/...)
+    python download_model.py vlm --endpoint http://127.0.0.1:8765
+"""
+import sys
+import time
+import argparse
+import threading
+from model_registry import ModelRegistry, HubSource, serve_mirror
+
+
+def download(registry, engine, revision, workers):
+    spec = registry.engines[engine]
+    print(f"Iniciando descarga del modelo {spec.repo} en {registry.path(engine)}...")
+    lock = threading.Lock()
+    state = {"bytes": 0, "last": 0.0}
+    start = time.time()
+
+    def progress(name, count):
+        with lock:
+            state["bytes"] += count
+            now = time.time()
+            if now - state["last"] >= 2:
+                state["last"] = now
+                speed = state["bytes"] / max(now - start, 1e-6) / 1024 ** 2
+                print(f"  {state['bytes'] / 1024 ** 3:.2f} GB descargados ({speed:.1f} MB/s)")
+
     try:
-        # Priorizamos descargar archivos .npz o .safetensors únicos (no sharded)
-        # y los archivos de configuración.
-        snapshot_download(
-            repo_id=model_id,
-            local_dir=local_dir,
-            local_dir_use_symlinks=False,
-            # Evitamos descargar los pesos sharded de transformers si existen los npz de MLX
-            ignore_patterns=["*.msgpack", "*.bin", "*.h5"],
-            revision="main"
-        )
-        print(f"\n¡Descarga completada! Los pesos están en: {local_dir}")
-        return True
+        path = registry.download(engine, revision=revision, workers=workers, progress=progress)
     except Exception as e:
         print(f"\nError durante la descarga: {e}")
-        print("\nTIP: Si el modelo es privado, asegúrate de haber ejecutado 'huggingface-cli login'.")
+        print("\nTIP: Si el modelo es privado, define HF_TOKEN o ejecuta 'huggingface-cli login'.")
         return False
+    print(f"\n¡Descarga completada! Los pesos están en: {path}")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Descarga y verificación de modelos locales")
+    parser.add_argument("engines", nargs="*", default=["vlm"], help="Motores: flux, vlm (por defecto vlm)")
+    parser.add_argument("--models-dir", default=None, help="Raíz del registro (QWEN_MODELS_DIR o models/)")
+    parser.add_argument("--revision", default="main")
+    parser.add_argument("--workers", type=int, default=4, help="Archivos descargados en paralelo")
+    parser.add_argument("--endpoint", default=None, help="Hub o espejo (por defecto HF_ENDPOINT o huggingface.co)")
+    parser.add_argument("--verify", action="store_true", help="Comprueba la descarga local en vez de descargar")
+    parser.add_argument("--deep", action="store_true", help="Con --verify: recalcula los sha256")
+    parser.add_argument("--serve", metavar="DIR", help="Sirve DIR como espejo HTTP con la API del hub")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.serve:
+        server = serve_mirror(args.serve, host="0.0.0.0", port=args.port)
+        print(f"Espejo de modelos en http://0.0.0.0:{args.port} (Ctrl+C para salir)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+        return 0
+
+    registry = ModelRegistry(args.models_dir, source=HubSource(args.endpoint))
+    unknown = [engine for engine in args.engines if engine not in registry.engines]
+    if unknown:
+        print(f"Motores desconocidos: {', '.join(unknown)} (disponibles: {', '.join(registry.engines)})")
+        return 2
+
+    ok = True
+    for engine in args.engines:
+        if args.verify:
+            problems = registry.verify(engine, deep=args.deep)
+            for problem in problems:
+                print(f"  {problem}")
+            print(f"{engine}: {'OK' if not problems else f'{len(problems)} problema(s)'}")
+            ok = ok and not problems
+        else:
+            ok = download(registry, engine, args.revision, args.workers) and ok
+    return 0 if ok else 1
+
 
 if __name__ == "__main__":
-    # Nota: Usamos Qwen2-VL-7B como base compatible con MLX hasta que 
-    # los pesos específicos de Qwen-Image 2.0 estén listados bajo ese ID exacto.
-    # El usuario puede cambiar este ID si tiene acceso a uno más específico.
-    download_qwen_image_model()
+    sys.exit(main())
@@ -0,0 +1,707 @@
+"""
+Motores en procesos trabajadores: un proceso por motor (FLUX, VLM), supervisado desde la app.
+
+El análisis con el VLM y la generación con FLUX dejan de bloquearse entre sí, y un fallo
+del motor (excepción nativa, falta de memoria, cuelgue) mata solo su proceso: el
+supervisor lo detecta con health checks, falla la petición en curso y arranca otro.
+
+IPC: mensajes pequeños (dicts) por un Pipe; los píxeles viajan por memoria compartida
+(multiprocessing.shared_memory), no como bytes serializados. Quien crea un bloque lo
+libera: las entradas las crea y borra el proceso principal; las salidas (imagen final y
+previews) las crea el trabajador y las borra el principal tras copiarlas.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import uuid
+import hashlib
+import argparse
+import importlib
+import threading
+import traceback
+import subprocess
+import multiprocessing
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+from multiprocessing.connection import Connection
+from metrics import REGISTRY, RequestTrace
+from progress import ProgressEvent
+from cancellation import CancellationToken, CancelledError
+from image_io import is_path, to_pil
+from scheduler import SchedulerBackend, ENGINE_LANES
+from tiling import parse_resolution
+
+MODE_ENGINES = {mode: engine for engine, modes in ENGINE_LANES.items() for mode in modes}
+
+
+def split_memory_budget(total, footprints):
+    """
+    Reparte el presupuesto de memoria entre los procesos de los motores, en proporción a su
+    huella estimada: cada proceso tiene su propio ResidencyManager y, sin reparto, todos
+    creerían disponer de la memoria entera a la vez.
+    """
+    weight = sum(footprints.values()) or 1
+    return {engine: int(total * footprint / weight) for engine, footprint in footprints.items()}
+
+
+def _open_block(name=None, size=0, track=True):
+    """
+    SharedMemory nuevo (name=None) o existente. Con track=False el bloque no se registra
+    en el resource_tracker de este proceso, que si no lo borraría al salir aunque su
+    dueño sea el otro proceso.
+    """
+    create = name is None
+    if track:
+        return shared_memory.SharedMemory(name=name, create=create, size=size)
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:
+        # Python < 3.13: se registra siempre; se deshace el registro a mano
+        from multiprocessing import resource_tracker
+        block = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(block._name, "shared_memory")
+        return block
+
+
+def share_image(image, track=True):
+    """Copia los píxeles de una imagen PIL a un bloque compartido nuevo. Devuelve (bloque, descriptor)."""
+    import numpy as np
+
+    if image.mode not in ("RGB", "RGBA", "L"):
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    pixels = np.asarray(image)
+    block = _open_block(size=max(1, pixels.nbytes), track=track)
+    np.ndarray(pixels.shape, dtype=np.uint8, buffer=block.buf)[...] = pixels
+    info = {key: image.info[key] for key in ("seed",) if key in image.info}
+    return block, {"shm": block.name, "shape": list(pixels.shape), "mode": image.mode, "info": info}
+
+
+def load_shared_image(desc, unlink=False, track=True):
+    """Imagen PIL (copia propia) a partir de un descriptor; con unlink borra el bloque al terminar."""
+    import numpy as np
+    from PIL import Image
+
+    block = _open_block(desc["shm"], track=track)
+    try:
+        pixels = np.ndarray(tuple(desc["shape"]), dtype=np.uint8, buffer=block.buf)
+        image = Image.fromarray(pixels.copy(), desc["mode"])
+        # La vista sobre el bloque debe desaparecer antes de cerrarlo
+        del pixels
+    finally:
+        block.close()
+        if unlink:
+            block.unlink()
+    image.info.update(desc.get("info", {}))
+    return image
+
+
+def _release(block):
+    try:
+        block.close()
+        block.unlink()
+    except (OSError, BufferError):
+        pass
+
+
+def _discard(desc):
+    """Borra un bloque de salida que ya nadie va a leer (respuesta de una petición abandonada)."""
+    try:
+        _release(_open_block(desc["shm"]))
+    except OSError:
+        pass
+
+
+# --- Motores (se instancian dentro del proceso trabajador) ---
+
+class GeneratorEngine:
+    """Motor real: un QwenImageGenerator propio del proceso, del que solo se usa un motor."""
+
+    def __init__(self, engine, prewarm=True):
+        from model_manager import QwenImageGenerator
+        self.engine = engine
+        self.generator = QwenImageGenerator()
+        if prewarm:
+            self.generator.prewarm([engine])
+
+    def stats(self):
+        """Estado del motor para /metrics; viaja con cada respuesta al health check."""
+        return {"loaded": self.generator.residency.stats()[self.engine]["loaded"],
+                "caches": self.generator.cache_stats()}
+
+    def run(self, op, params, image, progress, cancel_token):
+        if op == "analyze":
+            return self.generator.interrogate_image(image, params.get("query"), cancel_token=cancel_token,
+                                                    token_callback=progress)
+        item = {"prompt": params.get("prompt"), "seed": params.get("seed", -1), "image_path": image,
+                "trace": REGISTRY.current_trace(), "progress": progress,
+                "preview_every": params.get("preview_every", 0), "cancel_token": cancel_token}
+        result = self.generator.generate_batch(
+            [item],
+            steps=params.get("steps", 4),
+            guidance_scale=params.get("guidance_scale", 0.0),
+            resolution=params.get("resolution", "1024x1024"),
+            strength=params.get("strength", 0.8),
+        )[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class DummyEngine:
+    """
+    Motor falso para probar el camino completo (proceso, IPC, memoria compartida,
+    health checks, reinicios) sin GPU ni modelos. Prompts o preguntas especiales:
+    "__crash__" mata el proceso, "__hang__" lo deja colgado y "__error__" lanza una excepción.
+    """
+
+    def __init__(self, engine, step_time=0.05):
+        self.engine = engine
+        self.step_time = step_time
+
+    def run(self, op, params, image, progress, cancel_token):
+        from PIL import Image
+
+        text = params.get("prompt") or params.get("query") or ""
+        if is_path(image):
+            image = Image.open(image)
+        if "__crash__" in text:
+            os._exit(3)
+        if "__hang__" in text:
+            while True:
+                time.sleep(3600)
+        if "__error__" in text:
+            raise Exception("Fallo simulado del motor.")
+
+        if op == "analyze":
+            size = f"{image.width}x{image.height}" if image is not None else "sin imagen"
+            answer = f"Descripción simulada ({size}): {text}"
+            for word in answer.split(" "):
+                time.sleep(self.step_time)
+                cancel_token.raise_if_cancelled()
+                progress(word + " ")
+            return answer
+
+        width, height = parse_resolution(params.get("resolution", "64x64"))
+        steps = params.get("steps", 4)
+        digest = hashlib.sha256(f"{text}|{params.get('seed')}".encode("utf-8")).digest()
+        start = time.perf_counter()
+        for step in range(1, steps + 1):
+            time.sleep(self.step_time)
+            REGISTRY.record("denoise_step", self.step_time)
+            cancel_token.raise_if_cancelled()
+            preview = None
+            if params.get("preview_every") and step % params["preview_every"] == 0:
+                preview = Image.new("RGB", (max(1, width // 8), max(1, height // 8)), tuple(digest[:3]))
+            progress(ProgressEvent(step, steps, time.perf_counter() - start, preview=preview))
+        result = Image.new("RGB", (width, height), tuple(digest[:3]))
+        if image is not None:
+            result.paste(image.convert("RGB").resize((width // 2, height // 2)))
+        result.info["seed"] = params.get("seed")
+        return result
+
+
+def load_engine(spec, engine, options):
+    """Instancia un motor a partir de "módulo:clase"."""
+    module_name, _, attr = spec.partition(":")
+    factory = getattr(importlib.import_module(module_name), attr)
+    return factory(engine, **options)
+
+
+# --- Proceso trabajador ---
+
+def serve(conn, spec, engine_name, options):
+    """
+    Bucle del proceso trabajador. Un hilo lector atiende los pings y las cancelaciones
+    mientras el hilo principal ejecuta el motor, así que un paso de denoising largo no
+    hace fallar el health check (un proceso colgado sí).
+    """
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    jobs = queue.Queue()
+    tokens = {}
+
+    def reader():
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                # El proceso principal ha desaparecido: nadie recogerá el resultado
+                os._exit(0)
+            op = message["op"]
+            if op == "ping":
+                try:
+                    stats = engine.stats() if hasattr(engine, "stats") else None
+                except Exception:
+                    stats = None
+                try:
+                    send({"type": "pong", "ts": message["ts"], "stats": stats})
+                except OSError:
+                    os._exit(0)
+            elif op == "cancel":
+                token = tokens.get(message["id"])
+                if token is not None:
+                    token.cancel(message.get("reason") or "Petición cancelada.")
+            elif op == "stop":
+                jobs.put(None)
+                return
+            else:
+                # El token se crea al recibir el trabajo: una cancelación posterior siempre lo encuentra
+                tokens[message["id"]] = CancellationToken()
+                jobs.put(message)
+
+    engine = load_engine(spec, engine_name, options)
+    threading.Thread(target=reader, name="qwen-worker-reader", daemon=True).start()
+    send({"type": "ready", "pid": os.getpid()})
+
+    while True:
+        message = jobs.get()
+        if message is None:
+            break
+        job_id = message["id"]
+        token = tokens[job_id]
+        trace = RequestTrace(message["op"])
+
+        def progress(event, job_id=job_id):
+            if isinstance(event, str):
+                send({"type": "token", "id": job_id, "text": event})
+                return
+            update = {"type": "progress", "id": job_id, "step": event.step, "total": event.total,
+                      "elapsed": event.elapsed, "preview": None, "done": event.done,
+                      "error": str(event.error) if event.error is not None else None}
+            # La imagen final viaja con el resultado; aquí solo las previews
+            if event.preview is not None:
+                block, update["preview"] = share_image(event.preview, track=False)
+                block.close()
+            send(update)
+
+        reply = {"id": job_id}
+        try:
+            image = message.get("image")
+            if isinstance(image, dict):
+                image = load_shared_image(image, track=False)
+            token.raise_if_cancelled()
+            with REGISTRY.use_trace(trace), REGISTRY.measure_peak([trace]):
+                result = engine.run(message["op"], message["params"], image, progress, token)
+            reply["type"] = "result"
+            if isinstance(result, str):
+                reply["text"] = result
+            else:
+                block, reply["image"] = share_image(result, track=False)
+                block.close()
+        except CancelledError as e:
+            reply.update(type="cancelled", error=str(e))
+        except Exception as e:
+            traceback.print_exc()
+            reply.update(type="error", error=str(e))
+        finally:
+            tokens.pop(job_id, None)
+        reply.update(spans=trace.spans, steps=trace.steps, peak_memory=trace.peak_memory)
+        send(reply)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Proceso trabajador de un motor (lo lanza EngineWorker)")
+    parser.add_argument("--fd", type=int, required=True)
+    parser.add_argument("--engine", required=True)
+    parser.add_argument("--spec", required=True)
+    parser.add_argument("--options", default="{}")
+    args = parser.parse_args()
+    serve(Connection(args.fd), args.spec, args.engine, json.loads(args.options))
+    return 0
+
+
+# --- Supervisión (proceso principal) ---
+
+class WorkerRequest:
+    """Petición enviada a un trabajador; su resultado llega por future."""
+
+    def __init__(self, op, params, image=None, progress=None, cancel_token=None, trace=None):
+        self.id = uuid.uuid4().hex
+        self.op = op
+        self.params = params
+        self.image = image
+        self.progress = progress
+        self.cancel_token = cancel_token
+        self.trace = trace
+        self.future = Future()
+        self.last_event = None
+        self.reply = None
+        self.done = threading.Event()
+
+
+class EngineWorker:
+    """
+    Supervisa el proceso de un motor. Las peticiones esperan en la cola del trabajador y
+    se envían de una en una; mientras una se ejecuta se hace ping cada health_interval s.
+    Si el proceso muere, deja de responder (health_timeout), supera job_timeout o ignora
+    una cancelación durante cancel_grace s, se mata, la petición en curso falla y se arranca
+    un proceso nuevo: las peticiones en cola no se pierden.
+    """
+
+    def __init__(self, engine, spec="engine_workers:GeneratorEngine", options=None, health_interval=5.0,
+                 health_timeout=30.0, job_timeout=None, cancel_grace=30.0, startup_timeout=120.0,
+                 max_queue=0, env=None):
+        self.engine = engine
+        self.spec = spec
+        self.options = options or {}
+        # Variables de entorno propias del proceso (p. ej. su parte del presupuesto de memoria)
+        self.env = env or {}
+        # Último estado informado por el motor (GeneratorEngine.stats), o None
+        self.engine_stats = None
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.job_timeout = job_timeout
+        self.cancel_grace = cancel_grace
+        self.startup_timeout = startup_timeout
+        self.queue = queue.Queue(max_queue)
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "restarts": 0, "crashes": 0}
+        self.last_failure = None
+        self._process = None
+        self._conn = None
+        self._current = None
+        self._failures = 0
+        self._last_pong = 0.0
+        self._ready = threading.Event()
+        self._send_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._running = True
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name=f"qwen-worker-{engine}", daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, op, params, image=None, progress=None, cancel_token=None, trace=None):
+        """Encola una petición para el motor y devuelve su future sin bloquear."""
+        if not self._running:
+            raise Exception(f"El trabajador de {self.engine} está detenido.")
+        request = WorkerRequest(op, params, image, progress, cancel_token, trace)
+        try:
+            self.queue.put_nowait(request)
+        except queue.Full:
+            raise Exception(f"Servidor ocupado: la cola del motor {self.engine} está llena.")
+        self.stats["submitted"] += 1
+        return request.future
+
+    def alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def health(self):
+        return {
+            "status": "up" if self.alive() else ("stopped" if not self._running else "down"),
+            "pid": self._process.pid if self._process is not None else None,
+            "busy": self._current is not None,
+            "queued": self.queue.qsize(),
+            "last_pong_age": round(time.monotonic() - self._last_pong, 2) if self.alive() else None,
+            "last_failure": self.last_failure,
+            **self.stats,
+        }
+
+    def start(self):
+        """Arranca el proceso si no está vivo (también se hace solo con la primera petición)."""
+        with self._start_lock:
+            if not self.alive():
+                self._spawn()
+
+    def _spawn(self):
+        self._stop_process()
+        parent_conn, child_conn = multiprocessing.Pipe()
+        command = [sys.executable, os.path.abspath(__file__), "--fd", str(child_conn.fileno()),
+                   "--engine", self.engine, "--spec", self.spec, "--options", json.dumps(self.options)]
+        env = dict(os.environ, **self.env)
+        here = os.path.dirname(os.path.abspath(__file__))
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [here, env.get("PYTHONPATH")]))
+        self._ready.clear()
+        try:
+            self._process = subprocess.Popen(command, pass_fds=[child_conn.fileno()], env=env)
+        finally:
+            child_conn.close()
+        self._conn = parent_conn
+        self._last_pong = time.monotonic()
+        threading.Thread(target=self._receive, args=(parent_conn,), name=f"qwen-worker-{self.engine}-rx",
+                         daemon=True).start()
+        deadline = time.monotonic() + self.startup_timeout
+        while not self._ready.wait(0.1):
+            if not self.alive() or time.monotonic() > deadline:
+                code = self._process.poll()
+                self._stop_process()
+                raise Exception(f"El motor {self.engine} no arrancó (código {code}).")
+        print(f"Trabajador {self.engine}: proceso {self._process.pid} listo")
+
+    def stop(self, timeout=10.0):
+        """Detiene el trabajador: falla lo que quede en cola y termina el proceso."""
+        self._running = False
+        self.queue.put(None)
+        self._dispatcher.join(timeout)
+        if self._current is None:
+            try:
+                self._send({"op": "stop"})
+                self._process.wait(timeout)
+            except Exception:
+                pass
+        self._stop_process()
+
+    def _send(self, message):
+        with self._send_lock:
+            self._conn.send(message)
+
+    def _stop_process(self):
+        process, self._process = self._process, None
+        if process is not None and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _receive(self, conn):
+        """Hilo receptor de un proceso concreto; termina cuando se cierra su conexión."""
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                return
+            kind = message["type"]
+            if kind == "pong":
+                self._last_pong = time.monotonic()
+                self.engine_stats = message.get("stats")
+            elif kind == "ready":
+                self._ready.set()
+            else:
+                self._route(message)
+
+    def _route(self, message):
+        request = self._current
+        if request is None or request.id != message["id"]:
+            # Respuesta de una petición ya resuelta (p. ej. tras un reinicio): solo liberar memoria
+            for desc in (message.get("preview"), message.get("image")):
+                if desc:
+                    _discard(desc)
+            return
+        kind = message["type"]
+        if kind == "token":
+            self._notify(request, message["text"])
+        elif kind == "progress":
+            preview = load_shared_image(message["preview"], unlink=True) if message["preview"] else None
+            event = ProgressEvent(message["step"], message["total"], message["elapsed"], preview=preview,
+                                  error=message["error"])
+            request.last_event = event
+            if not message["done"]:
+                self._notify(request, event)
+        else:
+            if message.get("image"):
+                message["image"] = load_shared_image(message["image"], unlink=True)
+            request.reply = message
+            request.done.set()
+
+    def _notify(self, request, update):
+        if request.progress is None:
+            return
+        try:
+            request.progress(update)
+        except Exception as e:
+            print(f"Aviso: callback de progreso falló: {e}")
+
+    def _dispatch_loop(self):
+        while True:
+            try:
+                request = self.queue.get(timeout=self.health_interval)
+            except queue.Empty:
+                self._idle_check()
+                continue
+            if request is None or not self._running:
+                break
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            if request.cancel_token is not None and request.cancel_token.cancelled:
+                request.future.set_exception(CancelledError(request.cancel_token.reason))
+                continue
+            self._execute(request)
+
+        # Detenido: lo que queda en cola no se ejecutará
+        while True:
+            try:
+                request = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None and request.future.set_running_or_notify_cancel():
+                request.future.set_exception(Exception(f"El trabajador de {self.engine} se ha detenido."))
+
+    def _idle_check(self):
+        """Health check sin peticiones: si el proceso murió en reposo, se vuelve a arrancar."""
+        if self._process is None or not self._running:
+            return
+        if self.alive():
+            try:
+                self._send({"op": "ping", "ts": time.time()})
+            except OSError:
+                pass
+            if time.monotonic() - self._last_pong <= self.health_timeout:
+                return
+        self._restart("sin respuesta en reposo" if self.alive() else f"terminó (código {self._process.poll()})")
+
+    def _execute(self, request):
+        block = None
+        try:
+            self.start()
+            message = {"op": request.op, "id": request.id, "params": request.params, "image": None}
+            if request.image is not None:
+                if is_path(request.image):
+                    message["image"] = str(request.image)
+                else:
+                    from PIL import ImageOps
+                    # Los metadatos no viajan con los píxeles: la orientación EXIF se aplica aquí
+                    block, message["image"] = share_image(ImageOps.exif_transpose(to_pil(request.image)))
+            self._current = request
+            self._send(message)
+            failure = self._wait(request)
+        except Exception as e:
+            failure = str(e)
+        finally:
+            self._current = None
+            if block is not None:
+                _release(block)
+
+        if failure is not None:
+            self.stats["failed"] += 1
+            self._restart(failure)
+            request.future.set_exception(Exception(
+                f"El motor {self.engine} falló ({failure}) y se ha reiniciado; la petición no se completó."))
+            return
+        self._failures = 0
+        self._deliver(request)
+
+    def _wait(self, request):
+        """Espera la respuesta haciendo health checks. Devuelve None, o el motivo del fallo del proceso."""
+        started = time.monotonic()
+        next_ping = started + self.health_interval
+        cancel_deadline = None
+        while not request.done.wait(0.1):
+            now = time.monotonic()
+            if not self.alive():
+                return f"el proceso terminó con código {self._process.poll()}"
+            if cancel_deadline is None and request.cancel_token is not None and request.cancel_token.cancelled:
+                self._send({"op": "cancel", "id": request.id, "reason": request.cancel_token.reason})
+                cancel_deadline = now + self.cancel_grace
+            if now >= next_ping:
+                self._send({"op": "ping", "ts": time.time()})
+                next_ping = now + self.health_interval
+            if now - self._last_pong > self.health_timeout:
+                return f"sin respuesta al health check en {self.health_timeout:.0f} s"
+            if self.job_timeout and now - started > self.job_timeout:
+                return f"superó el límite de {self.job_timeout:.0f} s"
+            if cancel_deadline is not None and now > cancel_deadline:
+                return "no atendió la cancelación"
+        return None
+
+    def _restart(self, reason):
+        self.stats["crashes"] += 1
+        self.last_failure = reason
+        self._failures += 1
+        print(f"Trabajador {self.engine}: {reason}; reiniciando el proceso")
+        self._stop_process()
+        if not self._running:
+            return
+        # Espera creciente si falla en bucle (p. ej. el modelo no cabe en memoria)
+        time.sleep(min(30.0, 0.5 * 2 ** (self._failures - 1)))
+        try:
+            self.start()
+            self.stats["restarts"] += 1
+        except Exception as e:
+            # Se reintentará con la siguiente petición
+            print(f"Trabajador {self.engine}: no se pudo reiniciar: {e}")
+
+    def _deliver(self, request):
+        reply = request.reply
+        if request.trace is not None:
+            # Las etapas medidas en el trabajador se incorporan a la traza de la petición
+            with REGISTRY.use_trace(request.trace):
+                for stage, seconds in reply.get("spans", []):
+                    REGISTRY.record(stage, seconds)
+                for seconds in reply.get("steps", []):
+                    REGISTRY.record("denoise_step", seconds)
+            if reply.get("peak_memory") is not None:
+                request.trace.peak_memory = max(request.trace.peak_memory or 0, reply["peak_memory"])
+        if reply["type"] == "cancelled":
+            self.stats["failed"] += 1
+            request.future.set_exception(CancelledError(reply["error"]))
+        elif reply["type"] == "error":
+            self.stats["failed"] += 1
+            request.future.set_exception(Exception(reply["error"]))
+        else:
+            self.stats["completed"] += 1
+            result = reply["image"] if reply.get("image") is not None else reply.get("text")
+            if reply.get("image") is not None and request.last_event is not None:
+                # Evento final con la imagen, como lo emite el motor en proceso
+                last = request.last_event
+                self._notify(request, ProgressEvent(last.total, last.total, last.elapsed, image=result))
+            request.future.set_result(result)
+
+
+class WorkerBackend(SchedulerBackend):
+    """
+    Backend del planificador con un EngineWorker por motor. Usar con
+    RequestScheduler(..., lanes=ENGINE_LANES) para que cada motor tenga su propio hilo.
+    memory_budgets ({motor: bytes}, ver split_memory_budget) fija el presupuesto de cada proceso.
+    """
+
+    def __init__(self, spec="engine_workers:GeneratorEngine", engines=tuple(ENGINE_LANES), options=None,
+                 memory_budgets=None, **worker_options):
+        self.workers = {}
+        for engine in engines:
+            env = {}
+            if memory_budgets and engine in memory_budgets:
+                env["QWEN_MEMORY_BUDGET_GB"] = f"{memory_budgets[engine] / 1024 ** 3:.3f}"
+            self.workers[engine] = EngineWorker(engine, spec, options, env=env, **worker_options)
+
+    def run_batch(self, jobs):
+        worker = self.workers[MODE_ENGINES[jobs[0].mode]]
+        futures = []
+        for job in jobs:
+            params = {"prompt": job.prompt, "seed": job.seed, "steps": job.steps,
+                      "guidance_scale": job.guidance_scale, "resolution": job.resolution,
+                      "strength": job.strength, "query": job.query, "preview_every": job.preview_every}
+            futures.append(worker.submit(job.mode, params, image=job.image_path, progress=job.progress_callback,
+                                         cancel_token=job.cancel_token, trace=job.trace))
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def start(self):
+        for worker in self.workers.values():
+            worker.start()
+
+    def health(self):
+        return {engine: worker.health() for engine, worker in self.workers.items()}
+
+    def engine_stats(self):
+        """
+        (contadores de caché sumados entre procesos, {motor: cargado}) según el último
+        health check de cada trabajador.
+        """
+        caches, loaded = {}, {}
+        for engine, worker in self.workers.items():
+            stats = worker.engine_stats if worker.alive() else None
+            loaded[engine] = bool(stats and stats.get("loaded"))
+            for name, value in ((stats or {}).get("caches") or {}).items():
+                caches[name] = caches.get(name, 0) + value
+        return caches, loaded
+
+    def shutdown(self):
+        for worker in self.workers.values():
+            worker.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+PAGE_SIZE = 12
+
+COLUMNS = "id, session, created, kind, path, thumb_path, prompt, seed, params, timings"
+
+
+class HistoryIndex:
+    """
+    Historial persistente de generaciones en SQLite.
+    Las páginas se recorren por cursor (created, id) sobre índices, así que el coste de
+    cada página no depende del número total de imágenes guardadas.
+    """
+
+    def __init__(self, db_path="outputs/history.sqlite3", page_size=PAGE_SIZE):
+        self.db_path = db_path
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        if db_path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " session TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " kind TEXT NOT NULL,"
+            " path TEXT NOT NULL,"
+            " thumb_path TEXT,"
+            " prompt TEXT,"
+            " seed INTEGER,"
+            " params TEXT,"
+            " timings TEXT);"
+            "CREATE INDEX IF NOT EXISTS idx_generations_session ON generations (session, created, id);"
+            "CREATE INDEX IF NOT EXISTS idx_generations_created ON generations (created, id);"
+        )
+        # Búsqueda por texto del prompt: FTS5 si está compilado en SQLite, si no LIKE sin índice
+        try:
+            self._conn.executescript(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5("
+                " prompt, content='generations', content_rowid='id');"
+                "CREATE TRIGGER IF NOT EXISTS generations_ai AFTER INSERT ON generations BEGIN"
+                " INSERT INTO generations_fts (rowid, prompt) VALUES (new.id, new.prompt); END;"
+                "CREATE TRIGGER IF NOT EXISTS generations_ad AFTER DELETE ON generations BEGIN"
+                " INSERT INTO generations_fts (generations_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt); END;"
+            )
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+        self._conn.commit()
+
+    def add(self, session, kind, path, thumb_path=None, prompt=None, seed=None, params=None, timings=None):
+        """Registra una imagen generada y devuelve su id."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO generations (session, created, kind, path, thumb_path, prompt, seed, params, timings)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (session, time.time(), kind, path, thumb_path, prompt, seed,
+                 json.dumps(params or {}, default=str), json.dumps(timings or {}, default=str)),
+            )
+            self._conn.commit()
+            return cursor.lastrowid
+
+    def get(self, entry_id):
+        with self._lock:
+            row = self._conn.execute(f"SELECT {COLUMNS} FROM generations WHERE id = ?", (entry_id,)).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+    def page(self, session=None, cursor=None, limit=None):
+        """
+        Una página de entradas, de la más reciente a la más antigua.
+        cursor es el (created, id) de la última entrada de la página anterior; devuelve
+        (entradas, cursor_siguiente), con cursor_siguiente None si no hay más.
+        """
+        limit = limit or self.page_size
+        where, args = [], []
+        if session is not None:
+            where.append("session = ?")
+            args.append(session)
+        if cursor is not None:
+            where.append("(created < ? OR (created = ? AND id < ?))")
+            args += [cursor[0], cursor[0], cursor[1]]
+        return self._select(where, args, limit)
+
+    def between(self, start, end, session=None, cursor=None, limit=None):
+        """Entradas creadas en [start, end) (timestamps), paginadas igual que page."""
+        limit = limit or self.page_size
+        where, args = ["created >= ?", "created < ?"], [start, end]
+        if session is not None:
+            where.append("session = ?")
+            args.append(session)
+        if cursor is not None:
+            where.append("(created < ? OR (created = ? AND id < ?))")
+            args += [cursor[0], cursor[0], cursor[1]]
+        return self._select(where, args, limit)
+
+    def search(self, text, session=None, cursor=None, limit=None):
+        """Entradas cuyo prompt contiene las palabras de text, paginadas igual que page."""
+        limit = limit or self.page_size
+        if self.fts:
+            # Cada palabra como término entrecomillado: sin sintaxis FTS accidental
+            query = " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+            if not query:
+                return [], None
+            where, args = ["id IN (SELECT rowid FROM generations_fts WHERE generations_fts MATCH ?)"], [query]
+        else:
+            where, args = ["prompt LIKE ?"], [f"%{text}%"]
+        if session is not None:
+            where.append("session = ?")
+            args.append(session)
+        if cursor is not None:
+            where.append("(created < ? OR (created = ? AND id < ?))")
+            args += [cursor[0], cursor[0], cursor[1]]
+        return self._select(where, args, limit)
+
+    def count(self, session=None):
+        with self._lock:
+            if session is None:
+                return self._conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM generations WHERE session = ?", (session,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _select(self, where, args, limit):
+        sql = f"SELECT {COLUMNS} FROM generations"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        # Se pide una fila de más para saber si existe una página siguiente
+        sql += " ORDER BY created DESC, id DESC LIMIT ?"
+        with self._lock:
+            rows = self._conn.execute(sql, args + [limit + 1]).fetchall()
+        entries = [self._to_dict(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = entries[-1]
+            next_cursor = (last["created"], last["id"])
+        return entries, next_cursor
+
+    @staticmethod
+    def _to_dict(row):
+        entry = dict(row)
+        entry["params"] = json.loads(entry["params"] or "{}")
+        entry["timings"] = json.loads(entry["timings"] or "{}")
+        return entry
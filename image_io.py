@@ -0,0 +1,98 @@
+import os
+import inspect
+import tempfile
+import contextlib
+from pathlib import Path
+
+
+def is_path(image):
+    return isinstance(image, (str, Path))
+
+
+def accepts_pil(function):
+    """
+    True si el primer parámetro de function (el cargador de imágenes de un motor) declara
+    PIL.Image en su anotación. Se decide por la firma, sin ejecutar nada.
+    """
+    try:
+        parameter = next(iter(inspect.signature(function).parameters.values()))
+    except (TypeError, ValueError, StopIteration):
+        return False
+    annotation = parameter.annotation
+    return "Image" in (annotation if isinstance(annotation, str) else repr(annotation))
+
+
+def to_pil(image):
+    """
+    Normaliza una entrada de imagen para los motores: las rutas se devuelven tal cual,
+    los PIL.Image también, y los arrays de NumPy (HxW, HxWx3, HxWx4; uint8 o float en [0, 1])
+    se convierten a PIL sin pasar por disco.
+    """
+    if image is None or is_path(image):
+        return image
+    from PIL import Image
+    if isinstance(image, Image.Image):
+        return image
+
+    import numpy as np
+    array = np.asarray(image)
+    if array.ndim == 3 and array.shape[2] == 1:
+        array = array[:, :, 0]
+    if array.ndim not in (2, 3) or (array.ndim == 3 and array.shape[2] not in (3, 4)):
+        raise Exception(f"Forma de imagen no soportada: {array.shape}")
+    if array.dtype != np.uint8:
+        if np.issubdtype(array.dtype, np.floating):
+            array = np.clip(array, 0.0, 1.0) * 255.0
+        array = np.clip(array, 0, 255).astype(np.uint8)
+    return Image.fromarray(array)
+
+
+@contextlib.contextmanager
+def spill_to_file(image, prefix="qwen_spill_"):
+    """
+    Ruta en disco para motores que solo aceptan rutas. Las imágenes en memoria se escriben
+    en un archivo temporal único (sin colisiones entre peticiones) que se borra al salir.
+    """
+    if image is None or is_path(image):
+        yield image
+        return
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix=".png")
+    os.close(fd)
+    try:
+        # Sin compresión: el archivo vive unos milisegundos, solo interesa escribirlo rápido
+        to_pil(image).save(path, compress_level=0)
+        yield path
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def contact_sheet(images, labels=None, columns=4, cell_size=256, padding=4, background=(24, 24, 24)):
+    """
+    Hoja de contactos: las imágenes reducidas a celdas de cell_size en una cuadrícula,
+    cada una con su etiqueta (semilla, guidance...) en la esquina inferior.
+    """
+    from PIL import Image, ImageDraw
+
+    if not images:
+        raise Exception("No hay imágenes para la hoja de contactos.")
+    columns = max(1, min(columns, len(images)))
+    rows = (len(images) + columns - 1) // columns
+    sheet = Image.new("RGB", (columns * (cell_size + padding) + padding, rows * (cell_size + padding) + padding),
+                      background)
+    draw = ImageDraw.Draw(sheet)
+    for i, image in enumerate(images):
+        cell = to_pil(image).convert("RGB")
+        cell.thumbnail((cell_size, cell_size), Image.LANCZOS, reducing_gap=2.0)
+        x = padding + (i % columns) * (cell_size + padding)
+        y = padding + (i // columns) * (cell_size + padding)
+        # Centrar en la celda las imágenes no cuadradas
+        sheet.paste(cell, (x + (cell_size - cell.width) // 2, y + (cell_size - cell.height) // 2))
+        if labels and i < len(labels) and labels[i]:
+            left, top, right, bottom = draw.textbbox((0, 0), labels[i])
+            box_y = y + cell_size - (bottom - top) - 6
+            draw.rectangle((x, box_y, x + (right - left) + 6, y + cell_size), fill=(0, 0, 0))
+            draw.text((x + 3, box_y + 3 - top), labels[i], fill=(255, 255, 255))
+    return sheet
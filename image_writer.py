@@ -0,0 +1,170 @@
+import os
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from metrics import REGISTRY
+
+# Formato -> (extensión, formato de PIL)
+FORMATS = {
+    "png": (".png", "PNG"),
+    "webp": (".webp", "WEBP"),
+    "jpeg": (".jpg", "JPEG"),
+    "jpg": (".jpg", "JPEG"),
+}
+
+
+def save_options(fmt="png", png_level=6, quality=90):
+    """Argumentos de Image.save para el formato pedido."""
+    fmt = fmt.lower()
+    if fmt not in FORMATS:
+        raise Exception(f"Formato de salida no soportado: {fmt} (usa png, webp o jpeg)")
+    pil_format = FORMATS[fmt][1]
+    if pil_format == "PNG":
+        return {"format": "PNG", "compress_level": int(png_level)}
+    if pil_format == "WEBP":
+        # quality=100 se interpreta como WebP sin pérdida
+        if int(quality) >= 100:
+            return {"format": "WEBP", "lossless": True}
+        return {"format": "WEBP", "quality": int(quality), "method": 4}
+    return {"format": "JPEG", "quality": int(quality), "optimize": True}
+
+
+def write_image(image, path, fsync=True, **options):
+    """
+    Escribe la imagen de forma atómica: archivo temporal en el mismo directorio y os.replace,
+    así nadie (galería, caché) ve nunca un archivo a medio escribir.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if options.get("format") == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            image.save(f, **options)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def make_thumbnail(image, size=256):
+    """Miniatura para la galería (lado mayor = size), sin modificar la imagen original."""
+    from PIL import Image
+    thumb = image.copy()
+    # reducing_gap: primero reduce por factor entero (barato) y luego remuestrea
+    thumb.thumbnail((size, size), Image.LANCZOS, reducing_gap=2.0)
+    return thumb
+
+
+class ImageWriter:
+    """
+    Pool de hilos que persiste las imágenes en segundo plano.
+    submit devuelve enseguida las rutas finales (y la miniatura ya escrita) para que la UI
+    responda sin esperar a la codificación a resolución completa.
+    """
+
+    def __init__(self, output_dir="outputs", workers=2, fmt="png", png_level=6, quality=90,
+                 thumb_size=256, thumb_dir=None):
+        self.output_dir = output_dir
+        self.fmt = fmt.lower()
+        self.options = save_options(self.fmt, png_level, quality)
+        self.extension = FORMATS[self.fmt][0]
+        self.thumb_size = thumb_size
+        self.thumb_dir = thumb_dir or os.path.join(output_dir, "thumbs")
+        self.stats = {"written": 0, "failed": 0, "bytes": 0}
+        self._pending = 0
+        self._dirs = set()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._closed = False
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="qwen-writer")
+        os.makedirs(self.output_dir, exist_ok=True)
+        if thumb_size:
+            os.makedirs(self.thumb_dir, exist_ok=True)
+        atexit.register(self.close)
+
+    def submit(self, image, name, on_done=None):
+        """
+        Encola la escritura de image como <output_dir>/<name><ext>.
+        La miniatura se escribe en el momento (unos milisegundos); la imagen completa en el pool.
+        Con thumb_size=0 no se generan miniaturas (ruta_miniatura es None).
+        on_done(path) se llama en el hilo escritor cuando el archivo ya está en disco.
+        Devuelve (ruta, ruta_miniatura, future).
+        """
+        path = os.path.join(self.output_dir, name + self.extension)
+        thumb_path = None
+        if self.thumb_size:
+            thumb_path = os.path.join(self.thumb_dir, name + ".jpg")
+            with REGISTRY.span("thumbnail"):
+                write_image(make_thumbnail(image, self.thumb_size), thumb_path, fsync=False,
+                            **save_options("jpeg", quality=85))
+
+        with self._lock:
+            if self._closed:
+                raise Exception("El escritor de imágenes está cerrado.")
+            self._pending += 1
+            self._dirs.add(os.path.dirname(path) or ".")
+            if thumb_path:
+                self._dirs.add(self.thumb_dir)
+        future = self._pool.submit(self._write, image, path, on_done)
+        return path, thumb_path, future
+
+    def _write(self, image, path, on_done):
+        try:
+            # La petición ya respondió: la etapa va solo al histograma, sin traza
+            with REGISTRY.use_trace(None), REGISTRY.span("image_encode"):
+                write_image(image, path, **self.options)
+            size = os.path.getsize(path)
+            with self._lock:
+                self.stats["written"] += 1
+                self.stats["bytes"] += size
+            if on_done is not None:
+                on_done(path)
+            return path
+        except Exception as e:
+            print(f"Error al guardar {path}: {e}")
+            with self._lock:
+                self.stats["failed"] += 1
+            raise
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self._idle.notify_all()
+
+    def pending(self):
+        with self._lock:
+            return self._pending
+
+    def flush(self, timeout=None):
+        """Espera a que terminen las escrituras en curso y sincroniza los directorios."""
+        with self._lock:
+            if not self._idle.wait_for(lambda: self._pending == 0, timeout):
+                return False
+            dirs = list(self._dirs)
+        for directory in dirs:
+            # fsync del directorio para que los os.replace sobrevivan a un corte de luz
+            try:
+                fd = os.open(directory, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+        return True
+
+    def close(self):
+        """Vacía la cola, sincroniza con disco y detiene el pool. Idempotente."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self.flush()
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,137 @@
+import threading
+import contextlib
+from collections import OrderedDict
+from vlm_cache import image_key
+from metrics import REGISTRY
+from image_io import accepts_pil, spill_to_file
+
+_ORIENTATION_TAG = 0x0112
+
+
+def preprocess(image, width, height):
+    """
+    Imagen PIL -> array float32 (1, alto, ancho, 3) en [-1, 1], como ImageUtil de mflux
+    (orientación EXIF, alfa sobre blanco, LANCZOS), pero normalizando en sitio con NumPy:
+    una única copia a float32 y ninguna intermedia más.
+    """
+    import numpy as np
+    from PIL import Image, ImageOps
+
+    image = ImageOps.exif_transpose(image)
+    transparent = getattr(image, "has_transparency_data",
+                          image.mode in ("RGBA", "LA", "PA", "La") or "transparency" in image.info)
+    if transparent:
+        rgba = (image.convert("LA") if image.mode == "La" else image).convert("RGBA")
+        image = Image.alpha_composite(Image.new("RGBA", rgba.size, (255, 255, 255, 255)), rgba)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if image.size != (width, height):
+        image = image.resize((width, height), Image.LANCZOS)
+
+    pixels = np.asarray(image, dtype=np.float32)
+    if not pixels.flags.writeable:
+        pixels = pixels.copy()
+    # x / 255 * 2 - 1 en dos operaciones en sitio
+    np.multiply(pixels, 2.0 / 255.0, out=pixels)
+    np.subtract(pixels, 1.0, out=pixels)
+    return pixels[None]
+
+
+class LatentCache:
+    """
+    Latentes VAE de imágenes de entrada para Image-to-Image, por hash de contenido +
+    resolución destino, en un LRU. Editar varias veces la misma imagen (otra instrucción,
+    otra fuerza) reutiliza el latente: cada iteración solo paga el denoising.
+    Se engancha a LatentCreator.encode_image de mflux con install().
+    """
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._original = None
+        self.loader_accepts_pil = False
+
+    @property
+    def installed(self):
+        return self._original is not None
+
+    def install(self):
+        """Sustituye LatentCreator.encode_image por la versión con caché. Devuelve False si no es posible."""
+        if self._original is not None:
+            return True
+        try:
+            from mflux.models.common.latent_creator.latent_creator import LatentCreator
+        except ImportError:
+            return False
+        original = LatentCreator.__dict__.get("encode_image")
+        if not isinstance(original, staticmethod):
+            return False
+        self._original = original.__func__
+        try:
+            from mflux.utils.image_util import ImageUtil
+            self.loader_accepts_pil = accepts_pil(ImageUtil.load_image)
+        except ImportError:
+            self.loader_accepts_pil = False
+        cache = self
+
+        def encode_image(vae, image_path, height, width, tiling_config=None):
+            return cache.encode(vae, image_path, height, width, tiling_config)
+
+        LatentCreator.encode_image = staticmethod(encode_image)
+        return True
+
+    @contextlib.contextmanager
+    def skip(self):
+        """Desactiva el caché en este hilo (imágenes de un solo uso, p. ej. teselas de refinado)."""
+        previous = getattr(self._local, "skip", False)
+        self._local.skip = True
+        try:
+            yield
+        finally:
+            self._local.skip = previous
+
+    def encode(self, vae, image, height, width, tiling_config=None):
+        from PIL import Image
+        # Rutas y demás entradas: comportamiento original de mflux
+        if getattr(self._local, "skip", False) or not isinstance(image, Image.Image):
+            # Con un cargador que solo admite rutas, la imagen en memoria pasa por un temporal
+            spill = isinstance(image, Image.Image) and not self.loader_accepts_pil
+            with spill_to_file(image) if spill else contextlib.nullcontext(image) as source:
+                return self._original(vae=vae, image_path=source, height=height, width=width,
+                                      tiling_config=tiling_config)
+
+        tiled = bool(tiling_config is not None and getattr(tiling_config, "vae_encode_tiled", False))
+        key = (image_key(image), image.getexif().get(_ORIENTATION_TAG, 1), width, height, tiled)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        import mlx.core as mx
+        from mflux.models.common.vae.vae_util import VAEUtil
+        # NHWC -> NCHW en mlx (vista perezosa), como ImageUtil.to_array
+        with REGISTRY.span("image_preprocess"):
+            pixels = mx.transpose(mx.array(preprocess(image, width, height)), (0, 3, 1, 2))
+        latent = VAEUtil.encode(vae=vae, image=pixels, tiling_config=tiling_config)
+        # Se materializa ya: el array guardado no debe arrastrar el grafo ni la imagen de entrada
+        mx.eval(latent)
+        with self._lock:
+            self._entries[key] = latent
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return latent
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries),
+                    "max_entries": self.max_entries}
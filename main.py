@@ -5,6 +5,7 @@ import os
 import threading
 from datetime import datetime
 from model_manager import QwenImageGenerator
+from cancellation import CancellationToken, CancelledError
 
 # Configuración estética
 ctk.set_appearance_mode("Dark")
@@ -21,6 +22,8 @@ class QwenImageApp(ctk.CTk):
         # Inicializar generador de IA
         self.generator = QwenImageGenerator()
         self.current_image = None
+        self.cancel_token = None
+        self.worker = None
 
         # Layout principal (Grid)
         self.grid_columnconfigure(1, weight=1)
@@ -92,6 +95,9 @@ class QwenImageApp(ctk.CTk):
         self.save_btn = ctk.CTkButton(self.actions_frame, text="Save Local", state="disabled", fg_color="#2ecc71", hover_color="#27ae60", command=self.save_image)
         self.save_btn.pack(side="right", padx=10)
 
+        self.cancel_btn = ctk.CTkButton(self.actions_frame, text="Cancel", state="disabled", fg_color="#e74c3c", hover_color="#c0392b", command=self.cancel_generation)
+        self.cancel_btn.pack(side="right", padx=10)
+
         self.progress_bar = ctk.CTkProgressBar(self.main_frame)
         self.progress_bar.set(0)
         self.progress_bar.grid(row=3, column=0, columnspan=2, padx=20, pady=10, sticky="ew")
@@ -104,13 +110,16 @@ class QwenImageApp(ctk.CTk):
             self.status_label.configure(text="Status: Model Missing", text_color="#e74c3c")
             tk.messagebox.showwarning("Modelo no encontrado", 
                 f"No se han encontrado los pesos en: {self.generator.model_path}\n\n"
-                "Por favor, descarga los pesos desde Hugging Face y colócalos en esa carpeta.")
+                "Descárgalos con: python download_model.py flux")
         else:
             self.status_label.configure(text="Status: Loading Model...", text_color="#f1c40f")
             threading.Thread(target=self.load_model_bg, daemon=True).start()
 
     def load_model_bg(self):
-        success = self.generator.load_model()
+        # Carga a través del gestor de residencia: si luego descarga FLUX por inactividad,
+        # generate_image lo vuelve a cargar al pedirlo
+        self.generator.prewarm(["flux"]).join()
+        success = self.generator.model is not None
         if success:
             self.status_label.configure(text="Status: Model Ready", text_color="#2ecc71")
         else:
@@ -123,15 +132,19 @@ class QwenImageApp(ctk.CTk):
             tk.messagebox.showwarning("Atención", "Por favor, escribe un prompt.")
             return
 
-        if self.generator.model is None:
-            tk.messagebox.showerror("Error", "El modelo no está cargado.")
-            return
+        # Un segundo clic con una generación en curso la cancela (preempción) y arranca la nueva
+        previous = None
+        if self.worker is not None and self.worker.is_alive():
+            self.cancel_token.cancel("Reemplazada por una nueva generación.")
+            previous = self.worker
+        token = CancellationToken()
+        self.cancel_token = token
 
-        self.generate_btn.configure(state="disabled")
         self.save_btn.configure(state="disabled")
+        self.cancel_btn.configure(state="normal")
         self.status_label.configure(text="Status: Generating...", text_color="#f1c40f")
-        self.progress_bar.configure(mode="indeterminate")
-        self.progress_bar.start()
+        self.progress_bar.configure(mode="determinate")
+        self.progress_bar.set(0)
 
         # Obtener parámetros
         params = {
@@ -141,16 +154,56 @@ class QwenImageApp(ctk.CTk):
             "resolution": self.res_menu.get()
         }
 
-        threading.Thread(target=self.generation_thread, args=(prompt, params), daemon=True).start()
+        self.worker = threading.Thread(target=self.generation_thread, args=(prompt, params, token, previous), daemon=True)
+        self.worker.start()
 
-    def generation_thread(self, prompt, params):
+    def cancel_generation(self):
+        if self.cancel_token is not None:
+            self.cancel_token.cancel()
+
+    def generation_thread(self, prompt, params, token, previous=None):
+        if previous is not None:
+            # La generación anterior aborta en su siguiente paso; esperar a que suelte el motor
+            previous.join()
         try:
-            image = self.generator.generate_image(prompt, **params)
-            self.after(0, self.display_image, image)
+            image = self.generator.generate_image(
+                prompt, progress_callback=lambda event: self.on_progress(event, token),
+                preview_every=1, cancel_token=token, **params
+            )
+            self.after(0, self.display_image, image, token)
+        except CancelledError:
+            self.after(0, self.handle_cancelled, token)
         except Exception as e:
-            self.after(0, self.handle_error, str(e))
+            self.after(0, self.handle_error, str(e), token)
+
+    def on_progress(self, event, token):
+        # Llamado desde el hilo de generación: delegar la actualización al hilo de Tk
+        if not event.done and token is self.cancel_token:
+            self.after(0, self.show_progress, event)
 
-    def display_image(self, image):
+    def handle_cancelled(self, token):
+        # Si ya hay otra generación en marcha, su progreso sustituye a este estado
+        if token is not self.cancel_token:
+            return
+        self.cancel_btn.configure(state="disabled")
+        self.status_label.configure(text="Status: Cancelled", text_color="gray")
+        self.progress_bar.set(0)
+
+    def show_progress(self, event):
+        self.progress_bar.set(event.fraction)
+        self.status_label.configure(text=f"Status: {event.describe()}", text_color="#f1c40f")
+        if event.preview is not None:
+            # La preview es de 1/8 de resolución: escalarla al tamaño del visor
+            preview = event.preview.resize((event.preview.width * 4, event.preview.height * 4), Image.Resampling.BILINEAR)
+            preview.thumbnail((800, 600), Image.Resampling.BILINEAR)
+            photo = ImageTk.PhotoImage(preview)
+            self.image_label.configure(image=photo, text="")
+            self.image_label.image = photo
+
+    def display_image(self, image, token):
+        # Resultado de una generación ya sustituida por otra: no pisar la imagen ni el estado
+        if token is not self.cancel_token:
+            return
         self.current_image = image
         
         # Redimensionar para la preview pero manteniendo el ratio
@@ -162,14 +215,16 @@ class QwenImageApp(ctk.CTk):
         self.image_label.configure(image=photo, text="")
         self.image_label.image = photo # Keep reference
 
-        self.generate_btn.configure(state="normal")
+        self.cancel_btn.configure(state="disabled")
         self.save_btn.configure(state="normal")
         self.status_label.configure(text="Status: Generation Complete", text_color="#2ecc71")
         self.progress_bar.stop()
         self.progress_bar.set(1)
 
-    def handle_error(self, message):
-        self.generate_btn.configure(state="normal")
+    def handle_error(self, message, token):
+        if token is not self.cancel_token:
+            return
+        self.cancel_btn.configure(state="disabled")
         self.status_label.configure(text="Status: Error", text_color="#e74c3c")
         self.progress_bar.stop()
         self.progress_bar.set(0)
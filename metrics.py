@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Límites superiores (segundos) de los buckets del histograma de etapas
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Histogram:
+    """Histograma acumulativo al estilo Prometheus."""
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class RequestTrace:
+    """Etapas cronometradas de una petición, más su pico de memoria."""
+
+    def __init__(self, kind, **attrs):
+        self.kind = kind
+        self.attrs = attrs
+        self.spans = []
+        self.steps = []
+        self.status = "ok"
+        self.started = time.time()
+        self.start = None
+        self.total = None
+        self.peak_memory = None
+
+    def to_dict(self):
+        return {
+            "ts": self.started,
+            "kind": self.kind,
+            "status": self.status,
+            "total_s": self.total,
+            "spans": [{"stage": stage, "seconds": seconds} for stage, seconds in self.spans],
+            "denoise_steps_s": self.steps,
+            "peak_memory_bytes": self.peak_memory,
+            **self.attrs,
+        }
+
+
+def _reset_peak_memory():
+    # Solo si mlx ya está cargado: las métricas no deben forzar su importación
+    mx = sys.modules.get("mlx.core")
+    if mx is not None:
+        try:
+            (mx if hasattr(mx, "reset_peak_memory") else mx.metal).reset_peak_memory()
+        except Exception:
+            pass
+
+
+def _peak_memory():
+    """Pico de memoria de MLX desde el último reinicio; si no hay mlx, RSS máximo del proceso."""
+    mx = sys.modules.get("mlx.core")
+    if mx is not None:
+        try:
+            return (mx if hasattr(mx, "get_peak_memory") else mx.metal).get_peak_memory()
+        except Exception:
+            pass
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss viene en bytes en macOS y en KB en Linux
+        return rss if sys.platform == "darwin" else rss * 1024
+    except Exception:
+        return None
+
+
+class MetricsRegistry:
+    """
+    Agrega la latencia por etapa en histogramas y registra cada petición como una línea JSON.
+    La traza activa es por hilo: el código del motor añade etapas sin tener que recibirla.
+    """
+
+    def __init__(self, log_path=None):
+        self.log_path = log_path
+        self.stages = {}
+        self.requests = {}
+        self.peak_memory = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def current_trace(self):
+        return getattr(self._local, "trace", None)
+
+    @contextlib.contextmanager
+    def use_trace(self, trace):
+        """Activa una traza existente en este hilo (p. ej. en el hilo del planificador)."""
+        previous = self.current_trace()
+        self._local.trace = trace
+        try:
+            yield trace
+        finally:
+            self._local.trace = previous
+
+    @contextlib.contextmanager
+    def request(self, kind, **attrs):
+        """Cronometra una petición completa y la vuelca al log JSON al terminar."""
+        trace = self.begin(kind, **attrs)
+        try:
+            with self.use_trace(trace):
+                yield trace
+        except Exception:
+            trace.status = "error"
+            raise
+        finally:
+            self.end(trace)
+
+    def begin(self, kind, **attrs):
+        """
+        Abre una traza sin activarla en el hilo. Para funciones generadoras (streaming),
+        cuyo cuerpo puede reanudarse en hilos distintos: activarla con use_trace por tramos.
+        """
+        trace = RequestTrace(kind, **attrs)
+        trace.start = time.perf_counter()
+        return trace
+
+    def end(self, trace):
+        trace.total = time.perf_counter() - trace.start
+        self._finish(trace)
+
+    @contextlib.contextmanager
+    def measure_peak(self, traces):
+        """
+        Anota en cada traza el pico de memoria del bloque. El contador de MLX es global al
+        proceso: debe envolver solo la ejecución del motor (en su hilo), no la petición entera,
+        o una petición nueva lo reiniciaría con otra aún en curso.
+        """
+        _reset_peak_memory()
+        try:
+            yield
+        finally:
+            peak = _peak_memory()
+            if peak is not None:
+                for trace in traces:
+                    if trace is not None:
+                        trace.peak_memory = max(trace.peak_memory or 0, peak)
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        """Cronometra una etapa."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, seconds):
+        """Registra la duración de una etapa en su histograma y en la traza activa."""
+        with self._lock:
+            self.stages.setdefault(stage, Histogram()).observe(seconds)
+        trace = self.current_trace()
+        if trace is not None:
+            if stage == "denoise_step":
+                trace.steps.append(seconds)
+            else:
+                trace.spans.append((stage, seconds))
+
+    def register_collector(self, collector):
+        """collector() devuelve una lista de (nombre, etiquetas, valor) para exportar como gauges."""
+        self.collectors.append(collector)
+
+    def render_prometheus(self):
+        """Exposición en formato de texto de Prometheus."""
+        lines = [
+            "# HELP qwen_stage_seconds Duración de cada etapa de una petición.",
+            "# TYPE qwen_stage_seconds histogram",
+        ]
+        with self._lock:
+            for stage, hist in sorted(self.stages.items()):
+                for bound, count in zip(hist.buckets, hist.counts):
+                    lines.append(f'qwen_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'qwen_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist.count}')
+                lines.append(f'qwen_stage_seconds_sum{{stage="{stage}"}} {hist.sum}')
+                lines.append(f'qwen_stage_seconds_count{{stage="{stage}"}} {hist.count}')
+
+            lines += ["# HELP qwen_request_seconds Duración total de las peticiones.",
+                      "# TYPE qwen_request_seconds histogram"]
+            for (kind, status), hist in sorted(self.requests.items()):
+                labels = f'kind="{kind}",status="{status}"'
+                for bound, count in zip(hist.buckets, hist.counts):
+                    lines.append(f'qwen_request_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'qwen_request_seconds_bucket{{{labels},le="+Inf"}} {hist.count}')
+                lines.append(f'qwen_request_seconds_sum{{{labels}}} {hist.sum}')
+                lines.append(f'qwen_request_seconds_count{{{labels}}} {hist.count}')
+
+            lines += ["# HELP qwen_request_peak_memory_bytes Mayor pico de memoria observado por tipo de petición.",
+                      "# TYPE qwen_request_peak_memory_bytes gauge"]
+            for kind, value in sorted(self.peak_memory.items()):
+                lines.append(f'qwen_request_peak_memory_bytes{{kind="{kind}"}} {value}')
+
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    label_text = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+                    lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+            except Exception as e:
+                print(f"Error en colector de métricas: {e}")
+        return "\n".join(lines) + "\n"
+
+    def _finish(self, trace):
+        with self._lock:
+            self.requests.setdefault((trace.kind, trace.status), Histogram()).observe(trace.total)
+            if trace.peak_memory is not None:
+                self.peak_memory[trace.kind] = max(self.peak_memory.get(trace.kind, 0), trace.peak_memory)
+            if self.log_path:
+                try:
+                    os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+                    with open(self.log_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(trace.to_dict(), default=str) + "\n")
+                except OSError as e:
+                    print(f"Error al escribir log de métricas: {e}")
+
+
+REGISTRY = MetricsRegistry(os.getenv("QWEN_METRICS_LOG", "outputs/metrics.jsonl"))
+
+
+def start_metrics_server(port=9464, host="127.0.0.1", registry=REGISTRY):
+    """Sirve /metrics en un hilo de fondo, junto a la app de Gradio."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="qwen-metrics", daemon=True).start()
+    print(f"Métricas disponibles en http://{host}:{port}/metrics")
+    return server
@@ -1,149 +1,720 @@
 import os
-import mlx.core as mx
-from mflux.models.flux.variants.txt2img.flux import Flux1
-from mflux.models.common.config.model_config import ModelConfig
-from mflux.models.common.config.config import Config
-from PIL import Image
-import numpy as np
 import traceback
-from pathlib import Path
-from dotenv import load_dotenv
-from deep_translator import GoogleTranslator
+import gc
+import threading
+import time
+import contextlib
+import importlib.util
+from concurrent.futures import Future
+from collections import OrderedDict
+from translation_cache import TranslationMemo, normalize_prompt
+from residency import ResidencyManager, GB
+from metrics import REGISTRY
+from progress import ProgressTracker, ProgressStream, ProgressEvent
+from cancellation import CancelledError
+from image_io import to_pil, is_path, accepts_pil, spill_to_file, contact_sheet
+from image_writer import FORMATS, save_options, write_image
+from vlm_cache import VLMSessionCache, image_key
+from tiling import parse_resolution, base_size, tile_boxes, schedule_steps, TileBlender
+from weight_cache import QuantizedWeightCache, offline_mode, local_revision
+from model_registry import ModelRegistry
+from latent_cache import LatentCache
 
-# Importaciones para VLM (análisis de imágenes)
-try:
-    from mlx_vlm import load as load_vlm, generate as generate_vlm
-    from mlx_vlm.utils import load_config as load_vlm_config
-    VLM_AVAILABLE = True
-except ImportError:
-    VLM_AVAILABLE = False
+# Las dependencias pesadas (mlx, mflux, mlx_vlm, numpy, dotenv) se importan
+# en el primer uso del motor que las necesita, no al importar este módulo,
+# para que la interfaz pueda empezar a servir antes de cargar los motores.
+_env_loaded = False
 
-# Cargar variables desde .env
-load_dotenv()
+def load_env():
+    """Carga .env una sola vez; python-dotenv solo se importa si el archivo existe."""
+    global _env_loaded
+    if _env_loaded:
+        return
+    _env_loaded = True
+    here = os.path.dirname(os.path.abspath(__file__))
+    if os.path.exists(os.path.join(here, ".env")) or os.path.exists(".env"):
+        from dotenv import load_dotenv
+        load_dotenv()
+
+def vlm_available():
+    """Comprueba si mlx-vlm está instalado sin importarlo."""
+    return importlib.util.find_spec("mlx_vlm") is not None
+
+# Huellas estimadas en memoria unificada (se recalibran al medir la carga real)
+FLUX_FOOTPRINT = int(9.5 * GB)  # FLUX.1-schnell 4-bit: transformer + T5 + CLIP + VAE
+VLM_FOOTPRINT = int(5.5 * GB)   # Qwen2-VL-7B 4-bit
+
+class StepTimer:
+    """
+    Callback de mflux que cronometra cada paso de denoising y marca el fin del bucle.
+    Si hay un listener activo (progreso de la petición en curso) se le notifica cada paso,
+    y si la petición tiene token de cancelación se comprueba entre pasos.
+    """
+
+    def __init__(self):
+        self.loop_start = None
+        self.loop_end = None
+        self.listener = None
+        self.cancel_token = None
+        self._last = None
+
+    def call_before_loop(self, seed, prompt, latents, config, **kwargs):
+        self.loop_start = self._last = time.perf_counter()
+        self.loop_end = None
+
+    def call_in_loop(self, t, seed, prompt, latents, config, time_steps):
+        import mlx.core as mx
+        # mflux evalúa los latentes justo después; forzarlo aquí hace que la medida incluya el cómputo del paso
+        mx.eval(latents)
+        now = time.perf_counter()
+        REGISTRY.record("denoise_step", now - self._last)
+        self._last = now
+        if self.cancel_token is not None:
+            # La excepción atraviesa el bucle de mflux y aborta los pasos restantes
+            self.cancel_token.raise_if_cancelled()
+        if self.listener is not None:
+            self.listener(t, latents, config)
+
+    def call_after_loop(self, seed, prompt, latents, config):
+        self.loop_end = time.perf_counter()
+
+class PromptEmbeddingCache:
+    """
+    Sustituto acotado (LRU) del dict prompt_cache de mflux.
+    mflux consulta `prompt in cache` y solo codifica con T5 + CLIP si falta; al limitar
+    el número de entradas el caché no crece sin fin (unos 4 MB por prompt en bf16).
+    """
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __contains__(self, prompt):
+        return prompt in self._entries
+
+    def __getitem__(self, prompt):
+        value = self._entries[prompt]
+        self._entries.move_to_end(prompt)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, prompt, value):
+        if prompt not in self._entries:
+            self.misses += 1
+        self._entries[prompt] = value
+        self._entries.move_to_end(prompt)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, prompt, default=None):
+        return self[prompt] if prompt in self._entries else default
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries),
+                "max_entries": self.max_entries}
 
 class QwenImageGenerator:
-    def __init__(self, flux_model_path="black-forest-labs/FLUX.1-schnell", vlm_model_path="mlx-community/Qwen2-VL-7B-Instruct-4bit"):
+    def __init__(self, flux_model_path="black-forest-labs/FLUX.1-schnell", vlm_model_path="mlx-community/Qwen2-VL-7B-Instruct-4bit", translator_backend=None):
+        load_env()
+        # Modo sin red: huggingface_hub lee HF_HUB_OFFLINE al importarse, que aquí aún no ha ocurrido
+        self.offline = offline_mode()
+        if self.offline:
+            os.environ["HF_HUB_OFFLINE"] = "1"
         self.flux_model_path = flux_model_path
         self.vlm_model_path = vlm_model_path
+        # Registro local de modelos: con la descarga completa se carga del disco, sin red
+        self.models = ModelRegistry()
+        self.models.register("flux", flux_model_path)
+        self.models.register("vlm", vlm_model_path)
         self.model = None # Modelo mflux
         self.vlm_model = None
         self.vlm_processor = None
         self.loading = False
         self.error_message = ""
         self.engine_type = "flux"
-        self.translator = GoogleTranslator(source='auto', target='en')
+        self._flux_lock = threading.Lock()
+        self._vlm_lock = threading.Lock()
+        self.step_timer = StepTimer()
+        # Embeddings de texto por prompt normalizado; sobrevive a descargas del modelo
+        self.prompt_cache = PromptEmbeddingCache(int(os.getenv("QWEN_PROMPT_CACHE_SIZE", "32")))
+        # Latentes VAE de las imágenes de entrada de edición; también sobreviven a descargas
+        self.latent_cache = LatentCache(int(os.getenv("QWEN_LATENT_CACHE_SIZE", "8")))
+        # mflux y mlx-vlm recientes aceptan PIL.Image directamente; al cargar cada motor se
+        # comprueba por la firma de su cargador y, si no, se pasa por un archivo temporal
+        self.flux_accepts_images = True
+        self.vlm_accepts_images = True
+        # Residencia de motores: presupuesto de memoria, precarga y descarga por inactividad
+        budget_gb = os.getenv("QWEN_MEMORY_BUDGET_GB")
+        self.residency = ResidencyManager(
+            memory_budget=int(float(budget_gb) * GB) if budget_gb else None,
+            idle_timeout=int(os.getenv("QWEN_IDLE_UNLOAD_SECONDS", "900")),
+            clear_policy=os.getenv("QWEN_CACHE_CLEAR_POLICY", "pressure")
+        )
+        self.residency.register("flux", self.load_model, self.unload_model,
+                                lambda: self.model is not None, FLUX_FOOTPRINT)
+        self.residency.register("vlm", self.load_vlm_engine, self.unload_vlm_engine,
+                                lambda: self.vlm_model is not None, VLM_FOOTPRINT)
+        # Resoluciones altas: pasada base + refinado por teselas solapadas ("auto")
+        # o generación directa con decodificación VAE por teselas ("off")
+        self.tile_mode = os.getenv("QWEN_TILE_MODE", "auto")
+        self.tile_size = int(os.getenv("QWEN_TILE_SIZE", "1024")) // 16 * 16
+        self.tile_overlap = int(os.getenv("QWEN_TILE_OVERLAP", "128"))
+        self.tile_refine_strength = float(os.getenv("QWEN_TILE_REFINE_STRENGTH", "0.35"))
+        # Pesos de FLUX ya cuantizados en disco: el primer arranque los guarda, los siguientes los mapean
+        self.weight_cache = None
+        if os.getenv("QWEN_WEIGHT_CACHE", "on") != "off":
+            self.weight_cache = QuantizedWeightCache()
+        self._weight_store_thread = None
+        # Preguntas repetidas sobre la misma imagen: features de visión, prefijo KV y respuestas
+        self.vlm_cache = VLMSessionCache(
+            prefix_max_bytes=int(os.getenv("QWEN_VLM_PREFIX_CACHE_MB", "1024")) * 1024 * 1024,
+            vision_entries=int(os.getenv("QWEN_VLM_VISION_CACHE_SIZE", "16")),
+        )
+        # Memoria de traducción persistente; por defecto usa GoogleTranslator solo en fallos de caché
+        self.translator = TranslationMemo(
+            os.getenv("QWEN_TRANSLATION_DB", "outputs/cache/translations.sqlite3"),
+            backend=translator_backend
+        )
 
     def translate_prompt(self, text):
         """Traduce el texto al inglés si es necesario."""
-        try:
-            if not text or not text.strip():
-                return text
-            
-            # GoogleTranslator maneja la detección de origen con 'auto'
+        if not text or not text.strip():
+            return text
+        with REGISTRY.span("translation"):
             translated = self.translator.translate(text)
+        if translated != text:
             print(f"Propuesta de Traducción: '{text}' -> '{translated}'")
-            return translated
-        except Exception as e:
-            print(f"Error en traducción: {e}")
-            return text
+        return translated
 
-    def clear_vram(self):
-        """Limpia el caché de la GPU de Apple (Metal)."""
+    def translate_prompts(self, texts):
+        """Traduce una lista de prompts en una sola llamada (trabajos por lotes)."""
+        return self.translator.translate_batch(list(texts))
+
+    def cache_stats(self):
+        """Contadores de los cachés de los motores, para /metrics."""
+        return {
+            "prompt_embedding_cache_hits": self.prompt_cache.hits,
+            "prompt_embedding_cache_misses": self.prompt_cache.misses,
+            "edit_latent_cache_hits": self.latent_cache.hits,
+            "edit_latent_cache_misses": self.latent_cache.misses,
+            "vlm_response_cache_hits": self.vlm_cache.hits,
+            "vlm_prefix_cache_hits": self.vlm_cache.prefix_hits,
+            "vlm_prefix_cache_bytes": self.vlm_cache.prefix_bytes,
+        }
+
+    def prewarm(self, engines=("flux",)):
+        """Precarga motores en segundo plano para que la primera petición no pague la carga."""
+        return self.residency.prewarm(list(engines))
+
+    def clear_vram(self, force=False):
+        """Limpia el caché de la GPU de Apple (Metal) según la política de residencia."""
+        if not force and not self.residency.should_clear_cache():
+            return
         try:
-            mx.metal.clear_cache()
+            import mlx.core as mx
+            with REGISTRY.span("cache_clear"):
+                mx.metal.clear_cache()
             print("Caché de Metal (GPU) liberado.")
         except Exception as e:
             print(f"Error al limpiar caché: {e}")
 
     def load_model(self, quantization=4):
         """Carga el modelo FLUX para generación y edición."""
-        if self.loading: return
-        self.loading = True
-        try:
-            hf_token = os.getenv("HF_TOKEN")
-            print(f"Cargando motor FLUX {self.flux_model_path}...")
-            # mflux usa automáticamente el token si está en os.environ["HF_TOKEN"]
-            self.model = Flux1.from_name("schnell", quantize=quantization)
-            print("Motor FLUX cargado.")
-            self.loading = False
+        with self._flux_lock:
+            if self.model is not None:
+                return True
+            self.loading = True
+            try:
+                print(f"Cargando motor FLUX {self.flux_model_path}...")
+                with REGISTRY.span("model_load"):
+                    model, store = self._load_flux(quantization)
+                if hasattr(model, "callbacks"):
+                    model.callbacks.register(self.step_timer)
+                # mflux guarda los embeddings en un dict sin límite: se sustituye por el LRU
+                model.prompt_cache = self.prompt_cache
+                cached = self.latent_cache.install()
+                if not cached:
+                    print("mflux sin LatentCreator.encode_image: cada edición codifica su imagen de nuevo.")
+                self.flux_accepts_images = self._flux_loader_accepts_pil()
+                self.model = model
+                print("Motor FLUX cargado.")
+                if store is not None:
+                    self._store_flux_weights_async(model, *store)
+                return True
+            except Exception as e:
+                traceback.print_exc()
+                self.error_message = f"Error al cargar FLUX: {str(e)}"
+                return False
+            finally:
+                self.loading = False
+
+    @property
+    def model_path(self):
+        """Directorio local de los pesos de FLUX en el registro."""
+        return self.models.path("flux")
+
+    def check_model_exists(self, engine="flux"):
+        """True si los pesos del motor están en local (registro o caché de Hugging Face)."""
+        if self.models.local_path(engine):
             return True
-        except Exception as e:
-            traceback.print_exc()
-            self.error_message = f"Error al cargar FLUX: {str(e)}"
-            self.loading = False
+        if engine == "flux" and self.weight_cache is not None \
+                and self.weight_cache.lookup(self.flux_model_path, None, 4):
+            return True
+        return local_revision(self.models.engines[engine].repo) is not None
+
+    def _load_flux(self, quantization):
+        """
+        Instancia Flux1 desde el caché de pesos cuantizados si hay una entrada válida;
+        si no, desde los pesos originales (registro local o hub, cuantizando al vuelo).
+        Devuelve (modelo, guardado): guardado es (revisión, bits) si hay que crear la entrada
+        del caché para la próxima vez, o None.
+        """
+        from mflux.models.flux.variants.txt2img.flux import Flux1
+        from mflux.models.common.config.model_config import ModelConfig
+
+        local_dir = self.models.local_path("flux")
+        revision = (os.getenv("QWEN_FLUX_REVISION") or self.models.revision("flux")
+                    or local_revision(self.flux_model_path))
+        if self.weight_cache is not None:
+            cached = self.weight_cache.lookup(self.flux_model_path, revision, quantization)
+            if cached:
+                print(f"Pesos cuantizados en caché: {cached}")
+                # quantize=None: mflux usa el nivel guardado en los safetensors
+                return Flux1(model_config=ModelConfig.from_name(model_name="schnell", base_model=None),
+                             model_path=cached), None
+        if self.offline and revision is None and local_dir is None:
+            raise Exception(f"Modo sin conexión: no hay pesos de {self.flux_model_path} en el caché local. "
+                            "Descárgalos una vez con conexión (python download_model.py flux).")
+
+        if local_dir:
+            print(f"Pesos originales desde el registro local: {local_dir}")
+            model = Flux1(model_config=ModelConfig.from_name(model_name="schnell", base_model=None),
+                          model_path=local_dir, quantize=quantization)
+        else:
+            # mflux usa automáticamente el token si está en os.environ["HF_TOKEN"]
+            model = Flux1.from_name("schnell", quantize=quantization)
+        # Tras la primera descarga la revisión ya consta en el caché de Hugging Face
+        revision = revision or local_revision(self.flux_model_path)
+        if self.weight_cache is not None and quantization:
+            # Los pesos se materializan antes de publicar el modelo (la primera generación lo
+            # haría igualmente): el hilo de guardado solo leerá arrays ya evaluados
+            import mlx.core as mx
+            mx.eval(model.parameters())
+            return model, (revision, quantization)
+        return model, None
+
+    def _store_flux_weights_async(self, model, revision, quantization):
+        """
+        Guarda los pesos cuantizados en el caché en un hilo aparte, con el modelo ya publicado:
+        la primera carga no espera a escribir varios GB en disco. Un guardado a medias nunca
+        pasa por válido (el manifest va al final), así que cerrar la app durante él es seguro.
+        """
+        if self._weight_store_thread is not None and self._weight_store_thread.is_alive():
+            # Descarga y recarga rápidas: el guardado anterior sigue escribiendo la misma entrada
+            return
+
+        def _store():
+            try:
+                with REGISTRY.span("weight_cache_store"):
+                    path = self.weight_cache.store(model, self.flux_model_path, revision, quantization)
+                print(f"Pesos cuantizados guardados en {path} "
+                      f"({self.weight_cache.size_bytes(path) / GB:.1f} GB): el próximo arranque no recuantiza.")
+            except Exception as e:
+                print(f"Aviso: no se pudieron guardar los pesos cuantizados: {e}")
+
+        self._weight_store_thread = threading.Thread(target=_store, name="weight-cache-store", daemon=True)
+        self._weight_store_thread.start()
+
+    def unload_model(self):
+        """Libera el motor FLUX y devuelve su memoria."""
+        with self._flux_lock:
+            self.model = None
+        gc.collect()
+        self.clear_vram(force=True)
+
+    def _flux_loader_accepts_pil(self):
+        try:
+            from mflux.utils.image_util import ImageUtil
+        except ImportError:
             return False
+        return accepts_pil(ImageUtil.load_image)
 
     def load_vlm_engine(self):
         """Carga el motor VLM (Qwen2-VL) para análisis de imágenes."""
-        if not VLM_AVAILABLE:
+        if not vlm_available():
             self.error_message = "Módulo mlx-vlm no encontrado."
             return False
-        if self.vlm_model is not None:
-            return True
+        with self._vlm_lock:
+            if self.vlm_model is not None:
+                return True
+            try:
+                from mlx_vlm import load as load_vlm
+                source = self.models.resolve("vlm")
+                print(f"Cargando motor VLM {source}...")
+                with REGISTRY.span("model_load"):
+                    self.vlm_model, self.vlm_processor = load_vlm(source)
+                if not self.vlm_cache.attach():
+                    print("mlx-vlm sin caché de visión/prefijo: cada pregunta se procesa completa.")
+                try:
+                    from mlx_vlm.utils import load_image
+                    self.vlm_accepts_images = accepts_pil(load_image)
+                except ImportError:
+                    self.vlm_accepts_images = False
+                if not self.vlm_accepts_images:
+                    print("mlx-vlm no acepta imágenes en memoria; se usará un archivo temporal.")
+                print("Motor VLM cargado.")
+                return True
+            except Exception as e:
+                traceback.print_exc()
+                self.error_message = f"Error al cargar VLM: {str(e)}"
+                return False
+
+    def unload_vlm_engine(self):
+        """Libera el motor VLM y devuelve su memoria."""
+        with self._vlm_lock:
+            self.vlm_model = None
+            self.vlm_processor = None
+            # Los estados KV y las features pertenecen al modelo descargado
+            self.vlm_cache.detach()
+        gc.collect()
+        self.clear_vram(force=True)
+
+    def generate_image(self, prompt, steps=4, guidance_scale=0.0, seed=-1, resolution="1024x1024", image_path=None, strength=0.8,
+                       progress_callback=None, preview_every=0, cancel_token=None):
+        """
+        Genera o edita una imagen (Image-to-Image).
+        image_path: imagen de entrada para edición; ruta, PIL.Image o array NumPy.
+        strength: 0.0 (mismo que original) a 1.0 (cambio total).
+        progress_callback: recibe un ProgressEvent por paso (con preview cada preview_every pasos)
+        y uno final con la imagen.
+        cancel_token: CancellationToken comprobado entre pasos; al cancelarse lanza CancelledError.
+        """
+        if not self.residency.acquire("flux"):
+            raise Exception(self.error_message)
+
         try:
-            print(f"Cargando motor VLM {self.vlm_model_path}...")
-            self.vlm_model, self.vlm_processor = load_vlm(self.vlm_model_path)
-            print("Motor VLM cargado.")
-            return True
+            image = self._run_flux(prompt, steps, guidance_scale, seed, resolution, image_path, strength,
+                                   progress_callback, preview_every, cancel_token)
+            self.clear_vram() # Limpiar tras generar (si hay presión de memoria)
+            return image
+        except CancelledError:
+            print("Generación cancelada.")
+            self.clear_vram()
+            raise
         except Exception as e:
             traceback.print_exc()
-            self.error_message = f"Error al cargar VLM: {str(e)}"
-            return False
+            raise Exception(f"Fallo en motor de imagen: {str(e)}")
+        finally:
+            self.residency.release("flux")
 
-    def generate_image(self, prompt, steps=4, guidance_scale=0.0, seed=-1, resolution="1024x1024", image_path=None, strength=0.8):
+    def iter_generate_image(self, prompt, preview_every=1, **kwargs):
         """
-        Genera o edita una imagen (Image-to-Image).
-        strength: 0.0 (mismo que original) a 1.0 (cambio total).
+        Modo generador de generate_image: produce un ProgressEvent por paso
+        y termina con un evento que lleva la imagen (o el error).
+        """
+        stream = ProgressStream()
+        future = Future()
+
+        def _worker():
+            try:
+                future.set_result(self.generate_image(prompt, progress_callback=stream,
+                                                      preview_every=preview_every, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+        threading.Thread(target=_worker, name="qwen-generate-stream", daemon=True).start()
+        for event in stream.iterate(future):
+            yield event
+        if future.exception() is not None:
+            yield ProgressEvent(0, 0, 0.0, error=future.exception())
+
+    def generate_batch(self, items, steps=4, guidance_scale=0.0, resolution="1024x1024", strength=0.8):
         """
-        if self.model is None:
-            if not self.load_model():
-                raise Exception(self.error_message)
+        Genera un lote de imágenes que comparten parámetros de denoising.
+        items: lista de dicts con 'prompt', 'seed' y opcionalmente 'image_path',
+        'progress' (callback de progreso), 'preview_every' y 'cancel_token'.
+        Devuelve una lista alineada con items; los fallos aparecen como Exception.
+        """
+        if not self.residency.acquire("flux"):
+            error = Exception(self.error_message)
+            return [error] * len(items)
+
+        # mflux no expone un denoising multi-prompt: el lote se ejecuta seguido
+        # sobre el modelo ya cargado y el caché de Metal se libera una sola vez.
+        results = []
+        for item in items:
+            try:
+                # Cada elemento registra sus etapas en la traza de la petición que lo originó
+                with REGISTRY.use_trace(item.get("trace")):
+                    results.append(self._run_flux(
+                        item.get("prompt"), steps, guidance_scale, item.get("seed", -1),
+                        resolution, item.get("image_path"), strength,
+                        item.get("progress"), item.get("preview_every", 0), item.get("cancel_token")
+                    ))
+            except CancelledError as e:
+                print("Generación cancelada.")
+                results.append(e)
+            except Exception as e:
+                traceback.print_exc()
+                results.append(Exception(f"Fallo en motor de imagen: {str(e)}"))
+        self.residency.release("flux")
+        self.clear_vram()
+        return results
 
+    def generate_grid(self, prompt, seeds=(0, 1, 2, 3), guidance_values=None, steps_values=None,
+                      resolution="1024x1024", image_path=None, strength=0.8, columns=None, cancel_token=None):
+        """
+        Explora un prompt con varias semillas y/o valores de guidance y steps.
+        El prompt se codifica una sola vez (caché de embeddings) y el modelo se mantiene
+        adquirido durante toda la rejilla, así que cada variante cuesta casi solo el denoising.
+        Devuelve (hoja_de_contactos, variantes), con variantes = [(parámetros, imagen), ...].
+        """
+        seeds = list(seeds) or [-1]
+        guidance_values = list(guidance_values or [0.0])
+        steps_values = list(steps_values or [4])
+        combos = [(seed, guidance, steps) for steps in steps_values for guidance in guidance_values for seed in seeds]
+        max_variants = int(os.getenv("QWEN_GRID_MAX_VARIANTS", "16"))
+        if len(combos) > max_variants:
+            raise Exception(f"Demasiadas variantes ({len(combos)}); el máximo es {max_variants}.")
+
+        if not self.residency.acquire("flux"):
+            raise Exception(self.error_message)
+        # La imagen de entrada se normaliza una vez para todas las variantes
+        source = to_pil(image_path)
+        variants = []
         try:
-            if not prompt or not prompt.strip():
-                prompt = "A high-quality edited image, realistic, highly detailed"
+            with REGISTRY.span("grid"):
+                for seed, guidance, steps in combos:
+                    image = self._run_flux(prompt, steps, guidance, seed, resolution, source, strength,
+                                           cancel_token=cancel_token)
+                    variants.append(({"seed": image.info.get("seed", seed), "guidance": guidance, "steps": steps}, image))
+        except CancelledError:
+            print("Rejilla cancelada.")
+            raise
+        except Exception as e:
+            traceback.print_exc()
+            raise Exception(f"Fallo en motor de imagen: {str(e)}")
+        finally:
+            self.residency.release("flux")
+            self.clear_vram()
 
-            # Inversión de lógica: mflux usa strength como 'preservación'
-            # (menor valor = más cambio). Invertimos el valor del usuario.
-            mflux_strength = 1.0 - strength if image_path else None
-            
-            print(f"Procesando {'EDICIÓN' if image_path else 'GENERACIÓN'}: '{prompt}'...")
-            print(f"Parámetros: Seed={seed}, Strength_I2I={strength} (Interno: {mflux_strength})")
-            
-            width, height = map(int, resolution.split('x'))
-            final_seed = seed if seed != -1 else np.random.randint(0, 1000000)
-            
-            # Para edición (I2I), a veces necesitamos subir ligeramente los steps 
-            # para que FLUX tenga margen de maniobra con el denoising.
-            actual_steps = steps if not image_path else max(steps, 6)
+        # Solo se etiqueta lo que varía
+        labels = []
+        for params, _ in variants:
+            parts = [f"seed {params['seed']}"]
+            if len(guidance_values) > 1:
+                parts.append(f"cfg {params['guidance']:g}")
+            if len(steps_values) > 1:
+                parts.append(f"{params['steps']} steps")
+            labels.append(" · ".join(parts))
+        sheet = contact_sheet([image for _, image in variants], labels, columns=columns or len(seeds))
+        return sheet, variants
+
+    def _run_flux(self, prompt, steps, guidance_scale, seed, resolution, image_path, strength,
+                  progress_callback=None, preview_every=0, cancel_token=None):
+        """Ejecuta una pasada de FLUX sin limpiar el caché."""
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+        width, height = parse_resolution(resolution)
+        large = width * height > self.tile_size * self.tile_size
+        if large and self.tile_mode == "auto":
+            return self._run_flux_tiled(prompt, steps, guidance_scale, seed, width, height, image_path, strength,
+                                        progress_callback, preview_every, cancel_token)
+        if not prompt or not prompt.strip():
+            prompt = "A high-quality edited image, realistic, highly detailed"
+        # Clave estable para el caché de embeddings: mismas palabras, mismo prompt
+        prompt = normalize_prompt(prompt)
+
+        # La imagen de entrada viaja en memoria (PIL) salvo que llegue como ruta
+        source = to_pil(image_path)
+        is_edit = source is not None
 
-            output = self.model.generate_image(
+        # Inversión de lógica: mflux usa strength como 'preservación'
+        # (menor valor = más cambio). Invertimos el valor del usuario.
+        mflux_strength = 1.0 - strength if is_edit else None
+        
+        print(f"Procesando {'EDICIÓN' if is_edit else 'GENERACIÓN'}: '{prompt}'...")
+        print(f"Parámetros: Seed={seed}, Strength_I2I={strength} (Interno: {mflux_strength})")
+        
+        import numpy as np
+        final_seed = seed if seed != -1 else np.random.randint(0, 1000000)
+        
+        # Para edición (I2I), a veces necesitamos subir ligeramente los steps
+        # para que FLUX tenga margen de maniobra con el denoising.
+        actual_steps = schedule_steps("edit" if is_edit else "generate", steps)
+
+        tracker = None
+        if progress_callback is not None:
+            tracker = ProgressTracker(progress_callback, height, width, preview_every)
+            self.step_timer.listener = tracker.on_step
+        self.step_timer.cancel_token = cancel_token
+
+        self._set_vae_tiling(large)
+        start = time.perf_counter()
+        try:
+            output = self._call_flux(
+                source,
                 seed=final_seed,
                 prompt=prompt,
-                num_inference_steps=actual_steps if actual_steps <= 8 else 8,
+                num_inference_steps=actual_steps,
                 width=width,
                 height=height,
                 guidance=guidance_scale,
-                image_path=image_path if image_path else None,
                 image_strength=mflux_strength
             )
-            
-            self.clear_vram() # Limpiar tras generar
+        finally:
+            self.step_timer.listener = None
+            self.step_timer.cancel_token = None
+        end = time.perf_counter()
 
-            if hasattr(output, 'image'):
-                return output.image
-            else:
-                return output
-        except Exception as e:
-            traceback.print_exc()
-            raise Exception(f"Fallo en motor de imagen: {str(e)}")
+        # Repartir el tiempo con las marcas del StepTimer: preparación (latentes + texto),
+        # bucle de denoising y decodificación VAE
+        timer = self.step_timer
+        if timer.loop_start and timer.loop_end and start <= timer.loop_start <= timer.loop_end <= end:
+            REGISTRY.record("prepare", timer.loop_start - start)
+            REGISTRY.record("denoise", timer.loop_end - timer.loop_start)
+            REGISTRY.record("decode", end - timer.loop_end)
+        else:
+            REGISTRY.record("denoise", end - start)
 
-    def interrogate_image(self, image_path, query="Describe esta imagen en detalle."):
-        """Analiza una imagen usando el motor VLM."""
-        if not self.load_vlm_engine():
+        image = output.image if hasattr(output, 'image') else output
+        # Semilla efectiva, para el historial cuando se pidió aleatoria
+        image.info["seed"] = int(final_seed)
+        if tracker is not None:
+            tracker.finish(image)
+        return image
+
+    def _set_vae_tiling(self, enabled):
+        """Decodificación VAE por teselas (con mezcla de costuras de mflux) solo cuando hace falta."""
+        if not hasattr(self.model, "tiling_config"):
+            return
+        if enabled:
+            from mflux.models.common.vae.tiling_config import TilingConfig
+            self.model.tiling_config = TilingConfig()
+        else:
+            self.model.tiling_config = None
+
+    def _run_flux_tiled(self, prompt, steps, guidance_scale, seed, width, height, image_path, strength,
+                        progress_callback=None, preview_every=0, cancel_token=None):
+        """
+        Generación por teselas para resoluciones por encima de tile_size²:
+        una pasada base con la misma proporción y lado mayor tile_size, reescalado al tamaño final
+        y refinado Image-to-Image de teselas solapadas que se funden con máscaras en rampa.
+        Cada pasada de FLUX (denoising y decodificación VAE) es como mucho de tile_size px,
+        así que el pico de memoria no crece con la resolución de salida.
+        """
+        import numpy as np
+        from PIL import Image
+
+        final_seed = seed if seed != -1 else int(np.random.randint(0, 1000000))
+        base_w, base_h = base_size(width, height, self.tile_size)
+        boxes = tile_boxes(width, height, self.tile_size, self.tile_overlap)
+        phases = 1 + len(boxes)
+        start = time.perf_counter()
+        print(f"Modo por teselas: base {base_w}x{base_h} + {len(boxes)} teselas de {self.tile_size}px "
+              f"para {width}x{height}")
+
+        def phase(index):
+            # Progreso global: cada pasada ocupa una fracción igual de la barra
+            if progress_callback is None:
+                return None
+
+            def _forward(event):
+                if event.done:
+                    return
+                fraction = (index + event.fraction) / phases
+                preview = event.preview if index == 0 else None
+                progress_callback(ProgressEvent(round(fraction * 100), 100, time.perf_counter() - start, preview=preview))
+            return _forward
+
+        base = self._run_flux(prompt, steps, guidance_scale, final_seed, f"{base_w}x{base_h}", image_path, strength,
+                              phase(0), preview_every, cancel_token)
+        canvas = base.resize((width, height), Image.LANCZOS)
+        blender = TileBlender(width, height, self.tile_overlap)
+        for index, box in enumerate(boxes, start=1):
+            tile_w, tile_h = box[2] - box[0], box[3] - box[1]
+            # Cada tesela es de un solo uso: no debe desalojar latentes de la sesión de edición
+            with REGISTRY.span("tile_refine"), self.latent_cache.skip():
+                refined = self._run_flux(prompt, steps, guidance_scale, final_seed + index, f"{tile_w}x{tile_h}",
+                                         canvas.crop(box), self.tile_refine_strength, phase(index),
+                                         preview_every, cancel_token)
+            blender.add(refined, box)
+        with REGISTRY.span("tile_blend"):
+            image = blender.result()
+        image.info["seed"] = int(final_seed)
+        if progress_callback is not None:
+            progress_callback(ProgressEvent(100, 100, time.perf_counter() - start, image=image))
+        return image
+
+    def _call_flux(self, source, **kwargs):
+        """Llama a mflux con la imagen en memoria, o con un archivo temporal si la versión lo exige."""
+        # Con el caché enganchado, encode_image ya vuelca a disco lo que el cargador no admite
+        if source is None or is_path(source) or self.flux_accepts_images or self.latent_cache.installed:
+            return self.model.generate_image(image_path=source, **kwargs)
+        with spill_to_file(source) as path:
+            return self.model.generate_image(image_path=path, **kwargs)
+
+    def _vlm_source(self, image_path):
+        """
+        Imagen de entrada del VLM como PIL. Las rutas se decodifican aquí (mlx-vlm lo haría
+        igualmente) para que todas las cachés se indexen por contenido y no por una ruta
+        cuyo archivo puede cambiar.
+        """
+        with REGISTRY.span("image_preprocess"):
+            source = to_pil(image_path)
+            if is_path(source):
+                from PIL import Image
+                with Image.open(source) as img:
+                    source = img.convert("RGB")
+        return source
+
+    def interrogate_image(self, image_path, query="Describe esta imagen en detalle.", cancel_token=None,
+                          token_callback=None):
+        """
+        Analiza una imagen usando el motor VLM.
+        image_path: ruta, PIL.Image o array NumPy.
+        cancel_token: CancellationToken comprobado entre tokens generados.
+        token_callback: si se indica, recibe cada fragmento de texto según se genera.
+        Las repeticiones de (imagen, pregunta) se responden desde caché sin cargar el motor.
+        """
+        pieces = []
+        for piece in self.iter_interrogate_image(image_path, query, cancel_token):
+            pieces.append(piece)
+            if token_callback is not None:
+                token_callback(piece)
+        # Devolvemos solo el texto para evitar mostrar el objeto GenerationResult completo en la UI
+        return "".join(pieces)
+
+    def iter_interrogate_image(self, image_path, query="Describe esta imagen en detalle.", cancel_token=None,
+                               max_tokens=500):
+        """
+        Modo generador de interrogate_image: produce los fragmentos de texto según se generan
+        (como mucho max_tokens). Si el consumidor deja de iterar, la generación se aborta y el
+        motor se libera.
+        """
+        source = self._vlm_source(image_path)
+        key = image_key(source)
+        cached = self.vlm_cache.get_response(key, query)
+        if cached is not None:
+            print("Respuesta VLM servida desde caché.")
+            yield cached
+            return
+
+        if not self.residency.acquire("vlm"):
             raise Exception(self.error_message)
 
+        completed = False
+        pieces = []
         try:
+            from mlx_vlm import stream_generate
             from mlx_vlm.prompt_utils import apply_chat_template
             
             print(f"Analizando imagen: {query}...")
@@ -157,25 +728,120 @@ class QwenImageGenerator:
                 num_images=1
             )
             
-            output = generate_vlm(
-                self.vlm_model, 
-                self.vlm_processor, 
-                formatted_prompt,
-                image_path, 
-                max_tokens=500
-            )
-            
-            self.clear_vram() # Limpiar tras análisis
-            # Devolvemos solo el texto para evitar mostrar el objeto GenerationResult completo en la UI
-            return output.text
+            # Features de visión y prefijo KV reutilizados entre preguntas sobre la misma imagen
+            cache_kwargs = {}
+            state = self.vlm_cache.prefix_state(key)
+            if state is not None and self.vlm_cache.vision_cache is not None:
+                cache_kwargs = {"vision_cache": self.vlm_cache.vision_cache, "prompt_cache_state": state}
+
+            image = source
+            if not self.vlm_accepts_images:
+                # La ruta temporal no identifica el contenido: sin caché de visión
+                cache_kwargs.pop("vision_cache", None)
+            start = time.perf_counter()
+            with contextlib.ExitStack() as stack:
+                if not self.vlm_accepts_images:
+                    image = stack.enter_context(spill_to_file(source))
+                # Generación token a token: se emite cada fragmento y se comprueba la cancelación entre tokens
+                for chunk in stream_generate(
+                    self.vlm_model,
+                    self.vlm_processor,
+                    formatted_prompt,
+                    image,
+                    max_tokens=max_tokens,
+                    **cache_kwargs
+                ):
+                    if cancel_token is not None:
+                        cancel_token.raise_if_cancelled()
+                    if not pieces:
+                        REGISTRY.record("vlm_first_token", time.perf_counter() - start)
+                    pieces.append(chunk.text)
+                    yield chunk.text
+            REGISTRY.record("vlm_generate", time.perf_counter() - start)
+            completed = True
+            self.vlm_cache.account(key)
+            self.vlm_cache.put_response(key, query, "".join(pieces))
+            self.clear_vram() # Limpiar tras análisis (si hay presión de memoria)
+        except CancelledError:
+            print("Análisis cancelado.")
+            self.clear_vram()
+            raise
         except Exception as e:
             traceback.print_exc()
             raise Exception(f"Fallo en motor VLM: {str(e)}")
+        finally:
+            if not completed:
+                # Generación interrumpida (error, cancelación o consumidor que deja de iterar):
+                # el KV cache ya no corresponde a los tokens registrados
+                self.vlm_cache.discard(key)
+            self.residency.release("vlm")
+
+    def caption_batch(self, images, query="Describe esta imagen en detalle.", max_tokens=500):
+        """
+        Describe varias imágenes con una sola adquisición del VLM.
+        Usa batch_generate de mlx-vlm (prefill por lotes, agrupando imágenes del mismo tamaño)
+        cuando existe; si no, o si el lote falla, las procesa una a una.
+        Devuelve una lista alineada con images; los fallos aparecen como Exception.
+        """
+        results = [None] * len(images)
+        sources, keys = [None] * len(images), [None] * len(images)
+        for i, image in enumerate(images):
+            try:
+                sources[i] = self._vlm_source(image)
+                keys[i] = image_key(sources[i])
+            except Exception as e:
+                results[i] = Exception(f"No se pudo abrir la imagen: {e}")
+                continue
+            cached = self.vlm_cache.get_response(keys[i], query)
+            if cached is not None:
+                results[i] = cached
+        pending = [i for i, result in enumerate(results) if result is None]
+        if not pending:
+            return results
+
+        if not self.residency.acquire("vlm"):
+            error = Exception(self.error_message)
+            return [error if result is None else result for result in results]
+        try:
+            try:
+                from mlx_vlm import batch_generate
+            except ImportError:
+                batch_generate = None
+            if batch_generate is not None and len(pending) > 1 and self.vlm_accepts_images:
+                try:
+                    from mlx_vlm.prompt_utils import apply_chat_template
+                    formatted_prompt = apply_chat_template(self.vlm_processor, self.vlm_model.config, query, num_images=1)
+                    print(f"Describiendo {len(pending)} imágenes en lote...")
+                    with REGISTRY.span("vlm_batch_generate"):
+                        response = batch_generate(
+                            self.vlm_model,
+                            self.vlm_processor,
+                            images=[sources[i] for i in pending],
+                            prompts=[formatted_prompt] * len(pending),
+                            max_tokens=max_tokens,
+                        )
+                    for i, text in zip(pending, response.texts):
+                        results[i] = text
+                        self.vlm_cache.put_response(keys[i], query, text)
+                    pending = []
+                except Exception as e:
+                    print(f"Lote VLM fallido ({e}); se procesan las imágenes una a una.")
+            for i in pending:
+                try:
+                    results[i] = "".join(self.iter_interrogate_image(sources[i], query, max_tokens=max_tokens))
+                except Exception as e:
+                    results[i] = e
+            return results
+        finally:
+            self.residency.release("vlm")
+            self.clear_vram()
 
     def save_image(self, image, path):
-        """Guarda la imagen generada en el disco."""
+        """Guarda la imagen generada en el disco (formato según la extensión; PNG por defecto)."""
         try:
-            image.save(path)
+            fmt = os.path.splitext(path)[1].lstrip(".").lower()
+            with REGISTRY.span("png_save"):
+                write_image(image, path, **save_options(fmt if fmt in FORMATS else "png"))
             return True
         except Exception as e:
             print(f"Error al guardar: {e}")
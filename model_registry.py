@@ -0,0 +1,375 @@
+import os
+import json
+import time
+import fnmatch
+import hashlib
+import threading
+import urllib.parse
+import urllib.request
+import urllib.error
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+MANIFEST = "registry.json"
+CHUNK_SIZE = 1024 * 1024
+RETRIES = 3
+
+# Archivos que mflux lee de FLUX.1 (FluxWeightDefinition + tokenizers)
+FLUX_PATTERNS = [
+    "model_index.json",
+    "text_encoder/*.safetensors", "text_encoder/*.json",
+    "text_encoder_2/*.safetensors", "text_encoder_2/*.json",
+    "transformer/*.safetensors", "transformer/*.json",
+    "vae/*.safetensors", "vae/*.json",
+    "tokenizer/*", "tokenizer_2/*",
+]
+# Pesos sharded de transformers/flax/keras: los de MLX van en safetensors
+VLM_IGNORE = ["*.msgpack", "*.bin", "*.h5", "*.md", ".gitattributes"]
+
+EngineSpec = namedtuple("EngineSpec", ["repo", "directory", "patterns", "ignore"])
+RemoteFile = namedtuple("RemoteFile", ["name", "size", "sha256", "git_sha1"])
+
+DEFAULT_ENGINES = {
+    "flux": EngineSpec("black-forest-labs/FLUX.1-schnell", "FLUX.1-schnell", FLUX_PATTERNS, []),
+    "vlm": EngineSpec("mlx-community/Qwen2-VL-7B-Instruct-4bit", "Qwen-Image-2.0-7B-Instruct-MLX", ["*"], VLM_IGNORE),
+}
+
+
+def wanted(spec, name):
+    return (any(fnmatch.fnmatch(name, pattern) for pattern in spec.patterns)
+            and not any(fnmatch.fnmatch(name, pattern) for pattern in spec.ignore))
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class HubSource:
+    """
+    Origen HTTP con la API de Hugging Face (listado con tamaños y hashes, descarga con Range).
+    El endpoint puede ser un espejo local (ver serve_mirror) para trabajar sin Internet.
+    """
+
+    def __init__(self, endpoint=None, token=None, timeout=60):
+        self.endpoint = (endpoint or os.getenv("HF_ENDPOINT") or "https://huggingface.co").rstrip("/")
+        self.token = token if token is not None else os.getenv("HF_TOKEN")
+        self.timeout = timeout
+
+    def _request(self, url, headers=None):
+        headers = dict(headers or {})
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout)
+
+    def list_files(self, repo, revision="main"):
+        """(commit, [RemoteFile]) de una revisión del repositorio."""
+        url = f"{self.endpoint}/api/models/{repo}/revision/{urllib.parse.quote(revision, safe='')}?blobs=true"
+        with self._request(url) as response:
+            info = json.load(response)
+        files = []
+        for sibling in info.get("siblings", []):
+            lfs = sibling.get("lfs") or {}
+            files.append(RemoteFile(sibling["rfilename"], sibling.get("size", lfs.get("size")),
+                                    lfs.get("sha256"), None if lfs else sibling.get("blobId")))
+        return info.get("sha") or revision, files
+
+    def open(self, repo, revision, name, offset=0):
+        """(respuesta, reanudada): reanudada es False si el servidor ignoró el Range y envía el archivo entero."""
+        url = f"{self.endpoint}/{repo}/resolve/{revision}/{urllib.parse.quote(name)}"
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            response = self._request(url, headers)
+        except urllib.error.HTTPError as e:
+            if e.code == 416:
+                # Range fuera del archivo (la parte local no corresponde): se descarga de cero
+                return self._request(url), False
+            raise
+        return response, bool(offset) and response.status == 206
+
+
+class ModelRegistry:
+    """
+    Motores lógicos ("flux", "vlm") -> directorios locales bajo root, cada uno con un
+    manifest de archivos, tamaños y sha256. Con el manifest completo el motor se carga
+    del disco sin tocar la red; sin él se usa el ID del hub como hasta ahora.
+    """
+
+    def __init__(self, root=None, engines=None, source=None):
+        self.root = root or os.getenv("QWEN_MODELS_DIR", "models")
+        self.engines = dict(engines or DEFAULT_ENGINES)
+        self.source = source
+        self._lock = threading.Lock()
+
+    def register(self, engine, repo, directory=None, patterns=None, ignore=None):
+        """Asocia un motor a otro repositorio (p. ej. un ID distinto pasado al generador)."""
+        base = self.engines.get(engine, EngineSpec(repo, repo.split("/")[-1], ["*"], []))
+        if repo != base.repo and directory is None:
+            directory = repo.split("/")[-1]
+        self.engines[engine] = EngineSpec(repo, directory or base.directory,
+                                          patterns if patterns is not None else base.patterns,
+                                          ignore if ignore is not None else base.ignore)
+
+    def path(self, engine):
+        return os.path.join(self.root, self.engines[engine].directory)
+
+    def manifest(self, engine):
+        try:
+            with open(os.path.join(self.path(engine), MANIFEST), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def local_path(self, engine):
+        """Directorio del motor si su manifest está completo y los tamaños cuadran (solo stat), o None."""
+        manifest = self.manifest(engine)
+        if not manifest or not manifest.get("complete") or manifest.get("repo") != self.engines[engine].repo:
+            return None
+        base = self.path(engine)
+        for name, entry in manifest.get("files", {}).items():
+            try:
+                if os.path.getsize(os.path.join(base, name)) != entry["size"]:
+                    return None
+            except OSError:
+                return None
+        return base
+
+    def resolve(self, engine):
+        """Lo que se pasa al cargador: directorio local si está completo, o el ID del hub."""
+        return self.local_path(engine) or self.engines[engine].repo
+
+    def revision(self, engine):
+        """Commit descargado en local, o None."""
+        manifest = self.manifest(engine)
+        return manifest.get("revision") if manifest and self.local_path(engine) else None
+
+    def verify(self, engine, deep=False):
+        """
+        Lista de problemas del directorio local (vacía si está bien).
+        deep=True recalcula el sha256 de cada archivo; si no, solo se comprueban tamaños.
+        """
+        manifest = self.manifest(engine)
+        if not manifest or not manifest.get("complete"):
+            return [f"{engine}: sin descarga completa en {self.path(engine)}"]
+        problems = []
+        base = self.path(engine)
+        for name, entry in sorted(manifest.get("files", {}).items()):
+            path = os.path.join(base, name)
+            if not os.path.exists(path):
+                problems.append(f"{name}: no existe")
+            elif os.path.getsize(path) != entry["size"]:
+                problems.append(f"{name}: tamaño {os.path.getsize(path)} != {entry['size']}")
+            elif deep and file_sha256(path) != entry["sha256"]:
+                problems.append(f"{name}: sha256 no coincide")
+        return problems
+
+    def download(self, engine, revision="main", workers=4, progress=None):
+        """
+        Descarga (o completa) el motor: los archivos van en paralelo, cada uno se reanuda desde
+        su .part y se verifica con hash a medida que llega. Devuelve el directorio local.
+        progress(nombre, bytes_nuevos) se llama desde los hilos de descarga.
+        """
+        spec = self.engines[engine]
+        source = self.source or HubSource()
+        commit, remote = source.list_files(spec.repo, revision)
+        remote = [f for f in remote if wanted(spec, f.name)]
+        if not remote:
+            raise Exception(f"No hay archivos que descargar para {spec.repo} ({revision}).")
+        base = self.path(engine)
+        os.makedirs(base, exist_ok=True)
+
+        previous = self.manifest(engine) or {}
+        known = previous.get("files", {}) if previous.get("repo") == spec.repo else {}
+        same_revision = previous.get("revision") == commit
+        manifest = {"repo": spec.repo, "revision": commit, "complete": False, "files": dict(known)}
+        self._write_manifest(base, manifest)
+
+        def unchanged(remote_file):
+            # Entrada local reutilizable: mismo sha256 publicado o, sin él, misma revisión
+            entry = known.get(remote_file.name)
+            if entry is None or entry["size"] != remote_file.size:
+                return None
+            same = entry["sha256"] == remote_file.sha256 if remote_file.sha256 else same_revision
+            return entry if same else None
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="qwen-download") as pool:
+            futures = {pool.submit(self._fetch, source, spec.repo, commit, f, base, unchanged(f), progress): f
+                       for f in remote}
+            for future in as_completed(futures):
+                remote_file = futures[future]
+                try:
+                    digest = future.result()
+                except Exception as e:
+                    errors.append(f"{remote_file.name}: {e}")
+                    continue
+                with self._lock:
+                    manifest["files"][remote_file.name] = {"size": remote_file.size, "sha256": digest}
+                    self._write_manifest(base, manifest)
+        if errors:
+            raise Exception("Descarga incompleta (se reanudará en el próximo intento):\n" + "\n".join(errors))
+
+        names = {f.name for f in remote}
+        manifest["files"] = {name: entry for name, entry in manifest["files"].items() if name in names}
+        manifest["complete"] = True
+        manifest["downloaded"] = time.time()
+        self._write_manifest(base, manifest)
+        return base
+
+    def _fetch(self, source, repo, revision, remote_file, base, known, progress):
+        dest = os.path.join(base, remote_file.name)
+        # Ya descargado y sin cambios en el origen: sin releer el archivo
+        if known and os.path.exists(dest) and os.path.getsize(dest) == known["size"]:
+            return known["sha256"]
+
+        os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+        part = dest + ".part"
+        last_error = None
+        for attempt in range(RETRIES):
+            try:
+                digest = self._fetch_once(source, repo, revision, remote_file, part, progress)
+                os.replace(part, dest)
+                return digest
+            except urllib.error.HTTPError as e:
+                if e.code in (401, 403, 404):
+                    raise Exception(f"HTTP {e.code} (¿repositorio privado? define HF_TOKEN)")
+                last_error = e
+            except (urllib.error.URLError, OSError, ConnectionError, ValueError) as e:
+                last_error = e
+            time.sleep(min(2 ** attempt, 10))
+        raise Exception(f"falló tras {RETRIES} intentos: {last_error}")
+
+    def _fetch_once(self, source, repo, revision, remote_file, part, progress):
+        sha256 = hashlib.sha256()
+        git_sha1 = None
+        if remote_file.git_sha1 and remote_file.size is not None:
+            # Archivos pequeños (no LFS): el hub publica el hash de blob de git
+            git_sha1 = hashlib.sha1(f"blob {remote_file.size}\0".encode("utf-8"))
+
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if remote_file.size is not None and offset > remote_file.size:
+            offset = 0
+        if offset:
+            # Lo ya descargado entra en el hash antes de reanudar
+            with open(part, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    sha256.update(chunk)
+                    if git_sha1 is not None:
+                        git_sha1.update(chunk)
+
+        # Una parte ya completa (corte justo antes del os.replace) solo necesita verificarse
+        if remote_file.size is None or offset < remote_file.size:
+            response, resumed = source.open(repo, revision, remote_file.name, offset)
+            with response:
+                if offset and not resumed:
+                    sha256 = hashlib.sha256()
+                    if git_sha1 is not None:
+                        git_sha1 = hashlib.sha1(f"blob {remote_file.size}\0".encode("utf-8"))
+                    offset = 0
+                with open(part, "ab" if offset else "wb") as f:
+                    for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        if git_sha1 is not None:
+                            git_sha1.update(chunk)
+                        if progress is not None:
+                            progress(remote_file.name, len(chunk))
+                    f.flush()
+                    os.fsync(f.fileno())
+
+        size = os.path.getsize(part)
+        if remote_file.size is not None and size < remote_file.size:
+            # Conexión cortada: el .part se conserva y el siguiente intento reanuda
+            raise ConnectionError(f"descarga incompleta ({size} de {remote_file.size} bytes)")
+        digest = sha256.hexdigest()
+        bad = (size != remote_file.size if remote_file.size is not None else False) \
+            or (remote_file.sha256 is not None and digest != remote_file.sha256) \
+            or (git_sha1 is not None and git_sha1.hexdigest() != remote_file.git_sha1)
+        if bad:
+            # Se descarta la parte: el siguiente intento empieza de cero
+            os.remove(part)
+            raise ValueError("el contenido no coincide con el hash publicado")
+        return digest
+
+    def _write_manifest(self, base, manifest):
+        path = os.path.join(base, MANIFEST)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, path)
+
+
+def serve_mirror(directory, host="127.0.0.1", port=8765):
+    """
+    Servidor HTTP mínimo con la misma API que el hub sobre <directory>/<org>/<modelo>/...
+    Sirve de espejo en la red local y de banco de pruebas de las descargas (admite Range).
+    Devuelve el servidor ya escuchando en un hilo; server.shutdown() lo detiene.
+    """
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    root = os.path.abspath(directory)
+
+    class MirrorHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parsed = urllib.parse.urlparse(self.path)
+            parts = [urllib.parse.unquote(p) for p in parsed.path.strip("/").split("/")]
+            if len(parts) >= 6 and parts[0] == "api" and parts[1] == "models" and parts[4] == "revision":
+                return self._listing(parts[2] + "/" + parts[3])
+            if len(parts) >= 5 and parts[2] == "resolve":
+                return self._file(parts[0] + "/" + parts[1], "/".join(parts[4:]))
+            self.send_error(404)
+
+        def _repo_dir(self, repo):
+            path = os.path.abspath(os.path.join(root, repo))
+            return path if path.startswith(root + os.sep) and os.path.isdir(path) else None
+
+        def _listing(self, repo):
+            repo_dir = self._repo_dir(repo)
+            if repo_dir is None:
+                return self.send_error(404)
+            siblings = []
+            for directory, _, names in os.walk(repo_dir):
+                for name in sorted(names):
+                    full = os.path.join(directory, name)
+                    size = os.path.getsize(full)
+                    siblings.append({"rfilename": os.path.relpath(full, repo_dir).replace(os.sep, "/"),
+                                     "size": size, "lfs": {"sha256": file_sha256(full), "size": size}})
+            body = json.dumps({"sha": "mirror", "siblings": siblings}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _file(self, repo, name):
+            repo_dir = self._repo_dir(repo)
+            path = os.path.abspath(os.path.join(repo_dir, name)) if repo_dir else None
+            if path is None or not path.startswith(repo_dir + os.sep) or not os.path.isfile(path):
+                return self.send_error(404)
+            size = os.path.getsize(path)
+            start = 0
+            header = self.headers.get("Range", "")
+            if header.startswith("bytes="):
+                start = int(header[6:].split("-")[0] or 0)
+                if start >= size:
+                    return self.send_error(416)
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(size - start))
+            self.end_headers()
+            with open(path, "rb") as f:
+                f.seek(start)
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    self.wfile.write(chunk)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MirrorHandler)
+    threading.Thread(target=server.serve_forever, name="qwen-mirror", daemon=True).start()
+    return server
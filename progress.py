@@ -0,0 +1,136 @@
+import time
+import queue
+
+# Proyección lineal aproximada de los 16 canales latentes de FLUX a RGB
+# (los mismos factores que usan los previsualizadores habituales de FLUX).
+# Permite ver una preview a 1/8 de resolución sin pasar por el VAE.
+FLUX_LATENT_RGB_FACTORS = [
+    [-0.0346, 0.0244, 0.0681],
+    [0.0034, 0.0210, 0.0687],
+    [0.0275, -0.0668, -0.0433],
+    [-0.0174, 0.0160, 0.0617],
+    [0.0859, 0.0721, 0.0329],
+    [0.0004, 0.0383, 0.0115],
+    [0.0405, 0.0861, 0.0915],
+    [-0.0236, -0.0185, -0.0259],
+    [-0.0245, 0.0250, 0.1180],
+    [0.1008, 0.0755, -0.0421],
+    [-0.0515, 0.0201, 0.0011],
+    [0.0428, -0.0012, -0.0036],
+    [0.0817, 0.0765, 0.0749],
+    [-0.1264, -0.0522, -0.1103],
+    [-0.0280, -0.0881, -0.0499],
+    [-0.1262, -0.0982, -0.0778],
+]
+FLUX_LATENT_RGB_BIAS = [-0.0329, -0.0718, -0.0851]
+
+
+def latents_to_preview(latents, height, width):
+    """Preview de baja resolución (1/8) a partir de los latentes empaquetados de FLUX."""
+    import numpy as np
+    import mlx.core as mx
+    from PIL import Image
+
+    # Desempaquetar (1, h/16 * w/16, 64) -> (16, h/8, w/8), igual que FluxLatentCreator.unpack_latents
+    unpacked = mx.reshape(latents, (height // 16, width // 16, 16, 2, 2))
+    unpacked = mx.transpose(unpacked, (2, 0, 3, 1, 4))
+    unpacked = mx.reshape(unpacked, (16, height // 8, width // 8))
+    channels = np.array(unpacked.astype(mx.float32))
+
+    factors = np.asarray(FLUX_LATENT_RGB_FACTORS, dtype=np.float32)
+    bias = np.asarray(FLUX_LATENT_RGB_BIAS, dtype=np.float32)
+    rgb = np.einsum("chw,cr->hwr", channels, factors) + bias
+    rgb = np.clip((rgb + 1.0) * 127.5, 0, 255).astype(np.uint8)
+    return Image.fromarray(rgb, "RGB")
+
+
+class ProgressEvent:
+    """Estado de una generación en curso."""
+
+    def __init__(self, step, total, elapsed, preview=None, image=None, error=None):
+        self.step = step
+        self.total = total
+        self.elapsed = elapsed
+        self.preview = preview
+        self.image = image
+        self.error = error
+
+    @property
+    def eta(self):
+        if not self.step or self.step >= self.total:
+            return 0.0
+        return self.elapsed / self.step * (self.total - self.step)
+
+    @property
+    def done(self):
+        return self.image is not None or self.error is not None
+
+    @property
+    def fraction(self):
+        return self.step / self.total if self.total else 0.0
+
+    def describe(self):
+        if self.error is not None:
+            return f"Error: {self.error}"
+        if self.image is not None:
+            return f"Completado en {self.elapsed:.1f} s"
+        return f"Paso {self.step}/{self.total} · ETA {self.eta:.1f} s"
+
+
+class ProgressTracker:
+    """Convierte los pasos del bucle de denoising en ProgressEvent para un callback."""
+
+    def __init__(self, callback, height, width, preview_every=0):
+        self.callback = callback
+        self.height = height
+        self.width = width
+        self.preview_every = preview_every
+        self.start = time.perf_counter()
+        self.total = 0
+
+    def on_step(self, t, latents, config):
+        first = getattr(config, "init_time_step", 0)
+        total = config.num_inference_steps - first
+        step = t - first + 1
+        self.total = total
+        now = time.perf_counter()
+        preview = None
+        if self.preview_every and (step % self.preview_every == 0 or step == total):
+            try:
+                preview = latents_to_preview(latents, self.height, self.width)
+            except Exception as e:
+                print(f"Error al generar preview: {e}")
+        self.callback(ProgressEvent(step, total, now - self.start, preview=preview))
+
+    def finish(self, image):
+        """Evento final con la imagen decodificada."""
+        self.callback(ProgressEvent(self.total, self.total, time.perf_counter() - self.start, image=image))
+
+
+class ProgressStream:
+    """
+    Cola de eventos de progreso consumible como iterador.
+    Se pasa como callback al motor y el hilo de la UI itera sobre ella hasta que el future termina.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def __call__(self, event):
+        self._queue.put(event)
+
+    def iterate(self, future, poll=0.1, heartbeat=False):
+        """
+        Itera los eventos hasta que el future termina. Con heartbeat=True produce None
+        en cada intervalo sin eventos, para que el consumidor pueda ceder el control.
+        """
+        while True:
+            try:
+                yield self._queue.get(timeout=poll)
+            except queue.Empty:
+                if future.done():
+                    break
+                if heartbeat:
+                    yield None
+        while not self._queue.empty():
+            yield self._queue.get_nowait()
@@ -0,0 +1,212 @@
+import os
+import time
+import threading
+import traceback
+
+GB = 1024 ** 3
+CLEAR_POLICIES = ("always", "pressure", "never")
+
+
+def physical_memory_bytes():
+    """Memoria física total (unificada en Apple Silicon), o None si no se puede leer."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def mlx_memory():
+    """Devuelve (memoria activa, memoria en caché) de MLX en bytes, o (None, None)."""
+    try:
+        import mlx.core as mx
+        # Las versiones recientes exponen estas funciones en mx; las antiguas en mx.metal
+        source = mx if hasattr(mx, "get_active_memory") else mx.metal
+        return source.get_active_memory(), source.get_cache_memory()
+    except Exception:
+        return None, None
+
+
+class EngineSlot:
+    """Estado de residencia de un motor registrado."""
+
+    def __init__(self, name, loader, unloader, is_loaded, footprint):
+        self.name = name
+        self.loader = loader
+        self.unloader = unloader
+        self.is_loaded = is_loaded
+        self.footprint = footprint
+        self.in_use = 0
+        self.last_used = 0.0
+        # True mientras se ejecuta unloader(): acquire espera y vuelve a cargar
+        self.unloading = False
+
+
+class ResidencyManager:
+    """
+    Decide qué motores permanecen cargados en memoria.
+    Cada motor declara una huella estimada (recalibrada al medir la carga real);
+    si cargar uno supera el presupuesto se descarga el menos usado recientemente,
+    y los motores ociosos más de idle_timeout segundos se descargan solos.
+    """
+
+    def __init__(self, memory_budget=None, idle_timeout=900, clear_policy="pressure", pressure_ratio=0.9):
+        if clear_policy not in CLEAR_POLICIES:
+            raise Exception(f"Política de limpieza desconocida: {clear_policy}")
+        if memory_budget is None:
+            total = physical_memory_bytes()
+            memory_budget = int(total * 0.75) if total else 16 * GB
+        self.memory_budget = memory_budget
+        self.idle_timeout = idle_timeout
+        self.clear_policy = clear_policy
+        self.pressure_ratio = pressure_ratio
+        self.slots = {}
+        self._lock = threading.Lock()
+        self._unloaded = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._reaper = None
+        if idle_timeout:
+            self._reaper = threading.Thread(target=self._reap_idle, name="qwen-residency", daemon=True)
+            self._reaper.start()
+
+    def register(self, name, loader, unloader, is_loaded, footprint):
+        """Registra un motor. loader() devuelve True si la carga tuvo éxito."""
+        with self._lock:
+            self.slots[name] = EngineSlot(name, loader, unloader, is_loaded, footprint)
+
+    def acquire(self, name):
+        """Garantiza que el motor está cargado y lo marca en uso. Devuelve False si falla la carga."""
+        slot = self.slots[name]
+        with self._lock:
+            # Una descarga en curso terminará dejando el motor sin modelo: esperarla y recargar
+            while slot.unloading:
+                self._unloaded.wait()
+            slot.in_use += 1
+            slot.last_used = time.monotonic()
+            needs_load = not slot.is_loaded()
+            if needs_load:
+                victims = self._select_victims(slot)
+        if not needs_load:
+            return True
+
+        for victim in victims:
+            self._unload(victim)
+
+        before, _ = mlx_memory()
+        ok = False
+        try:
+            ok = bool(slot.loader())
+        except Exception:
+            traceback.print_exc()
+        if not ok:
+            self.release(name)
+            return False
+
+        after, _ = mlx_memory()
+        if before is not None and after is not None and after > before:
+            # Calibrar con lo que realmente ocupó la carga
+            slot.footprint = after - before
+        return True
+
+    def release(self, name):
+        slot = self.slots[name]
+        with self._lock:
+            slot.in_use = max(0, slot.in_use - 1)
+            slot.last_used = time.monotonic()
+
+    def prewarm(self, names, background=True):
+        """Carga los motores indicados por adelantado (por defecto en segundo plano)."""
+        def _run():
+            for name in names:
+                print(f"Precargando motor {name}...")
+                if self.acquire(name):
+                    self.release(name)
+
+        if not background:
+            _run()
+            return None
+        thread = threading.Thread(target=_run, name="qwen-prewarm", daemon=True)
+        thread.start()
+        return thread
+
+    def unload(self, name):
+        """Descarga un motor si está cargado y no se está usando."""
+        return self._unload(self.slots[name])
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(s.footprint for s in self.slots.values() if s.is_loaded())
+
+    def should_clear_cache(self):
+        """Indica si conviene vaciar el caché del asignador de Metal tras una petición."""
+        if self.clear_policy == "always":
+            return True
+        if self.clear_policy == "never":
+            return False
+        active, cache = mlx_memory()
+        if active is None:
+            return True
+        return active + cache > self.memory_budget * self.pressure_ratio
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {
+                    "loaded": slot.is_loaded(),
+                    "in_use": slot.in_use,
+                    "footprint": slot.footprint,
+                    "idle_seconds": time.monotonic() - slot.last_used if slot.last_used else None,
+                }
+                for name, slot in self.slots.items()
+            }
+
+    def shutdown(self):
+        self._stop.set()
+
+    def _select_victims(self, incoming):
+        """Motores a descargar (LRU) para que quepa incoming. Se llama con el lock tomado."""
+        loaded = [s for s in self.slots.values() if s is not incoming and s.is_loaded()]
+        resident = sum(s.footprint for s in loaded)
+        victims = []
+        for slot in sorted(loaded, key=lambda s: s.last_used):
+            if resident + incoming.footprint <= self.memory_budget:
+                break
+            if slot.in_use:
+                continue
+            victims.append(slot)
+            resident -= slot.footprint
+        if resident + incoming.footprint > self.memory_budget:
+            print(f"Aviso: cargar {incoming.name} supera el presupuesto de memoria "
+                  f"({(resident + incoming.footprint) / GB:.1f} GB > {self.memory_budget / GB:.1f} GB).")
+        return victims
+
+    def _unload(self, slot):
+        # Volver a comprobar: otro hilo puede haber empezado a usarlo desde que se eligió.
+        # unloading se marca con el lock tomado, así que ningún acquire se cuela durante la descarga.
+        with self._lock:
+            if slot.in_use or slot.unloading or not slot.is_loaded():
+                return False
+            slot.unloading = True
+        print(f"Descargando motor {slot.name} para liberar memoria...")
+        try:
+            slot.unloader()
+        except Exception:
+            traceback.print_exc()
+            return False
+        finally:
+            with self._lock:
+                slot.unloading = False
+                self._unloaded.notify_all()
+        return True
+
+    def _reap_idle(self):
+        interval = min(60, max(1, self.idle_timeout / 4))
+        while not self._stop.wait(interval):
+            now = time.monotonic()
+            with self._lock:
+                idle = [
+                    s for s in self.slots.values()
+                    if s.is_loaded() and not s.in_use and s.last_used and now - s.last_used > self.idle_timeout
+                ]
+            for slot in idle:
+                print(f"Motor {slot.name} inactivo más de {self.idle_timeout}s.")
+                self.unload(slot.name)
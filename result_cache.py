@@ -0,0 +1,147 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    Caché en disco direccionado por contenido para generaciones y ediciones.
+    La clave es un hash de todos los parámetros más los bytes de la imagen de entrada;
+    las entradas se desalojan por LRU cuando se supera el presupuesto de bytes.
+    """
+
+    def __init__(self, cache_dir="outputs/cache", max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.entries = OrderedDict() # clave -> tamaño en bytes, de menos a más reciente
+        self.extensions = {} # clave -> extensión del archivo (el formato de salida es configurable)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def make_key(mode, input_image=None, **params):
+        """
+        Calcula la clave de una petición. Devuelve None si no es cacheable
+        (semilla aleatoria: el resultado no es reproducible).
+        """
+        if int(params.get("seed", -1)) == -1:
+            return None
+        h = hashlib.sha256()
+        h.update(json.dumps({"mode": mode, **params}, sort_keys=True, default=str).encode("utf-8"))
+        if input_image is not None:
+            # Bytes crudos de los píxeles: evita codificar a PNG solo para calcular el hash
+            h.update(f"{input_image.mode}:{input_image.size}".encode("utf-8"))
+            h.update(input_image.tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        """Devuelve la ruta de la imagen cacheada o None."""
+        if key is None:
+            return None
+        with self._lock:
+            path = self._path(key)
+            if key in self.entries and os.path.exists(path):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return path
+            if key in self.entries:
+                # El archivo desapareció del disco: olvidar la entrada
+                self.total_bytes -= self.entries.pop(key)
+                self.extensions.pop(key, None)
+            self.misses += 1
+            return None
+
+    def put(self, key, source_path):
+        """Registra en el caché la imagen ya guardada en source_path (PNG, WebP o JPEG)."""
+        if key is None or not os.path.exists(source_path):
+            return None
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self._path(key)
+            # La entrada conserva la extensión del archivo enlazado
+            self.extensions[key] = os.path.splitext(source_path)[1].lower() or ".png"
+            path = self._path(key)
+            try:
+                # Enlace duro cuando es posible: no duplica bytes en disco
+                os.link(source_path, path)
+            except OSError:
+                shutil.copyfile(source_path, path)
+            size = os.path.getsize(path)
+            self.entries[key] = size
+            self.total_bytes += size
+            self._evict()
+            self._save_index()
+            return path
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            for key in list(self.entries):
+                self._remove(key)
+            self._save_index()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.extensions.get(key, ".png"))
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+
+    def _remove(self, key):
+        path = self._path(key)
+        self.total_bytes -= self.entries.pop(key)
+        self.extensions.pop(key, None)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        # Índices antiguos: lista de claves, todas PNG
+        if isinstance(saved, list):
+            saved = {key: ".png" for key in saved}
+        for key, extension in saved.items():
+            self.extensions[key] = extension
+            path = self._path(key)
+            if os.path.exists(path):
+                size = os.path.getsize(path)
+                self.entries[key] = size
+                self.total_bytes += size
+            else:
+                self.extensions.pop(key, None)
+        self._evict()
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({key: self.extensions.get(key, ".png") for key in self.entries}, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f"Error al guardar índice del caché: {e}")
@@ -0,0 +1,413 @@
+import threading
+import time
+import uuid
+import traceback
+import hashlib
+from concurrent.futures import Future
+from metrics import REGISTRY
+from progress import ProgressEvent
+from cancellation import CancellationToken, CancelledError
+from tiling import parse_resolution, format_resolution
+
+MODES = ("generate", "edit", "analyze")
+# Un carril por motor: con motores en procesos separados, el análisis (VLM) no espera
+# a que termine una generación (FLUX) y viceversa
+ENGINE_LANES = {"flux": ("generate", "edit"), "vlm": ("analyze",)}
+
+
+class Job:
+    """Petición individual encolada en el planificador."""
+
+    def __init__(self, mode, prompt=None, steps=4, guidance_scale=0.0, seed=-1, resolution="1024x1024",
+                 image_path=None, strength=0.8, query=None, progress_callback=None, preview_every=0):
+        # progress_callback recibe ProgressEvent en generación/edición y fragmentos de texto en análisis
+        if mode not in MODES:
+            raise Exception(f"Modo de trabajo desconocido: {mode}")
+        self.job_id = uuid.uuid4().hex
+        self.mode = mode
+        self.prompt = prompt
+        self.steps = int(steps)
+        self.guidance_scale = float(guidance_scale)
+        self.seed = int(seed)
+        # Forma canónica: "2048x2048 (2K)" y "2048x2048" comparten lote
+        self.resolution = format_resolution(resolution)
+        self.image_path = image_path
+        self.strength = float(strength)
+        self.query = query
+        self.progress_callback = progress_callback
+        self.preview_every = preview_every
+        self.status = "queued"
+        # Decisión y coste estimado del control de admisión (None sin controlador)
+        self.admission = None
+        self.estimate = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = Future()
+        self.cancel_token = CancellationToken()
+        # Traza de métricas de la petición que encoló el trabajo (si la hay)
+        self.trace = REGISTRY.current_trace()
+
+    def batch_key(self):
+        """Clave de agrupación: solo se agrupan trabajos que comparten una pasada de denoising."""
+        if self.mode == "analyze":
+            return ("analyze",)
+        # En edición la fuerza determina el paso inicial del scheduler, así que también debe coincidir
+        strength = self.strength if self.mode == "edit" else None
+        return (self.resolution, self.steps, self.guidance_scale, self.mode, strength)
+
+
+class SchedulerBackend:
+    """
+    Interfaz de motor para el planificador.
+    run_batch recibe trabajos con la misma clave y devuelve un resultado por trabajo
+    (una instancia de Exception en la posición de los que fallen).
+    """
+
+    def run_batch(self, jobs):
+        raise NotImplementedError
+
+
+class GeneratorBackend(SchedulerBackend):
+    """Motor real: delega en QwenImageGenerator."""
+
+    def __init__(self, generator):
+        self.generator = generator
+
+    def run_batch(self, jobs):
+        # El pico se mide en el hilo del motor, alrededor del lote que se ejecuta de verdad
+        with REGISTRY.measure_peak([job.trace for job in jobs]):
+            return self._run_batch(jobs)
+
+    def _run_batch(self, jobs):
+        first = jobs[0]
+        if first.mode == "analyze":
+            results = []
+            for job in jobs:
+                try:
+                    with REGISTRY.use_trace(job.trace):
+                        results.append(self.generator.interrogate_image(job.image_path, job.query,
+                                                                        cancel_token=job.cancel_token,
+                                                                        token_callback=job.progress_callback))
+                except Exception as e:
+                    results.append(e)
+            return results
+
+        items = [
+            {"prompt": job.prompt, "seed": job.seed, "image_path": job.image_path, "trace": job.trace,
+             "progress": job.progress_callback, "preview_every": job.preview_every,
+             "cancel_token": job.cancel_token}
+            for job in jobs
+        ]
+        return self.generator.generate_batch(
+            items,
+            steps=first.steps,
+            guidance_scale=first.guidance_scale,
+            resolution=first.resolution,
+            strength=first.strength,
+        )
+
+
+class StubBackend(SchedulerBackend):
+    """
+    Motor de CPU sin mflux, para probar la lógica de lotes sin GPU.
+    Con cost_model, cada trabajo del lote tarda lo que predice el modelo de costes (por time_scale),
+    como el motor real que los ejecuta seguidos, y peak_memory recoge el mayor pico sintético.
+    """
+
+    def __init__(self, step_time=0.0, cost_model=None, time_scale=1.0):
+        self.step_time = step_time
+        self.cost_model = cost_model
+        self.time_scale = time_scale
+        self.peak_memory = 0
+        self.batches = []
+
+    def _step_time(self, job, count):
+        """Pausa por paso (o por palabra): fija, o el coste sintético repartido en count tramos."""
+        if self.cost_model is None:
+            return self.step_time
+        cost = self.cost_model.predict(job.mode, job.resolution, job.steps, job.strength)
+        self.peak_memory = max(self.peak_memory, cost.memory_bytes)
+        return cost.seconds * self.time_scale / max(1, count)
+
+    def run_batch(self, jobs):
+        from PIL import Image
+
+        self.batches.append([job.job_id for job in jobs])
+        first = jobs[0]
+        if first.mode == "analyze":
+            results = []
+            for job in jobs:
+                text = f"Descripción simulada: {job.query}"
+                words = text.split(" ")
+                delay = self._step_time(job, len(words))
+                # Emite la respuesta palabra a palabra, como el streaming del VLM
+                for word in words:
+                    time.sleep(delay)
+                    if job.progress_callback is not None:
+                        job.progress_callback(word + " ")
+                results.append(text)
+            return results
+
+        # Una sola "pasada" por lote, como haría un denoising batched real
+        delay = self._step_time(first, first.steps) * (len(jobs) if self.cost_model is not None else 1)
+        start = time.perf_counter()
+        for step in range(1, first.steps + 1):
+            time.sleep(delay)
+            for job in jobs:
+                if job.cancel_token.cancelled:
+                    continue
+                if job.progress_callback is not None:
+                    job.progress_callback(ProgressEvent(step, first.steps, time.perf_counter() - start))
+        width, height = parse_resolution(first.resolution)
+        results = []
+        for job in jobs:
+            if job.cancel_token.cancelled:
+                results.append(CancelledError(job.cancel_token.reason))
+                continue
+            digest = hashlib.sha256(f"{job.prompt}|{job.seed}".encode("utf-8")).digest()
+            image = Image.new("RGB", (width, height), tuple(digest[:3]))
+            if job.progress_callback is not None:
+                job.progress_callback(ProgressEvent(first.steps, first.steps, time.perf_counter() - start, image=image))
+            results.append(image)
+        return results
+
+
+class RequestScheduler:
+    """
+    Cola acotada de peticiones delante del generador.
+    Un único hilo consume la cola y agrupa los trabajos pendientes con la misma
+    (resolución, steps, guidance, modo) en un solo lote.
+    Con un AdmissionController, cada trabajo se evalúa al encolarlo frente al trabajo
+    ya comprometido (cola + lote en curso) y se admite, se rebaja o se rechaza.
+    lanes ({carril: modos}) reparte los modos en carriles con su propio hilo consumidor
+    (p. ej. ENGINE_LANES, si el backend ejecuta cada motor por separado); por defecto
+    hay un único carril para todos los modos.
+    """
+
+    def __init__(self, backend, max_queue=32, max_batch_size=4, batch_window=0.05, admission=None, lanes=None):
+        self.backend = backend
+        self.max_queue = max_queue
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.admission = admission
+        self.lanes = lanes or {"engine": MODES}
+        self._pending = []
+        self._active = {lane: [] for lane in self.lanes}
+        self._active_started = {lane: 0.0 for lane in self.lanes}
+        self._jobs = {}
+        self._cond = threading.Condition()
+        self._running = True
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "cancelled": 0, "batches": 0,
+                      "rejected": 0, "downgraded": 0}
+        self._workers = []
+        for lane in self.lanes:
+            name = "qwen-scheduler" if len(self.lanes) == 1 else f"qwen-scheduler-{lane}"
+            worker = threading.Thread(target=self._loop, args=(lane,), name=name, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def lane_of(self, mode):
+        for lane, modes in self.lanes.items():
+            if mode in modes:
+                return lane
+        raise Exception(f"Ningún carril del planificador atiende el modo {mode}")
+
+    def submit(self, mode, prompt=None, **params):
+        """Encola un trabajo y devuelve el Job (con su future) sin bloquear."""
+        job = Job(mode, prompt, **params)
+        self.lane_of(job.mode)
+        with self._cond:
+            if not self._running:
+                raise Exception("El planificador está detenido.")
+            if len(self._pending) >= self.max_queue:
+                raise Exception("Servidor ocupado: la cola de peticiones está llena, inténtalo de nuevo en unos segundos.")
+            if self.admission is not None:
+                self._admit(job)
+            self._pending.append(job)
+            self._jobs[job.job_id] = job
+            self.stats["submitted"] += 1
+            self._cond.notify_all()
+        return job
+
+    def _admit(self, job):
+        """Aplica el control de admisión (con el lock tomado); lanza Exception si se rechaza."""
+        lane = self.lane_of(job.mode)
+        decision = self.admission.decide(job, self._backlog_seconds(lane), self._reserved_memory(lane))
+        if decision.action == "reject":
+            self.stats["rejected"] += 1
+            raise Exception(decision.reason)
+        if decision.action == "downgrade":
+            self.stats["downgraded"] += 1
+            print(f"Admisión: {decision.reason}")
+            job.resolution = decision.resolution
+            job.steps = decision.steps
+        if job.trace is not None:
+            # La traza describe lo que se ejecuta de verdad: así calibra bien el modelo de costes
+            job.trace.attrs.update(admission=decision.action, resolution=job.resolution, steps=job.steps)
+        job.admission = decision
+        job.estimate = decision.cost
+
+    def _backlog_seconds(self, lane):
+        """
+        Segundos estimados de trabajo comprometido en un carril: su cola pendiente más lo
+        que le queda a su lote en curso (los demás carriles avanzan en paralelo).
+        """
+        modes = self.lanes[lane]
+        backlog = sum(job.estimate.seconds for job in self._pending
+                      if job.estimate is not None and job.mode in modes)
+        active = self._active[lane]
+        if active:
+            # El motor ejecuta los elementos del lote uno tras otro sobre el modelo cargado
+            batch_seconds = sum(job.estimate.seconds for job in active if job.estimate is not None)
+            backlog += max(0.0, batch_seconds - (time.perf_counter() - self._active_started[lane]))
+        return backlog
+
+    def _reserved_memory(self, lane):
+        """
+        Memoria estimada de los lotes en curso en los demás carriles, que se ejecutan a la vez.
+        Cada carril ejecuta su lote elemento a elemento: su pico es el del trabajo mayor.
+        """
+        reserved = 0
+        for other, active in self._active.items():
+            if other != lane:
+                reserved += max((job.estimate.memory_bytes for job in active if job.estimate is not None), default=0)
+        return reserved
+
+    def run(self, mode, prompt=None, timeout=None, **params):
+        """Encola un trabajo y espera su resultado."""
+        return self.submit(mode, prompt, **params).future.result(timeout=timeout)
+
+    def get_job(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id, reason="Petición cancelada."):
+        """
+        Cancela un trabajo: si sigue en cola se retira sin ejecutarse; si está en curso
+        se activa su token y el motor aborta en el siguiente paso o token.
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return False
+            queued = job in self._pending
+            if queued:
+                self._pending.remove(job)
+        job.cancel_token.cancel(reason)
+        if queued:
+            self._finish(job, CancelledError(reason))
+        return True
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._pending)
+
+    def shutdown(self, wait=True):
+        """Detiene los hilos consumidores y falla los trabajos que sigan en cola."""
+        with self._cond:
+            self._running = False
+            pending, self._pending = self._pending, []
+            self._cond.notify_all()
+        for job in pending:
+            self._finish(job, Exception("El planificador se ha detenido."))
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def _next_batch(self, lane):
+        modes = self.lanes[lane]
+        with self._cond:
+            while self._running and not any(job.mode in modes for job in self._pending):
+                self._cond.wait()
+            queued = [job for job in self._pending if job.mode in modes]
+            if not queued:
+                return None
+
+            # Ventana corta para dejar que lleguen más trabajos compatibles
+            key = queued[0].batch_key()
+            deadline = time.monotonic() + self.batch_window
+            while self._running:
+                matching = sum(1 for job in self._pending if job.batch_key() == key)
+                remaining = deadline - time.monotonic()
+                if matching >= self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch, rest = [], []
+            for job in self._pending:
+                if len(batch) < self.max_batch_size and job.batch_key() == key:
+                    batch.append(job)
+                else:
+                    rest.append(job)
+            self._pending = rest
+            return batch
+
+    def _loop(self, lane):
+        while True:
+            batch = self._next_batch(lane)
+            if batch is None:
+                break
+            batch = [job for job in batch if job.future.set_running_or_notify_cancel()]
+            # Cancelados entre la extracción de la cola y el arranque: no gastar cómputo en ellos
+            for job in [job for job in batch if job.cancel_token.cancelled]:
+                self._finish(job, CancelledError(job.cancel_token.reason))
+            batch = [job for job in batch if not job.cancel_token.cancelled]
+            if not batch:
+                continue
+
+            for job in batch:
+                job.status = "running"
+                job.started_at = time.time()
+                with REGISTRY.use_trace(job.trace):
+                    REGISTRY.record("queue_wait", job.started_at - job.submitted_at)
+            print(f"Planificador: lote de {len(batch)} trabajo(s) {batch[0].batch_key()}")
+            started = time.perf_counter()
+            with self._cond:
+                self._active[lane] = batch
+                self._active_started[lane] = started
+            try:
+                results = self.backend.run_batch(batch)
+            except Exception as e:
+                traceback.print_exc()
+                results = [e] * len(batch)
+            elapsed = time.perf_counter() - started
+
+            with self._cond:
+                self._active[lane] = []
+                self.stats["batches"] += 1
+            self._observe(batch, results, elapsed)
+            for job, result in zip(batch, results):
+                self._finish(job, result)
+
+    def _observe(self, batch, results, elapsed):
+        """Recalibra el modelo de costes con la duración real del lote (solo si todo fue bien)."""
+        if self.admission is None or any(isinstance(result, Exception) for result in results):
+            return
+        first = batch[0]
+        # La carga del modelo es un coste puntual, no del trabajo
+        loading = sum(seconds for job in batch if job.trace is not None
+                      for stage, seconds in job.trace.spans if stage == "model_load")
+        try:
+            self.admission.cost_model.observe(first.mode, first.resolution, first.steps, first.strength,
+                                              seconds=(elapsed - loading) / len(batch))
+        except Exception as e:
+            print(f"Aviso: no se pudo recalibrar el modelo de costes: {e}")
+
+    def _finish(self, job, result):
+        job.finished_at = time.time()
+        with self._cond:
+            self._jobs.pop(job.job_id, None)
+            if isinstance(result, CancelledError):
+                self.stats["cancelled"] += 1
+            elif isinstance(result, Exception):
+                self.stats["failed"] += 1
+            else:
+                self.stats["completed"] += 1
+        if isinstance(result, Exception):
+            job.status = "cancelled" if isinstance(result, CancelledError) else "error"
+            if not job.future.done():
+                job.future.set_exception(result)
+        else:
+            job.status = "done"
+            job.future.set_result(result)
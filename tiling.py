@@ -0,0 +1,136 @@
+import re
+
+RESOLUTION_RE = re.compile(r"^\s*(\d+)\s*[x×X*]\s*(\d+)")
+# Etiquetas sueltas admitidas además de "AnchoxAlto"
+RESOLUTION_ALIASES = {"1k": (1024, 1024), "2k": (2048, 2048), "4k": (4096, 4096)}
+
+# FLUX trabaja con latentes a 1/8 empaquetados de 2x2: las dimensiones deben ser múltiplos de 16
+MULTIPLE = 16
+MAX_SIDE = 4096
+# FLUX.1-schnell: como mucho 8 pasos; la edición pide al menos 6 para tener margen de denoising
+MAX_STEPS = 8
+MIN_EDIT_STEPS = 6
+
+
+def parse_resolution(value):
+    """
+    Convierte "1024x768", "2048x2048 (2K)", "1536 × 1024" o "2K" en (ancho, alto),
+    redondeando a múltiplos de 16. Lanza Exception si el texto no es una resolución válida.
+    """
+    if isinstance(value, (tuple, list)) and len(value) == 2:
+        width, height = int(value[0]), int(value[1])
+    else:
+        text = str(value).strip()
+        match = RESOLUTION_RE.match(text)
+        if match:
+            width, height = int(match.group(1)), int(match.group(2))
+        elif text.lower() in RESOLUTION_ALIASES:
+            width, height = RESOLUTION_ALIASES[text.lower()]
+        else:
+            raise Exception(f"Resolución no válida: '{value}' (usa el formato 1024x1024)")
+    width = max(MULTIPLE, round(width / MULTIPLE) * MULTIPLE)
+    height = max(MULTIPLE, round(height / MULTIPLE) * MULTIPLE)
+    if width > MAX_SIDE or height > MAX_SIDE:
+        raise Exception(f"Resolución demasiado grande: {width}x{height} (máximo {MAX_SIDE} por lado)")
+    return width, height
+
+
+def format_resolution(value):
+    """Forma canónica "AnchoxAlto" de cualquier resolución aceptada por parse_resolution."""
+    width, height = parse_resolution(value)
+    return f"{width}x{height}"
+
+
+def schedule_steps(mode, steps):
+    """Pasos del schedule que se piden a mflux (num_inference_steps) para generate o edit."""
+    if mode == "edit":
+        steps = max(steps, MIN_EDIT_STEPS)
+    return min(steps, MAX_STEPS)
+
+
+def effective_steps(mode, steps, strength=0.8):
+    """
+    Pasos de denoising que recorre realmente FLUX. En edición mflux arranca en
+    init_time_step = max(1, int(n * image_strength)), con image_strength = 1 - strength.
+    """
+    total = schedule_steps(mode, steps)
+    if mode != "edit":
+        return total
+    preserve = max(0.0, min(1.0, 1.0 - strength))
+    if preserve <= 0.0:
+        return total
+    return total - max(1, int(total * preserve))
+
+
+def base_size(width, height, tile_size):
+    """Tamaño de la pasada base: misma proporción con el lado mayor igual a tile_size."""
+    scale = tile_size / max(width, height)
+    return (max(MULTIPLE, round(width * scale / MULTIPLE) * MULTIPLE),
+            max(MULTIPLE, round(height * scale / MULTIPLE) * MULTIPLE))
+
+
+def _positions(length, tile, overlap):
+    if length <= tile:
+        return [0]
+    # Mínimo de teselas con al menos `overlap` de solape, repartidas de forma uniforme
+    # (la última queda alineada con el borde)
+    count = -(-(length - overlap) // (tile - overlap))
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+
+def tile_boxes(width, height, tile_size=1024, overlap=128):
+    """Cajas (izq, arriba, der, abajo) de teselas solapadas que cubren todo el lienzo."""
+    tile_w, tile_h = min(tile_size, width), min(tile_size, height)
+    return [(x, y, x + tile_w, y + tile_h)
+            for y in _positions(height, tile_h, overlap)
+            for x in _positions(width, tile_w, overlap)]
+
+
+def feather_mask(tile_w, tile_h, overlap, box, width, height):
+    """
+    Peso de mezcla de una tesela: rampa lineal en los bordes que se solapan con vecinas
+    y 1.0 en los bordes del lienzo, para que las costuras se fundan sin oscurecer los márgenes.
+    """
+    import numpy as np
+
+    def ramp(size, at_start, at_end):
+        weights = np.ones(size, dtype=np.float32)
+        fade = min(overlap, size // 2)
+        if fade > 0:
+            steps = (np.arange(fade, dtype=np.float32) + 1.0) / (fade + 1.0)
+            if not at_start:
+                weights[:fade] = steps
+            if not at_end:
+                weights[-fade:] = steps[::-1]
+        return weights
+
+    left, top, right, bottom = box
+    wx = ramp(tile_w, left == 0, right >= width)
+    wy = ramp(tile_h, top == 0, bottom >= height)
+    return np.outer(wy, wx)[:, :, None]
+
+
+class TileBlender:
+    """Acumula teselas RGB ponderadas por su máscara y compone la imagen final."""
+
+    def __init__(self, width, height, overlap):
+        import numpy as np
+        self.width = width
+        self.height = height
+        self.overlap = overlap
+        self.accum = np.zeros((height, width, 3), dtype=np.float32)
+        self.weights = np.zeros((height, width, 1), dtype=np.float32)
+
+    def add(self, tile, box):
+        import numpy as np
+        left, top, right, bottom = box
+        pixels = np.asarray(tile.convert("RGB"), dtype=np.float32)
+        mask = feather_mask(right - left, bottom - top, self.overlap, box, self.width, self.height)
+        self.accum[top:bottom, left:right] += pixels * mask
+        self.weights[top:bottom, left:right] += mask
+
+    def result(self):
+        import numpy as np
+        from PIL import Image
+        pixels = self.accum / np.maximum(self.weights, 1e-6)
+        return Image.fromarray(np.clip(pixels + 0.5, 0, 255).astype(np.uint8), "RGB")
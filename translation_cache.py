@@ -0,0 +1,175 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+import unicodedata
+
+# Palabras muy frecuentes para una detección de idioma barata (sin red ni modelos)
+ENGLISH_STOPWORDS = {
+    "a", "an", "the", "of", "and", "in", "on", "with", "at", "by", "for", "to", "is", "are",
+    "from", "its", "his", "her", "their", "this", "that", "wearing", "under", "over", "while",
+}
+SPANISH_STOPWORDS = {
+    "un", "una", "unos", "unas", "el", "la", "los", "las", "de", "del", "y", "en", "con", "por",
+    "para", "que", "es", "son", "al", "su", "sus", "sobre", "bajo", "mientras", "muy", "lleva",
+}
+WORD_RE = re.compile(r"[^\W\d_]+", re.UNICODE)
+
+
+def normalize_prompt(text):
+    """Normaliza el texto para usarlo como clave: NFC, sin espacios sobrantes."""
+    text = unicodedata.normalize("NFC", text)
+    return " ".join(text.split())
+
+
+def looks_english(text):
+    """
+    Pre-chequeo barato de idioma. Cualquier carácter no ASCII (tildes, ñ, ¿, ¡)
+    implica traducir; un texto ASCII solo se da por inglés si hay más palabras
+    funcionales en inglés que en español. Sin pruebas ("perro rojo") se traduce:
+    la interfaz espera español y el resultado queda en la memoria igualmente.
+    """
+    if not text.isascii():
+        return False
+    words = [w.lower() for w in WORD_RE.findall(text)]
+    if not words:
+        return True
+    english = sum(1 for w in words if w in ENGLISH_STOPWORDS)
+    spanish = sum(1 for w in words if w in SPANISH_STOPWORDS)
+    return english > spanish
+
+
+class TranslatorBackend:
+    """Interfaz de traductor. translate_batch traduce varios textos en una sola llamada."""
+
+    def translate(self, text):
+        raise NotImplementedError
+
+    def translate_batch(self, texts):
+        return [self.translate(text) for text in texts]
+
+
+class GoogleTranslatorBackend(TranslatorBackend):
+    """Traductor por defecto vía deep_translator (requiere red)."""
+
+    def __init__(self, source="auto", target="en"):
+        from deep_translator import GoogleTranslator
+        self.translator = GoogleTranslator(source=source, target=target)
+
+    def translate(self, text):
+        return self.translator.translate(text)
+
+    def translate_batch(self, texts):
+        return self.translator.translate_batch(list(texts))
+
+
+class DictTranslatorBackend(TranslatorBackend):
+    """Traductor local de sustitución (tests, modo sin conexión)."""
+
+    def __init__(self, table=None):
+        self.table = dict(table or {})
+        self.calls = 0
+
+    def translate(self, text):
+        self.calls += 1
+        return self.table.get(text, text)
+
+    def translate_batch(self, texts):
+        self.calls += 1
+        return [self.table.get(text, text) for text in texts]
+
+
+class TranslationMemo:
+    """
+    Memoria de traducción persistente en SQLite delante de un TranslatorBackend.
+    Solo se consulta al backend por textos no vistos que no parezcan ya inglés.
+    """
+
+    def __init__(self, db_path="outputs/cache/translations.sqlite3", backend=None):
+        self.db_path = db_path
+        self._backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            "source TEXT PRIMARY KEY, target TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    @property
+    def backend(self):
+        # Creación diferida: no tocar deep_translator hasta la primera traducción real
+        if self._backend is None:
+            self._backend = GoogleTranslatorBackend()
+        return self._backend
+
+    def translate(self, text):
+        """Traduce un texto usando la memoria; ante un fallo devuelve el original."""
+        return self.translate_batch([text])[0]
+
+    def translate_batch(self, texts):
+        """Traduce muchos textos con una sola llamada al backend para los no cacheados."""
+        results = list(texts)
+        pending = {}
+        for i, text in enumerate(texts):
+            if not text or not text.strip():
+                continue
+            key = normalize_prompt(text)
+            if looks_english(key):
+                with self._lock:
+                    self.skipped += 1
+                results[i] = key
+                continue
+            cached = self._lookup(key)
+            if cached is not None:
+                results[i] = cached
+                continue
+            pending.setdefault(key, []).append(i)
+
+        if not pending:
+            return results
+
+        sources = list(pending)
+        with self._lock:
+            self.misses += len(sources)
+        try:
+            translated = self.backend.translate_batch(sources)
+        except Exception as e:
+            # Sin conexión: se devuelve el texto original y no se memoriza nada
+            print(f"Error en traducción: {e}")
+            return results
+
+        rows = []
+        for source, target in zip(sources, translated):
+            if not target:
+                continue
+            rows.append((source, target, time.time()))
+            for i in pending[source]:
+                results[i] = target
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO translations VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+        return results
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "skipped": self.skipped, "entries": entries}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _lookup(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT target FROM translations WHERE source = ?", (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                return row[0]
+            return None
@@ -0,0 +1,154 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from translation_cache import normalize_prompt
+
+
+def image_key(image):
+    """
+    Clave de contenido de una imagen: hash de los píxeles para imágenes en memoria
+    y de ruta + tamaño + fecha de modificación para archivos (sin leerlos enteros).
+    """
+    h = hashlib.sha256()
+    if isinstance(image, (str, os.PathLike)):
+        st = os.stat(image)
+        h.update(f"file:{os.path.abspath(image)}:{st.st_size}:{st.st_mtime_ns}".encode("utf-8"))
+    else:
+        h.update(f"{image.mode}:{image.size}".encode("utf-8"))
+        h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def kv_cache_bytes(kv_cache):
+    """Bytes aproximados de un KV cache de mlx (lista de capas)."""
+    total = 0
+    for layer in kv_cache or []:
+        nbytes = getattr(layer, "nbytes", None)
+        if isinstance(nbytes, int):
+            total += nbytes
+            continue
+        try:
+            for array in layer.state:
+                total += getattr(array, "nbytes", 0)
+        except Exception:
+            pass
+    return total
+
+
+class VLMSessionCache:
+    """
+    Cachés del motor VLM para preguntas repetidas sobre la misma imagen:
+    - features de la torre de visión (VisionFeatureCache de mlx-vlm, por contenido),
+    - estado KV del prefijo (plantilla de chat + tokens de imagen) por imagen, en LRU
+      acotado por bytes: una pregunta nueva solo paga el prefill de sus propios tokens,
+    - respuestas por (imagen, pregunta normalizada).
+    """
+
+    def __init__(self, prefix_max_bytes=1024 ** 3, vision_entries=16, response_entries=256):
+        self.prefix_max_bytes = prefix_max_bytes
+        self.vision_entries = vision_entries
+        self.response_entries = response_entries
+        self.vision_cache = None
+        self.prefix_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefix_hits = 0
+        self._prefixes = OrderedDict() # clave de imagen -> (PromptCacheState, bytes)
+        self._responses = OrderedDict() # (clave de imagen, pregunta) -> texto
+        self._state_factory = None
+        self._lock = threading.Lock()
+
+    def attach(self):
+        """
+        Prepara las cachés dependientes del modelo (al cargar el VLM).
+        Devuelve False si la versión de mlx-vlm no las soporta.
+        """
+        try:
+            from mlx_vlm import VisionFeatureCache
+            from mlx_vlm.generate import PromptCacheState
+        except ImportError:
+            return False
+        with self._lock:
+            self.vision_cache = VisionFeatureCache(max_size=self.vision_entries)
+            self._state_factory = PromptCacheState
+        return True
+
+    def detach(self):
+        """Libera las cachés ligadas al modelo (al descargarlo); las respuestas se conservan."""
+        with self._lock:
+            if self.vision_cache is not None:
+                self.vision_cache.clear()
+            self.vision_cache = None
+            self._state_factory = None
+            self._prefixes.clear()
+            self.prefix_bytes = 0
+
+    def get_response(self, key, query):
+        with self._lock:
+            response_key = (key, normalize_prompt(query))
+            if response_key in self._responses:
+                self._responses.move_to_end(response_key)
+                self.hits += 1
+                return self._responses[response_key]
+            self.misses += 1
+            return None
+
+    def put_response(self, key, query, text):
+        with self._lock:
+            self._responses[(key, normalize_prompt(query))] = text
+            while len(self._responses) > self.response_entries:
+                self._responses.popitem(last=False)
+
+    def prefix_state(self, key):
+        """Estado de prefijo de la imagen (nuevo si no existe), o None sin soporte."""
+        with self._lock:
+            if self._state_factory is None:
+                return None
+            if key in self._prefixes:
+                self._prefixes.move_to_end(key)
+                state, _ = self._prefixes[key]
+                if state.cache is not None:
+                    self.prefix_hits += 1
+                return state
+            state = self._state_factory()
+            self._prefixes[key] = (state, 0)
+            return state
+
+    def account(self, key):
+        """Actualiza el tamaño del estado tras una generación y desaloja por LRU si se pasa del límite."""
+        with self._lock:
+            if key not in self._prefixes:
+                return
+            state, old_size = self._prefixes[key]
+            size = kv_cache_bytes(state.cache)
+            self._prefixes[key] = (state, size)
+            self.prefix_bytes += size - old_size
+            while self.prefix_bytes > self.prefix_max_bytes and len(self._prefixes) > 1:
+                _, (_, evicted) = self._prefixes.popitem(last=False)
+                self.prefix_bytes -= evicted
+            if self.prefix_bytes > self.prefix_max_bytes:
+                # Un único estado más grande que el límite: no se conserva
+                self._prefixes.clear()
+                self.prefix_bytes = 0
+
+    def discard(self, key):
+        """
+        Olvida el estado de prefijo de una imagen. Tras una generación interrumpida el KV cache
+        ya no corresponde a los tokens registrados y reutilizarlo daría respuestas corruptas.
+        """
+        with self._lock:
+            if key in self._prefixes:
+                _, size = self._prefixes.pop(key)
+                self.prefix_bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "response_hits": self.hits,
+                "response_misses": self.misses,
+                "prefix_hits": self.prefix_hits,
+                "prefix_entries": len(self._prefixes),
+                "prefix_bytes": self.prefix_bytes,
+                "vision_entries": len(self.vision_cache) if self.vision_cache is not None else 0,
+            }
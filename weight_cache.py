@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import shutil
+
+# Se incrementa si cambia la disposición de las entradas: las antiguas dejan de ser válidas
+CACHE_FORMAT = 1
+MANIFEST = "manifest.json"
+
+
+def offline_mode():
+    """True si no se debe acceder a la red (QWEN_OFFLINE=1 o HF_HUB_OFFLINE=1)."""
+    return any(os.getenv(name, "").lower() in ("1", "true", "yes", "on") for name in ("QWEN_OFFLINE", "HF_HUB_OFFLINE"))
+
+
+def hf_hub_cache():
+    """Directorio del caché de huggingface_hub, sin importar la librería."""
+    if os.getenv("HF_HUB_CACHE"):
+        return os.getenv("HF_HUB_CACHE")
+    hf_home = os.getenv("HF_HOME", os.path.join(os.path.expanduser("~"), ".cache", "huggingface"))
+    return os.path.join(hf_home, "hub")
+
+
+def local_revision(model_id, ref="main"):
+    """Commit de model_id descargado en el caché de Hugging Face (refs/<ref>), o None."""
+    path = os.path.join(hf_hub_cache(), "models--" + model_id.replace("/", "--"), "refs", ref)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def backend_version():
+    """Versión de mflux instalada (el formato de los pesos guardados depende de ella)."""
+    try:
+        from importlib.metadata import version
+        return version("mflux")
+    except Exception:
+        return "unknown"
+
+
+class QuantizedWeightCache:
+    """
+    Pesos de FLUX ya cuantizados, guardados una vez con Flux1.save_model en
+    <root>/<modelo>/<revisión>/q<bits>. En arranques posteriores se cargan desde ahí:
+    mlx lee los safetensors de forma perezosa (mmap) y no hay que recuantizar.
+    Cada entrada lleva un manifest con versión de formato, versión de mflux y tamaño de
+    cada archivo; validarla solo cuesta un stat por archivo.
+    """
+
+    def __init__(self, root=None):
+        self.root = root or os.getenv("QWEN_WEIGHT_CACHE_DIR",
+                                      os.path.join(os.path.expanduser("~"), ".cache", "qwen_studio", "weights"))
+
+    def entry_dir(self, model_id, revision, bits):
+        return os.path.join(self.root, model_id.replace("/", "--"), revision or "main", f"q{bits or 16}")
+
+    def lookup(self, model_id, revision, bits):
+        """
+        Ruta de una entrada válida, o None.
+        Sin revisión conocida (sin red ni caché de HF) vale la entrada válida más reciente.
+        """
+        if revision:
+            path = self.entry_dir(model_id, revision, bits)
+            return path if self.validate(path) else None
+        model_dir = os.path.join(self.root, model_id.replace("/", "--"))
+        candidates = []
+        try:
+            for name in os.listdir(model_dir):
+                path = os.path.join(model_dir, name, f"q{bits or 16}")
+                if self.validate(path):
+                    candidates.append((os.path.getmtime(os.path.join(path, MANIFEST)), path))
+        except OSError:
+            return None
+        return max(candidates)[1] if candidates else None
+
+    def validate(self, path):
+        """Comprobación barata del manifest: formato, versión de mflux y tamaños de archivo."""
+        manifest = self.read_manifest(path)
+        if manifest is None:
+            return False
+        if manifest.get("format") != CACHE_FORMAT or manifest.get("backend_version") != backend_version():
+            return False
+        for name, size in manifest.get("files", {}).items():
+            try:
+                if os.path.getsize(os.path.join(path, name)) != size:
+                    return False
+            except OSError:
+                return False
+        return bool(manifest.get("files"))
+
+    def read_manifest(self, path):
+        try:
+            with open(os.path.join(path, MANIFEST), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, model, model_id, revision, bits):
+        """
+        Guarda los pesos cuantizados de model. Se escriben en un directorio temporal y el
+        manifest va al final, así que un guardado interrumpido nunca pasa por válido.
+        """
+        path = self.entry_dir(model_id, revision, bits)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        try:
+            model.save_model(tmp_path)
+            files = {}
+            for directory, _, names in os.walk(tmp_path):
+                for name in names:
+                    full = os.path.join(directory, name)
+                    files[os.path.relpath(full, tmp_path)] = os.path.getsize(full)
+            manifest = {
+                "format": CACHE_FORMAT,
+                "model_id": model_id,
+                "revision": revision,
+                "bits": bits,
+                "backend_version": backend_version(),
+                "created": time.time(),
+                "files": files,
+            }
+            with open(os.path.join(tmp_path, MANIFEST), "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(tmp_path, path)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        return path
+
+    def size_bytes(self, path):
+        manifest = self.read_manifest(path) or {}
+        return sum(manifest.get("files", {}).values())